@@ -0,0 +1,149 @@
+import datetime
+import hashlib
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import constants
+import geohash
+import models
+import task_utils
+
+# Each user has a queue of items found by searching around them ahead of
+# time, so that /item/list doesn't have to page through search results that
+# the user has already seen. The queue is refilled in the background, when it
+# runs low, by handlers.item.RefillCandidateFeed.
+
+# The URL of RefillCandidateFeed.
+_REFILL_URL = '/admin/tasks/refill_candidate_feed'
+
+
+def _feed_key(user_key):
+    return ndb.Key(models.CandidateFeed, user_key.id())
+
+
+def is_current(feed, cell, radius_km):
+    """Return whether a feed can be used for a search.
+
+    Args:
+      feed: The models.CandidateFeed, or None.
+      cell: The geohash of the cell of the search area.
+      radius_km: The search radius of the user.
+    """
+    if not feed or feed.cell != cell or feed.radius_km != radius_km:
+        return False
+    age = datetime.datetime.utcnow() - feed.create_date
+    return age.total_seconds() < constants.CANDIDATE_FEED_MAX_AGE_SECONDS
+
+
+def get(user_key):
+    """Return the candidate feed of a user, or None."""
+    return _feed_key(user_key).get()
+
+
+@ndb.transactional
+def pop(user_key, cell, lat, lng, radius_km, count, is_candidate):
+    """Take the next items in range off a user's candidate feed.
+
+    Queued items that aren't candidates anymore are dropped along the way.
+    Items that are only out of the user's range from where they are now stay
+    queued, since the feed is used from anywhere in the cell.
+
+    Args:
+      user_key: The key of the user.
+      cell: The geohash of the cell of the search area.
+      lat, lng: Where the user is searching from.
+      radius_km: The search radius of the user.
+      count: The number of items to take.
+      is_candidate: A function that tells whether an item dictionary can
+        still be listed for the user at all, e.g. because they haven't seen
+        it.
+    Returns:
+      An (items, feed) pair. items is the list of item dictionaries that were
+      taken, or None if the feed can't fill the request, in which case
+      nothing is taken. It may be shorter than count if the search around the
+      feed was exhausted. feed is the user's models.CandidateFeed after the
+      items were taken, or None if the user doesn't have one.
+    """
+    feed = _feed_key(user_key).get()
+    if not is_current(feed, cell, radius_km):
+        return None, feed
+
+    items = []
+    remaining = []
+    for candidate in feed.candidates:
+        if not is_candidate(candidate):
+            continue
+        if len(items) < count and geohash.distance_km(
+                lat, lng, candidate['lat'], candidate['lng']) <= radius_km:
+            items.append(candidate)
+        else:
+            remaining.append(candidate)
+    if not items or (len(items) < count and feed.cursor):
+        return None, feed
+    feed.candidates = remaining
+    feed.put()
+    return items, feed
+
+
+def needs_refill(feed, cell, radius_km):
+    """Return whether a feed returned by pop() should be refilled.
+
+    Args:
+      feed: The models.CandidateFeed, or None.
+      cell: The geohash of the cell of the search area.
+      radius_km: The search radius of the user.
+    """
+    if not is_current(feed, cell, radius_km):
+        return True
+    return bool(feed.cursor and len(feed.candidates) <
+                constants.CANDIDATE_FEED_LOW_WATER_MARK)
+
+
+def start_refill(user_key, lat, lng, feed):
+    """Start refilling a user's candidate feed, if it isn't already.
+
+    Args:
+      user_key: The key of the user.
+      lat, lng: Where the user is searching from. The feed is built from
+        scratch if it isn't current for this location.
+      feed: The models.CandidateFeed returned by pop().
+    """
+    generation = feed.generation if feed else 0
+    try:
+        task_utils.add_task(
+            _REFILL_URL,
+            {'user_id': user_key.id(), 'lat': lat, 'lng': lng},
+            name='refill-candidate-feed-{}-{}'.format(
+                hashlib.md5(user_key.id()).hexdigest(), generation))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional
+def store(user_key, cell, radius_km, generation, candidates, cursor):
+    """Store the results of a refill of a user's candidate feed.
+
+    Args:
+      user_key: The key of the user.
+      cell: The geohash of the cell of the search area.
+      radius_km: The search radius of the user.
+      generation: The generation of the feed that was refilled, or None if
+        the feed was built from scratch.
+      candidates: The item dictionaries to add to the end of the feed.
+      cursor: The web-safe cursor of the search results after the candidates,
+        or None if the search was exhausted.
+    """
+    feed = _feed_key(user_key).get()
+    if generation is None:
+        feed = models.CandidateFeed(
+            key=_feed_key(user_key), cell=cell, radius_km=radius_km,
+            candidates=[], create_date=datetime.datetime.utcnow(),
+            generation=feed.generation if feed else 0)
+    elif not feed or feed.generation != generation:
+        # Someone else refilled the feed in the meantime.
+        return
+    feed.candidates = feed.candidates + candidates
+    feed.cursor = cursor
+    feed.generation += 1
+    feed.put()
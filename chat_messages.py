@@ -0,0 +1,103 @@
+from google.appengine.ext import ndb
+
+import constants
+import models
+
+
+def migrate(conversation):
+    """Move the legacy messages of a conversation into child entities.
+
+    The caller is responsible for storing the conversation and the returned
+    messages, preferably in one transaction.
+
+    Args:
+      conversation: The models.Conversation. It must already have a key.
+    Returns:
+      The list of models.Message to store, which is empty if the
+      conversation was already migrated.
+    """
+    messages = []
+    for message in conversation.legacy_messages:
+        messages.append(models.Message(
+            key=models.Message.key_for(conversation.key, len(messages) + 1),
+            user_key=message.user_key,
+            user_name=message.user_name,
+            message=message.message,
+            create_date=message.create_date))
+    if messages:
+        conversation.legacy_messages = []
+        conversation.message_count = len(messages)
+        conversation.last_message = messages[-1].message
+    return messages
+
+
+def append(conversation, message):
+    """Append a message to a conversation.
+
+    The message is stored as a child of the conversation, keyed by its
+    position, and the conversation only keeps a summary. If the conversation
+    hasn't been migrated yet, it is migrated along the way. The caller is
+    responsible for storing the conversation and the returned messages.
+
+    Args:
+      conversation: The models.Conversation. It must already have a key.
+      message: The unsaved models.Message.
+    Returns:
+      The list of models.Message to store.
+    """
+    messages = migrate(conversation)
+    conversation.message_count += 1
+    message.key = models.Message.key_for(conversation.key,
+                                         conversation.message_count)
+    conversation.last_message = message.message
+    messages.append(message)
+    return messages
+
+
+@ndb.tasklet
+def get_since_async(conversation, cutoff):
+    """Load the messages of a conversation that were sent after a cutoff.
+
+    The messages are read backwards from the end of the conversation, a batch
+    at a time, so this only costs as much as the number of new messages.
+
+    Args:
+      conversation: The models.Conversation.
+      cutoff: A datetime. Only the messages created after it are returned.
+    Returns:
+      A future for the list of models.Message, in the order they were sent.
+    """
+    if conversation.legacy_messages:
+        # The conversation hasn't been migrated yet.
+        raise ndb.Return([m for m in conversation.legacy_messages
+                          if m.create_date > cutoff])
+
+    messages = []
+    end = conversation.message_count
+    while end > 0:
+        start = max(0, end - constants.NUM_MESSAGES_PER_BATCH)
+        batch = yield ndb.get_multi_async(
+            [models.Message.key_for(conversation.key, i)
+             for i in range(end, start, -1)])
+        for message in batch:
+            if not message:
+                continue
+            if message.create_date <= cutoff:
+                raise ndb.Return(messages[::-1])
+            messages.append(message)
+        end = start
+    raise ndb.Return(messages[::-1])
+
+
+def get_all(conversation):
+    """Load all the messages of a conversation, in the order they were sent.
+
+    Args:
+      conversation: The models.Conversation.
+    Returns:
+      The list of models.Message.
+    """
+    if conversation.legacy_messages:
+        return list(conversation.legacy_messages)
+    return models.Message.query(ancestor=conversation.key).order(
+        models.Message.key).fetch()
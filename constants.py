@@ -18,5 +18,112 @@ RETRIEVAL_CATEGORY = 'category'
 RETRIEVAL_POPULAR = 'popular'
 RETRIEVAL_NEARBY = 'nearby'
 
-# Name of the Search API index that contains the items.
+# Name of the Search API index that contains the items. Items are split into
+# regional indexes named after it, see item_search.py.
 ITEM_INDEX_NAME = 'items'
+
+# The precision of the geohash cells of the first regional item indexes.
+# Regions that get too busy can be split further.
+INDEX_REGION_PRECISION = 2
+
+# The number of seconds that each instance caches the routes of the regional
+# item indexes for.
+INDEX_ROUTE_CACHE_TTL_SECONDS = 60
+
+# The maximum number of Facebook access tokens cached by each instance.
+TOKEN_CACHE_SIZE = 10000
+
+# The number of seconds that a resolved Facebook access token stays cached.
+TOKEN_CACHE_TTL_SECONDS = 10 * 60
+
+# The number of seconds that an expired or invalid Facebook access token stays
+# cached.
+TOKEN_CACHE_NEGATIVE_TTL_SECONDS = 60
+
+# The maximum number of documents that the Search API accepts in one put.
+MAX_DOCUMENTS_PER_PUT = 200
+
+# The number of entities processed by each task of a data migration.
+NUM_ENTITIES_PER_MIGRATION_BATCH = 20
+
+# The maximum number of item ids stored in one SeenItems shard. Each id takes
+# 8 bytes, so a full shard is 80 KB, which is cheap to rewrite when an item is
+# added to it.
+MAX_SEEN_ITEMS_PER_SHARD = 10000
+
+# The maximum number of like/dislike decisions in one batch request.
+MAX_LIKES_PER_BATCH = 50
+
+# The maximum number of items posted in one batch request. Each item is
+# stored in its own transaction, and those run in parallel.
+MAX_ITEMS_PER_BATCH = 200
+
+# The number of messages of a conversation to read at once.
+NUM_MESSAGES_PER_BATCH = 20
+
+# The number of times to retry a contended transaction.
+NUM_TRANSACTION_RETRIES = 5
+
+# The maximum number of inbox events to return per update request.
+MAX_INBOX_EVENTS_PER_REQUEST = 100
+
+# How long a user's updates watermark can go without being moved forward,
+# when there is nothing new to deliver.
+MAX_WATERMARK_AGE_SECONDS = 600
+
+# How long deleted items are kept in the deletion log, and in the seen items
+# of the users that saw them. Clients that don't check in for longer than this
+# may miss deletions.
+DELETED_ITEM_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+# How far before a user's last check-in to look in the deletion log, to make
+# up for it being eventually consistent.
+DELETION_LOG_MARGIN_SECONDS = 60
+
+# The maximum number of seconds that a request to /updates can wait for
+# something to happen.
+MAX_UPDATES_WAIT_SECONDS = 25
+
+# How often a waiting request to /updates checks for something new.
+NOTIFIER_POLL_INTERVAL_SECONDS = 0.5
+
+# The maximum number of requests to /updates that wait at the same time on
+# each instance. Each of them holds a request thread, and instances take 10
+# concurrent requests by default, so this leaves room for the other ones.
+MAX_WAITING_UPDATES_REQUESTS = 5
+
+# How long pages of item search results are cached for.
+SEARCH_CACHE_TTL_SECONDS = 60
+
+# The number of shards of the like count of each item.
+NUM_LIKE_COUNTER_SHARDS = 20
+
+# The number of items that the candidate feed of a user is filled up to.
+CANDIDATE_FEED_SIZE = 50
+
+# The number of queued items below which a candidate feed is refilled.
+CANDIDATE_FEED_LOW_WATER_MARK = 15
+
+# The maximum number of pages of search results read by one refill of a
+# candidate feed.
+MAX_PAGES_PER_CANDIDATE_FEED_REFILL = 5
+
+# The number of seconds after which a candidate feed is built from scratch,
+# so that it picks up new items.
+CANDIDATE_FEED_MAX_AGE_SECONDS = 10 * 60
+
+# The smallest number of search results that /item/list takes from a page at
+# a time. This grows by doubling, up to NUM_ITEMS_PER_PAGE.
+MIN_ITEMS_PER_PAGE = 10
+
+# The weight of the latest request in the moving average of the fraction of
+# search results that /item/list skips for a user.
+SKIP_RATIO_SMOOTHING = 0.3
+
+# The number of seconds that new search documents wait in the indexing
+# outbox, so that they are indexed in batches.
+INDEX_OUTBOX_DRAIN_DELAY_SECONDS = 2
+
+# The renditions of item images that /item/list can return, by the length in
+# pixels of their longest side. See image_renditions.py.
+IMAGE_RENDITION_SIZES = {'thumbnail': 100, 'card': 400, 'full': 1600}
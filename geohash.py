@@ -0,0 +1,147 @@
+import math
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# The mean radius of the Earth.
+_EARTH_RADIUS_KM = 6371.0
+
+# The length of a degree of latitude.
+_KM_PER_DEGREE = math.pi * _EARTH_RADIUS_KM / 180
+
+
+def encode(lat, lng, precision):
+    """Return the geohash of the cell containing a point.
+
+    Args:
+      lat: The latitude of the point.
+      lng: The longitude of the point.
+      precision: The number of characters in the geohash.
+    Returns:
+      The geohash, as a string.
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    num_bits = 0
+    even = True
+    while len(geohash) < precision:
+        # Even bits split the longitude, odd bits split the latitude.
+        value, value_range = (lng, lng_range) if even else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        num_bits += 1
+        if num_bits == 5:
+            geohash.append(_BASE32[bits])
+            bits = 0
+            num_bits = 0
+    return ''.join(geohash)
+
+
+def cell_size_degrees(precision):
+    """Return the (height, width) in degrees of the cells of a precision."""
+    num_bits = 5 * precision
+    lng_bits = (num_bits + 1) / 2
+    lat_bits = num_bits / 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def cell_size_km(precision, lat):
+    """Return the (height, width) in km of the cells of a precision.
+
+    Args:
+      precision: The number of characters in the geohashes.
+      lat: The latitude around which to measure the width, which shrinks
+        towards the poles.
+    """
+    height, width = cell_size_degrees(precision)
+    return (height * _KM_PER_DEGREE,
+            width * _KM_PER_DEGREE * math.cos(math.radians(lat)))
+
+
+def decode(geohash):
+    """Return the (lat, lng) of the center of a cell."""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for c in geohash:
+        bits = _BASE32.index(c)
+        for shift in range(4, -1, -1):
+            value_range = lng_range if even else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            even = not even
+    return ((lat_range[0] + lat_range[1]) / 2,
+            (lng_range[0] + lng_range[1]) / 2)
+
+
+def neighborhood(geohash):
+    """Return a cell along with the (up to) 8 cells around it."""
+    lat, lng = decode(geohash)
+    height, width = cell_size_degrees(len(geohash))
+    cells = set()
+    for dlat in (-height, 0, height):
+        neighbor_lat = lat + dlat
+        if not -90 < neighbor_lat < 90:
+            continue
+        for dlng in (-width, 0, width):
+            # Wrap around the antimeridian.
+            neighbor_lng = (lng + dlng + 180) % 360 - 180
+            cells.add(encode(neighbor_lat, neighbor_lng, len(geohash)))
+    return cells
+
+
+def covering(lat, lng, radius_km, precision):
+    """Return the cells of a precision that overlap a circle.
+
+    This uses the circle's bounding box, so it may include a few cells that
+    only overlap the corners of the box.
+
+    Args:
+      lat: The latitude of the center of the circle.
+      lng: The longitude of the center of the circle.
+      radius_km: The radius of the circle.
+      precision: The number of characters in the geohashes.
+    Returns:
+      A set of geohashes.
+    """
+    height, width = cell_size_degrees(precision)
+    dlat = radius_km / _KM_PER_DEGREE
+    south = max(lat - dlat, -90.0)
+    north = min(lat + dlat, 90.0)
+    # Longitudes shrink the most at the latitude closest to a pole.
+    cos_lat = math.cos(math.radians(max(abs(south), abs(north))))
+    if cos_lat * 180 * _KM_PER_DEGREE <= radius_km:
+        west, east = -180.0, 180.0
+    else:
+        dlng = radius_km / (_KM_PER_DEGREE * cos_lat)
+        west, east = lng - dlng, lng + dlng
+
+    def steps(start, end, step):
+        count = int(math.ceil((end - start) / step))
+        return [min(start + i * step, end) for i in range(count + 1)]
+
+    cells = set()
+    for cell_lat in steps(south, north, height):
+        for cell_lng in steps(west, east, width):
+            # Wrap around the antimeridian.
+            cells.add(encode(cell_lat, (cell_lng + 180) % 360 - 180,
+                             precision))
+    return cells
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Return the great-circle distance between two points, in km."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * _EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
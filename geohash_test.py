@@ -0,0 +1,65 @@
+import unittest
+
+import geohash
+
+
+class GeohashTest(unittest.TestCase):
+    def test_encode(self):
+        self.assertEqual('u4pruydqqvj', geohash.encode(57.64911, 10.40744, 11))
+        self.assertEqual('9q8yy', geohash.encode(37.7749, -122.4194, 5))
+
+    def test_decode(self):
+        lat, lng = geohash.decode('u4pruydqqvj')
+        self.assertAlmostEqual(57.64911, lat, places=4)
+        self.assertAlmostEqual(10.40744, lng, places=4)
+
+    def test_cell_size(self):
+        # Odd precisions have square cells in degrees, even ones are twice as
+        # wide as they are high.
+        self.assertEqual((45.0, 45.0), geohash.cell_size_degrees(1))
+        height, width = geohash.cell_size_degrees(2)
+        self.assertEqual(2 * height, width)
+        height_km, width_km = geohash.cell_size_km(5, 60)
+        self.assertAlmostEqual(height_km / 2, width_km, places=6)
+
+    def test_neighborhood(self):
+        cells = geohash.neighborhood('9q8yy')
+        self.assertEqual(9, len(cells))
+        self.assertIn('9q8yy', cells)
+        for cell in cells:
+            lat, lng = geohash.decode(cell)
+            self.assertLess(geohash.distance_km(37.7749, -122.4194, lat, lng),
+                            10)
+        # Cells on the antimeridian have neighbors on the other side.
+        cells = geohash.neighborhood(geohash.encode(0, 179.99, 3))
+        self.assertTrue(any(geohash.decode(c)[1] < 0 for c in cells))
+
+    def test_distance(self):
+        self.assertAlmostEqual(0, geohash.distance_km(10, 20, 10, 20))
+        # One degree of latitude is about 111 km.
+        self.assertAlmostEqual(111.2, geohash.distance_km(0, 0, 1, 0),
+                               places=1)
+
+
+class CoveringTest(unittest.TestCase):
+    def test_small_circle(self):
+        # A circle well inside a cell only overlaps that cell.
+        lat, lng = geohash.decode('ezs42')
+        self.assertSetEqual(set(['ezs42']),
+                            geohash.covering(lat, lng, 1, 5))
+
+    def test_circle_across_cells(self):
+        # A circle around the corner of 4 cells overlaps all of them.
+        cells = geohash.covering(0, 0, 10, 2)
+        self.assertSetEqual(set(['7z', 'kp', 'eb', 's0']), cells)
+
+    def test_antimeridian(self):
+        cells = geohash.covering(0, 179.99, 10, 2)
+        self.assertTrue(geohash.encode(0, -179.99, 2) in cells)
+        self.assertTrue(geohash.encode(0, 179.99, 2) in cells)
+
+    def test_pole(self):
+        # Every longitude is close to a pole.
+        cells = geohash.covering(89.99, 0, 10, 1)
+        self.assertSetEqual(set(geohash.encode(89.99, lng, 1)
+                                for lng in range(-180, 180, 45)), cells)
@@ -7,6 +7,70 @@ import user_utils
 import models
 
 
+def error_dict(error_code, message=None):
+    """Create the JSON representation of an error.
+
+    This is the body of an error response, and also describes the failure
+    of a single operation in a batch request.
+
+    Args:
+      error_code: The error_codes._ErrorCode.
+      message: An optional message with more details.
+    Returns:
+      A dictionary representation of the error.
+    """
+    error = {'status': error_code.name,
+             'error_code': error_code.code}
+    if message:
+        error['message'] = message
+    return {'status': httplib.BAD_REQUEST,
+            'error': error}
+
+
+def parse_args(args_dict, allowed_args, multi=False):
+    """Parse and validate a dictionary of arguments.
+
+    This is what BaseHandler.parse_request() runs on the parameters of a
+    request, and it can also validate each operation of a batch request.
+
+    Args:
+      args_dict: The dictionary of arguments, e.g. a decoded JSON object.
+      allowed_args: The allowed arguments, as for
+        BaseHandler.parse_request().
+      multi: Whether args_dict is a MultiDict of query parameters, where list
+        arguments may be repeated.
+    Returns:
+      The dictionary of parsed arguments, or None if there were any errors
+      in the supplied values.
+    """
+    args = {}
+    try:
+        for arg_name, type_tuple in allowed_args.iteritems():
+            t, required, validate = type_tuple
+            if arg_name not in args_dict.keys():
+                if required:
+                    return None
+                else:
+                    continue
+            # Try casting the value to the given type.
+            if multi and t is list:
+                value = args_dict.getall(arg_name)
+            else:
+                value = t(args_dict[arg_name])
+            # Run the validation function if it's present.
+            if validate and not validate(value):
+                return None
+            args[arg_name] = value
+    except (TypeError, ValueError):
+        return None
+    # Final check to ensure that no additional params were supplied.
+    # args_dict might be a MultiDict, so we need to collapse its keys to a
+    # set.
+    if len(args) != len(set(args_dict.keys())):
+        return None
+    return args
+
+
 class BaseHandler(webapp2.RequestHandler):
     def __init__(self, request, response):
         super(BaseHandler, self).__init__(request, response)
@@ -37,40 +101,16 @@ class BaseHandler(webapp2.RequestHandler):
             args_dict = json.decode(self.request.body)
         else:
             return False
-        seen_args = set()
-        try:
-            for arg_name, type_tuple in allowed_args.iteritems():
-                t, required, validate = type_tuple
-                if arg_name not in args_dict.keys():
-                    if required:
-                        return False
-                    else:
-                        continue
-                # Try casting the value to the given type.
-                if self.request.method == 'GET' and t is list:
-                    value = args_dict.getall(arg_name)
-                else:
-                    value = t(args_dict[arg_name])
-                # Run the validation function if it's present.
-                if validate and not validate(value):
-                    return False
-                self.args[arg_name] = value
-                seen_args.add(arg_name)
-        except ValueError:
+        args = parse_args(args_dict, allowed_args,
+                          multi=self.request.method == 'GET')
+        if args is None:
             return False
-        # Final check to ensure that no additional params were supplied.
-        # args_dict might be a MultiDict, so we need to collapse its keys to a
-        # set.
-        return len(seen_args) == len(set(args_dict.keys()))
+        self.args.update(args)
+        return True
 
     def populate_error_response(self, error_code, message=None):
         self.response.status_int = httplib.BAD_REQUEST
-        error_dict = {'status': error_code.name,
-                      'error_code': error_code.code}
-        if message:
-            error_dict['message'] = message
-        self.response.write(json.encode({'status': httplib.BAD_REQUEST,
-                                         'error': error_dict}))
+        self.response.write(json.encode(error_dict(error_code, message)))
 
     def populate_success_response(self, response_dict={}):
         self.response.status_int = httplib.OK
@@ -78,7 +118,25 @@ class BaseHandler(webapp2.RequestHandler):
         full_dict.update(response_dict)
         self.response.write(json.encode(full_dict))
 
-    def populate_user(self):
+    def get_facebook_user_id(self):
+        """Resolve the request's Facebook access token to a Facebook user id.
+
+        In case of failure, this method populates an error response.
+
+        Returns:
+          The Facebook user id, or None if the token could not be resolved.
+        """
+        fb_access_token = self.request.headers.get('x-auth-token')
+        try:
+            return user_utils.get_cached_facebook_user_id(fb_access_token)
+        except user_utils.FacebookTokenExpiredException:
+            self.populate_error_response(error_codes.FACEBOOK_TOKEN_ERROR)
+            return None
+        except user_utils.FacebookException as e:
+            self.populate_error_response(error_codes.FACEBOOK_ERROR, e.error)
+            return None
+
+    def populate_user(self, fb_user_id=None):
         """Load a models.User corresponding to a Facebook access token.
 
         The loaded user is stored in self.user.
@@ -89,24 +147,24 @@ class BaseHandler(webapp2.RequestHandler):
         In case of failure, this method populates an error response.
 
         Args:
-          fb_access_token: The Facebook access token.
+          fb_user_id: The Facebook user id, if get_facebook_user_id() resolved
+            the access token already.
         Returns:
           True if the populate succeeded, False otherwise.
         """
-        # Use the token to get the Facebook user id.
-        fb_access_token = self.request.headers.get("x-auth-token")
-        try:
-            fb_user_id = user_utils.get_facebook_user_id(fb_access_token)
-        except user_utils.FacebookTokenExpiredException:
-            self.populate_error_response(error_codes.FACEBOOK_TOKEN_ERROR)
-            return False
-        except user_utils.FacebookException as e:
-            self.populate_error_response(error_codes.FACEBOOK_ERROR, e.error)
+        if not fb_user_id:
+            fb_user_id = self.get_facebook_user_id()
+        if not fb_user_id:
             return False
 
         # Retrieve the User object for the given Facebook user id, if it exists.
-        self.user = models.User.query(
-            models.User.third_party_id == fb_user_id).get()
+        self.user = models.User.key_for('facebook', fb_user_id).get()
+        if not self.user:
+            # Users that MigrateUserKeys hasn't re-keyed yet are still stored
+            # under allocated ids.
+            self.user = models.User.query(
+                models.User.login_type == 'facebook',
+                models.User.third_party_id == fb_user_id).get()
         if not self.user:
             # At this point, looks like there is no user with that id.
             self.populate_error_response(error_codes.INVALID_USER)
@@ -120,7 +178,7 @@ class BaseHandler(webapp2.RequestHandler):
         The loaded item is stored in self.item.
 
         This verifies that there is indeed an item with the corresponding
-        item id.
+        item id, and that it hasn't been deleted.
 
         In case of failure, this method populates an error response.
 
@@ -130,7 +188,7 @@ class BaseHandler(webapp2.RequestHandler):
           True if the populate succeeded, False otherwise.
         """
         self.item = models.Item.get_by_id(item_id)
-        if not self.item:
+        if not self.item or self.item.deleted:
             self.populate_error_response(error_codes.INVALID_ITEM)
             return False
         return True
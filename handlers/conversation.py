@@ -1,8 +1,72 @@
+import datetime
 from google.appengine.ext import ndb
 
-import error_codes
 import base
+import chat_messages
+import constants
+import error_codes
+import inbox
 import models
+import notifier
+import seen_items
+
+
+def _get_conversation_key(item_key, buyer_key):
+    """Find the conversation between a buyer and the seller of an item.
+
+    Returns:
+      The ndb.Key of the conversation, or None if there isn't one yet.
+    """
+    conversation_key = models.Conversation.key_for(item_key, buyer_key)
+    if conversation_key.get():
+        return conversation_key
+    # Conversations that were created before they were keyed by their
+    # participants can only be found with a query, until
+    # MigrateConversationKeys has moved them.
+    return models.Conversation.query(
+        models.Conversation.item_key == item_key,
+        models.Conversation.buyer_key == buyer_key).get(keys_only=True)
+
+
+@ndb.transactional(xg=True, retries=constants.NUM_TRANSACTION_RETRIES)
+def _append_message(conversation_key, item, buyer_key, message):
+    """Append a message to a conversation, creating it if needed.
+
+    Only the new message and the conversation's summary are written. A new
+    conversation is also added to the lists of both the buyer and the seller,
+    in the same transaction, so that concurrent first messages can't create it
+    twice. The message is added to the inboxes of both participants in the
+    same transaction as well.
+
+    Args:
+      conversation_key: The key of the conversation.
+      item: The models.Item the conversation is about.
+      buyer_key: The key of the user that wants to buy the item.
+      message: The unsaved models.Message.
+    """
+    conversation = conversation_key.get()
+    entities = []
+    if not conversation:
+        conversation = models.Conversation(key=conversation_key,
+                                           item_key=item.key,
+                                           buyer_key=buyer_key)
+        users = ndb.get_multi([buyer_key, item.user_key])
+        # The seller's account may be gone while the item is still listed.
+        for user in users:
+            if user and conversation_key not in user.conversation_keys:
+                user.conversation_keys.append(conversation_key)
+                entities.append(user)
+    entities.append(conversation)
+    entities.extend(chat_messages.append(conversation, message))
+    ndb.put_multi(entities)
+
+    # Let the clients of both participants know about the message.
+    inbox_futures = [
+        inbox.append_async(user_key,
+                           [inbox.message_event(item.key.id(), message)])
+        for user_key in set([buyer_key, item.user_key])]
+    for future in inbox_futures:
+        future.get_result()
 
 
 class Post(base.BaseHandler):
@@ -10,7 +74,7 @@ class Post(base.BaseHandler):
     def post(self):
         success = self.parse_request(
             {'item_id': (long, True, None),
-             'receiver_id': (long, True, None),
+             'receiver_id': (str, True, None),
              'message': (str, True, lambda x: len(x) > 0)})
         if not success:
             self.populate_error_response(error_codes.MALFORMED_REQUEST)
@@ -40,52 +104,40 @@ class Post(base.BaseHandler):
         # Grab the conversation between the sender and receiver for this
         # item, if it already exists. Since the seller is determined by the
         # item, we only need to keep track of the buyer.
-        conversation = models.Conversation.query(
-            models.Conversation.item_key == self.item.key,
-            models.Conversation.buyer_key == buyer_key).get()
+        conversation_key = _get_conversation_key(self.item.key, buyer_key)
 
         # If there is no conversation, double check that the sender is the
         # buyer, to ensure that sellers can't spam people.
         # Also check that the sender liked the item.
-        added_new_conversation = False
-        if not conversation:
+        if not conversation_key:
             if buyer_key != self.user.key:
                 self.populate_error_response(error_codes.MALFORMED_REQUEST)
                 return
             # First, do the cheaper check to see that the user has even seen
             # this item.
-            if self.item.key.id() not in self.user.seen_item_ids:
+            if self.item.key.id() not in seen_items.get(self.user):
                 self.populate_error_response(error_codes.INVALID_ITEM)
                 return
             # Now do the more expensive check to see that the user actually
             # liked the item.
-            query = models.LikeState.query(
-                models.LikeState.item_key == self.item.key)
-            item_like_state = query.filter(
-                models.LikeState.user_key == self.user.key).get()
+            item_like_state = models.LikeState.key_for(
+                self.user.key, self.item.key.id()).get()
             if not item_like_state or not item_like_state.like_state:
                 self.populate_error_response(error_codes.INVALID_ITEM)
                 return
             # Finally, it's safe to create the conversation.
-            conversation = models.Conversation(item_key=self.item.key,
-                                               buyer_key=buyer_key)
-            added_new_conversation = True
+            conversation_key = models.Conversation.key_for(self.item.key,
+                                                           buyer_key)
 
         # Create the message and append it to the end of the conversation.
         message = models.Message(user_key=self.user.key,
                                  user_name=self.user.name,
-                                 message=self.args['message'])
-        conversation.messages.append(message)
-        conversation_key = conversation.put()
-
-        if added_new_conversation:
-            # This only happens when the current user is the buyer,
-            # so we need to also refetch and update the seller.
-            self.user.ongoing_conversations.append(conversation_key.id())
-            other_user = receiver_key.get()
-            other_user.ongoing_conversations.append(conversation_key.id())
-            ndb.put_multi_async([self.user, other_user])
-
-        # TODO: Push the message to the receiver here.
+                                 message=self.args['message'],
+                                 create_date=datetime.datetime.utcnow())
+        _append_message(conversation_key, self.item, buyer_key, message)
+
+        # Wake up the clients of both participants that are waiting for
+        # updates.
+        notifier.get().notify([buyer_key, self.item.user_key])
 
         self.populate_success_response()
@@ -2,8 +2,10 @@ from google.appengine.ext import ndb
 import httplib
 from webapp2_extras import json
 
+import chat_messages
 import error_codes
 import models
+import seen_items
 import test_utils
 
 
@@ -12,35 +14,25 @@ class PostTest(test_utils.HandlerTest):
         super(PostTest, self).setUp()
 
         # Another user, who is selling an item.
-        self.second_user = models.User(login_type='facebook',
-                                       third_party_id='2',
-                                       name='second_name',
-                                       distance_radius_km=10)
-        self.second_user.put()
+        self.second_user = self.create_user('2',
+                                            name='second_name',
+                                            distance_radius_km=10)
 
         # An item owned by second_user.
         self.item = models.Item(user_key=self.second_user.key)
         self.item.put()
 
         # One more user that likes the above item.
-        self.third_user = models.User(login_type='facebook',
-                                      third_party_id='3',
-                                      name='third_name',
-                                      distance_radius_km=10,
-                                      seen_item_ids=[self.item.key.id()])
-        self.third_user.put()
-        third_user_like_state = models.LikeState(item_key=self.item.key,
-                                                 user_key=self.third_user.key,
-                                                 like_state=True)
-        third_user_like_state.put()
+        self.third_user = self.create_user('3',
+                                           name='third_name',
+                                           distance_radius_km=10)
+        seen_items.add(self.third_user, [self.item.key.id()])
+        self.create_like_state(self.third_user.key, self.item.key, True)
 
         # The test user also likes this item.
-        self.user.seen_item_ids.append(self.item.key.id())
-        self.user.put()
-        self.user_like_state = models.LikeState(item_key=self.item.key,
-                                                user_key=self.user.key,
-                                                like_state=True)
-        self.user_like_state.put()
+        seen_items.add(self.user, [self.item.key.id()])
+        self.user_like_state = self.create_like_state(self.user.key,
+                                                      self.item.key, True)
 
     def test_buyer_must_be_first_message(self):
         # second_user owns the item and there is no convo between him and the
@@ -77,8 +69,7 @@ class PostTest(test_utils.HandlerTest):
                          response_body['error']['error_code'])
 
     def test_buyer_must_have_seen_item(self):
-        self.user.seen_item_ids = []
-        self.user.put()
+        seen_items.remove(self.user, self.item.key.id())
         response = self.app.post(
             '/chat/post',
             params=json.encode({'item_id': self.item.key.id(),
@@ -131,12 +122,14 @@ class PostTest(test_utils.HandlerTest):
 
         # Check that the conversation was created and the message was recorded
         # properly.
-        conversation = models.Conversation.query(
-            models.Conversation.item_key == self.item.key,
-            models.Conversation.buyer_key == self.user.key).get()
+        conversation = models.Conversation.key_for(self.item.key,
+                                                   self.user.key).get()
         self.assertIsNotNone(conversation)
-        self.assertEqual(1, len(conversation.messages))
-        message = conversation.messages[0]
+        self.assertEqual(1, conversation.message_count)
+        self.assertEqual('test_message', conversation.last_message)
+        messages = chat_messages.get_all(conversation)
+        self.assertEqual(1, len(messages))
+        message = messages[0]
         self.assertEqual(self.user.key, message.user_key)
         self.assertEqual('test_message', message.message)
         self.assertEqual('test_name', message.user_name)
@@ -146,10 +139,24 @@ class PostTest(test_utils.HandlerTest):
         # We need to refetch both user objects, since they were updated.
         self.user = self.user.key.get()
         self.second_user = self.second_user.key.get()
-        self.assertListEqual([conversation.key.id()],
-                             self.user.ongoing_conversations)
-        self.assertListEqual([conversation.key.id()],
-                             self.second_user.ongoing_conversations)
+        self.assertListEqual([conversation.key],
+                             self.user.conversation_keys)
+        self.assertListEqual([conversation.key],
+                             self.second_user.conversation_keys)
+
+    def test_missing_seller(self):
+        self.second_user.key.delete()
+        response = self.app.post(
+            '/chat/post',
+            params=json.encode({'item_id': self.item.key.id(),
+                                'receiver_id': self.second_user.key.id(),
+                                'message': 'test_message'}),
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        conversation_key = models.Conversation.key_for(self.item.key,
+                                                       self.user.key)
+        self.assertListEqual([conversation_key],
+                             self.user.key.get().conversation_keys)
 
     def test_seller_response(self):
         # Test user sends a message to second_user about the item.
@@ -172,10 +179,37 @@ class PostTest(test_utils.HandlerTest):
 
         # Check that the conversation was created and the messages were recorded
         # properly.
-        conversation = models.Conversation.query(
-            models.Conversation.item_key == self.item.key,
-            models.Conversation.buyer_key == self.user.key).get()
+        conversation = models.Conversation.key_for(self.item.key,
+                                                   self.user.key).get()
         self.assertIsNotNone(conversation)
-        self.assertEqual(2, len(conversation.messages))
-        self.assertEqual('test_message', conversation.messages[0].message)
-        self.assertEqual('response', conversation.messages[1].message)
+        self.assertEqual(2, conversation.message_count)
+        self.assertEqual('response', conversation.last_message)
+        messages = chat_messages.get_all(conversation)
+        self.assertEqual(2, len(messages))
+        self.assertEqual('test_message', messages[0].message)
+        self.assertEqual('response', messages[1].message)
+
+    def test_legacy_conversation_is_migrated(self):
+        # A conversation whose messages are still stored inside it.
+        conversation = models.Conversation(
+            item_key=self.item.key,
+            buyer_key=self.user_key,
+            legacy_messages=[models.Message(user_key=self.user_key,
+                                            user_name='test_name',
+                                            message='legacy_message')])
+        conversation.put()
+
+        response = self.app.post(
+            '/chat/post',
+            params=json.encode({'item_id': self.item.key.id(),
+                                'receiver_id': self.user_key.id(),
+                                'message': 'response'}),
+            headers=self.headers_for_user(self.second_user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+
+        conversation = conversation.key.get()
+        self.assertListEqual([], conversation.legacy_messages)
+        self.assertEqual(2, conversation.message_count)
+        self.assertListEqual(
+            ['legacy_message', 'response'],
+            [m.message for m in chat_messages.get_all(conversation)])
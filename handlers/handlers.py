@@ -2,6 +2,7 @@ from google.appengine.ext import ndb
 
 import base
 import models
+import stats
 
 # TODO: Get rid of these once the server is considered fully functional.
 
@@ -14,9 +15,27 @@ class DefaultHandler(base.BaseHandler):
 class ClearAllEntry(base.BaseHandler):
     @ndb.toplevel
     def post(self):
+        ndb.delete_multi(models.Message.query().fetch(keys_only=True))
         ndb.delete_multi(models.Conversation.query().fetch(keys_only=True))
+        ndb.delete_multi(models.InboxEvent.query().fetch(keys_only=True))
+        ndb.delete_multi(models.Inbox.query().fetch(keys_only=True))
         ndb.delete_multi(models.User.query().fetch(keys_only=True))
+        ndb.delete_multi(
+            models.UpdatesWatermark.query().fetch(keys_only=True))
+        ndb.delete_multi(models.SeenItems.query().fetch(keys_only=True))
+        ndb.delete_multi(
+            models.CandidateFeed.query().fetch(keys_only=True))
         ndb.delete_multi(models.LikeState.query().fetch(keys_only=True))
+        ndb.delete_multi(
+            models.LikeCounterShard.query().fetch(keys_only=True))
+        ndb.delete_multi(
+            models.PendingDocument.query().fetch(keys_only=True))
         ndb.delete_multi(models.Item.query().fetch(keys_only=True))
+        ndb.delete_multi(models.DeletedItem.query().fetch(keys_only=True))
         ndb.delete_multi(models.Image.query().fetch(keys_only=True))
         self.populate_success_response()
+
+
+class Stats(base.BaseHandler):
+    def get(self):
+        self.populate_success_response({'counters': stats.get_all()})
@@ -6,6 +6,7 @@ from google.appengine.ext.webapp import blobstore_handlers
 import error_codes
 import base
 import models
+import search_cache
 
 
 class GetUploadUrl(base.BaseHandler):
@@ -44,11 +45,18 @@ class Upload(blobstore_handlers.BlobstoreUploadHandler, base.BaseHandler):
             blobstore.delete(image_key)
             return
 
-        # Append the image key to the item's list of images.
+        # Append the image key to the item's list of images. The renditions
+        # of the image are served from its serving URL, see
+        # image_renditions.py, so this is all the image work of an upload.
         image = models.Image(blob_key=image_key,
                              url=images.get_serving_url(image_key))
 
         self.item.image.append(image)
         self.item.put()
 
+        # Listed items are cached along with their images.
+        if self.item.location:
+            search_cache.invalidate(self.item.location.lat,
+                                    self.item.location.lon)
+
         self.populate_success_response()
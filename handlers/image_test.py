@@ -0,0 +1,106 @@
+from google.appengine.api import images
+from google.appengine.ext import blobstore
+from google.appengine.ext.webapp import blobstore_handlers
+import httplib
+from webapp2_extras import json
+
+import error_codes
+import models
+import test_utils
+
+
+class _Upload(object):
+    """Stands in for the BlobInfo of an uploaded file."""
+    def __init__(self, blob_key):
+        self._blob_key = blob_key
+
+    def key(self):
+        return self._blob_key
+
+
+class UploadTest(test_utils.HandlerTest):
+    def setUp(self):
+        super(UploadTest, self).setUp()
+        self.seller = self.create_user('2')
+
+        # An item of the seller's, posted without images.
+        response = self.app.post(
+            '/item/post',
+            params=json.encode({'title': 'title',
+                                'description': 'description',
+                                'price': 10.0,
+                                'currency': 'USD',
+                                'category': 'other',
+                                'lat': 0,
+                                'lng': 0}),
+            headers=self.headers_for_user(self.seller.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        self.item_id = json.decode(response.body)['item_id']
+        self.run_tasks()
+
+        # The blobstore upload of an image.
+        self.testbed.get_stub('blobstore').CreateBlob(
+            'blob_key', 'fake_image_data')
+        self.blob_key = blobstore.BlobKey('blob_key')
+        self.orig_get_uploads = (
+            blobstore_handlers.BlobstoreUploadHandler.get_uploads)
+        blobstore_handlers.BlobstoreUploadHandler.get_uploads = (
+            lambda handler, field_name=None: [_Upload(self.blob_key)])
+
+        self.orig_get_serving_url = images.get_serving_url
+        self.serving_url_calls = []
+
+        def get_serving_url(blob_key, *args, **kwargs):
+            self.serving_url_calls.append(blob_key)
+            return 'http://images/{}'.format(blob_key)
+        images.get_serving_url = get_serving_url
+
+    def tearDown(self):
+        blobstore_handlers.BlobstoreUploadHandler.get_uploads = (
+            self.orig_get_uploads)
+        images.get_serving_url = self.orig_get_serving_url
+        super(UploadTest, self).tearDown()
+
+    def upload(self, user):
+        return self.app.post(
+            '/item/image/upload',
+            params={'item_id': str(self.item_id)},
+            headers={'X-Auth-Token': str(user.third_party_id)},
+            expect_errors=True)
+
+    def test_rendition_urls(self):
+        # Listing the item caches it without images.
+        self.app.get('/item/list', params={'lat': 0, 'lng': 0},
+                     headers=self.headers_for_user(self.user.third_party_id))
+
+        response = self.upload(self.seller)
+        self.assertEqual(httplib.OK, response.status_int)
+        # Only the serving URL is made, whatever the number of renditions.
+        self.assertListEqual([self.blob_key], self.serving_url_calls)
+
+        for image_size, url in [
+                (None, 'http://images/blob_key'),
+                ('thumbnail', 'http://images/blob_key=s100'),
+                ('card', 'http://images/blob_key=s400'),
+                ('full', 'http://images/blob_key=s1600')]:
+            params = {'lat': 0, 'lng': 0}
+            if image_size:
+                params['image_size'] = image_size
+            response = self.app.get(
+                '/item/list', params=params,
+                headers=self.headers_for_user(self.user.third_party_id))
+            self.assertEqual(httplib.OK, response.status_int)
+            results = json.decode(response.body)['results']
+            self.assertListEqual([[url]], [r['image'] for r in results])
+
+    def test_upload_to_other_users_item(self):
+        response = self.upload(self.user)
+        self.assertEqual(httplib.BAD_REQUEST, response.status_int)
+        self.assertEqual(error_codes.USER_PERMISSION_ERROR.code,
+                         json.decode(response.body)['error']['error_code'])
+
+        # The image service isn't called for rejected uploads.
+        self.assertListEqual([], self.serving_url_calls)
+        self.assertIsNone(blobstore.get(self.blob_key))
+        self.assertListEqual(
+            [], models.Item.get_by_id(long(self.item_id)).image)
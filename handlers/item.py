@@ -1,27 +1,70 @@
+import base64
+import collections
+import httplib
 import logging
 
-from google.appengine.api import images
 from google.appengine.api import search
-from google.appengine.ext import blobstore
 from google.appengine.ext import ndb
+from webapp2_extras import json
 
 import constants
 import error_codes
 import base
+import candidate_feed
+import geohash
+import image_renditions
+import index_outbox
+import item_deletion
+import item_search
+import like_counter
 import models
+import search_cache
+import seen_items
+import skip_ratio
+import stats
+import task_utils
+
+
+# The arguments of an item to post, as for base.BaseHandler.parse_request().
+_POST_ARGS = {
+    'title':       (str, True, None),
+    'description': (str, True, None),
+    'price':       (float, True, None),
+    'currency':    (str, True, None),
+    'category':    (str, True, None),
+    'lat':         (float, True, lambda x: -90 <= x <= 90),
+    'lng':         (float, True, lambda x: -180 <= x <= 180)}
+
+
+def _new_item(user, args):
+    """Create an item to post.
+
+    Args:
+      user: The models.User that posts the item.
+      args: The parsed _POST_ARGS of the item.
+    Returns:
+      An (item, document) pair of the unsaved models.Item and the fields of
+      its search document, for index_outbox.put(), or None if the fields
+      can't be indexed, e.g. because one of them is too long.
+    """
+    document = {'user_id': str(user.key.id())}
+    document.update(args)
+    # Build the search document now, so that an item that can't be indexed
+    # is rejected here rather than stuck in the index outbox.
+    try:
+        item_search.build_document(0, document)
+    except (TypeError, ValueError):
+        return None
+    item = models.Item(user_key=user.key,
+                       location=ndb.GeoPt(args['lat'], args['lng']),
+                       document=document)
+    return item, document
 
 
 class Post(base.BaseHandler):
     @ndb.toplevel
     def post(self):
-        success = self.parse_request(
-            {'title':       (str, True, None),
-             'description': (str, True, None),
-             'price':       (float, True, None),
-             'currency':    (str, True, None),
-             'category':    (str, True, None),
-             'lat':         (float, True, lambda x: -90 <= x <= 90),
-             'lng':         (float, True, lambda x: -180 <= x <= 180)})
+        success = self.parse_request(_POST_ARGS)
         if not success:
             self.populate_error_response(error_codes.MALFORMED_REQUEST)
             return
@@ -30,39 +73,70 @@ class Post(base.BaseHandler):
         if not self.populate_user():
             return
 
-        item = models.Item(user_key=self.user.key)
-        item_key = item.put()
-
-        try:
-            fields = [
-                # Include the user ID so we can skip items owned by a user in
-                # queries.
-                search.AtomField(name='user_id', value=str(self.user.key.id())),
-                search.AtomField(name='category', value=self.args['category']),
-                search.TextField(name='title', value=self.args['title']),
-                search.TextField(name='description',
-                                 value=self.args['description']),
-                search.NumberField(name='price', value=self.args['price']),
-                search.TextField(name='currency', value=self.args['currency']),
-                search.GeoField(name='location',
-                                value=search.GeoPoint(
-                                    self.args['lat'], self.args['lng']))]
-            # The Item object's id is shared with the document.
-            item_doc = search.Document(
-                doc_id=str(item_key.id()),
-                fields=fields)
-
-            index = search.Index(name=constants.ITEM_INDEX_NAME)
-            index.put(item_doc)
-        except search.Error:
-            # Delete the stored item.
-            item_key.delete()
-            self.populate_error_response(error_codes.INDEXING_ERROR)
+        new_item = _new_item(self.user, self.args)
+        if not new_item:
+            self.populate_error_response(error_codes.MALFORMED_REQUEST)
             return
 
+        # The item's search document is indexed in the background.
+        item_key = index_outbox.put(*new_item)
+        index_outbox.start_drain()
+
         self.populate_success_response({'item_id': item_key.id()})
 
 
+class PostBatch(base.BaseHandler):
+    """Post many items of the user in one request.
+
+    The 'items' argument is a list of items, each with the same arguments as
+    for Post. The response has one result per item, in the same order, each
+    of which is either a success with the 'item_id' or an error. Items that
+    are invalid, or fail to be stored, don't keep the others from being
+    posted.
+    """
+    @ndb.toplevel
+    def post(self):
+        success = self.parse_request(
+            {'items': (list, True,
+                       lambda x: 0 < len(x) <= constants.MAX_ITEMS_PER_BATCH)})
+        if not success:
+            self.populate_error_response(error_codes.MALFORMED_REQUEST)
+            return
+
+        if not self.populate_user():
+            return
+
+        results = []
+        new_items = []
+        for item_args in self.args['items']:
+            new_item = None
+            if isinstance(item_args, dict):
+                args = base.parse_args(item_args, _POST_ARGS)
+                if args is not None:
+                    new_item = _new_item(self.user, args)
+            if new_item is None:
+                results.append(base.error_dict(error_codes.MALFORMED_REQUEST))
+            else:
+                results.append({'status': httplib.OK})
+                new_items.append(new_item)
+
+        # Store all the valid items at once. Their search documents are
+        # indexed in the background, in batches.
+        if new_items:
+            item_keys = index_outbox.put_multi([i for i, _ in new_items],
+                                               [d for _, d in new_items])
+            valid = [i for i, r in enumerate(results)
+                     if r['status'] == httplib.OK]
+            for i, item_key in zip(valid, item_keys):
+                if item_key:
+                    results[i]['item_id'] = item_key.id()
+                else:
+                    results[i] = base.error_dict(error_codes.GENERIC_ERROR)
+            if any(item_keys):
+                index_outbox.start_drain()
+        self.populate_success_response({'results': results})
+
+
 class Delete(base.BaseHandler):
     @ndb.toplevel
     def post(self):
@@ -77,67 +151,346 @@ class Delete(base.BaseHandler):
         if not self.populate_item_for_mutation(self.args['item_id']):
             return
 
-        # Delete all the likes/dislikes of this item by removing all the
-        # LikedItemState objects that are mentioning this item.
-        dislikes_query = models.LikeState.query(
-            models.LikeState.item_key == self.item.key)
-        ndb.delete_multi_async(dislikes_query.fetch(keys_only=True))
-
-        # Delete all the conversations associated to this item.
-        conversation_keys = models.Conversation.query(
-            models.Conversation.item_key == self.item.key).fetch(keys_only=True)
-        ndb.delete_multi_async(conversation_keys)
-        conversation_ids = set([key.id() for key in conversation_keys])
-
-        # Delete this item's id from all the seen_item_ids lists of all users.
-        users_query = models.User.query(
-            models.User.seen_item_ids == self.item.key.id())
-        cursor = None
-        more = True
-        while more:
-            users, cursor, more = users_query.fetch_page(
-                constants.NUM_USERS_PER_PAGE, start_cusor=cursor)
-            for user in users:
-                # Delete the unique occurrence of the item's id in the
-                # seen_item_ids list.
-                seen_item_index = user.seen_item_ids.index(self.item.key.id())
-                del user.seen_item_ids[seen_item_index]
-                # Delete all (really at most 1) conversation ids that
-                # correspond to conversations this user has about this item.
-                user.ongoing_conversations = \
-                    [i for i in user.ongoing_conversations if i not in
-                     conversation_ids]
-            ndb.put_multi_async(users)
-
-        # TODO: When push notifications are implemented, send a notification
-        #       here to all the clients of buyers for this item, so they delete
-        #       the conversation on their end.
-
-        # Delete all the image data associated to this item.
-        blobstore_future = blobstore.delete_async(
-            [image.blob_key for image in self.item.image])
-        for image in self.item.image:
-            images.delete_serving_url(image.blob_key)
-
-        # Delete the search document associated with this item.
+        # Tombstone the item and start deleting the rest of its data in the
+        # background, since that fans out to every user that has seen it.
+        @ndb.transactional(xg=True)
+        def tombstone():
+            item = self.item.key.get()
+            item.deleted = True
+            item.put()
+            item_deletion.start(item)
+        tombstone()
+
+        # Stop listing the item right away. The deletion retries this if it
+        # fails here, but the cached searches would then keep listing the item
+        # until they expire.
         try:
-            index = search.Index(name=constants.ITEM_INDEX_NAME)
-            index_future = index.delete_async(str(self.item.key.id()))
+            cell, document = item_search.find_document(self.item)
+            if document:
+                item_search.get_index(cell).delete(document.doc_id)
+                # Searches can't have found documents without a location.
+                locations = document['location']
+                if locations:
+                    search_cache.invalidate(locations[0].value.latitude,
+                                            locations[0].value.longitude)
         except search.Error as e:
             logging.error(
                 'Index delete failed for item_id={}. Message: {}'.format(
                     self.item.key.id(), e.message))
 
-        # Delete the item itself.
-        self.item.key.delete_async()
-
-        # We actually have to wait on the Blobstore and Index futures, unlike
-        # the others.
-        index_future.get_result()
-        blobstore_future.wait()
         self.populate_success_response()
 
 
+def _item_dict(document, image_urls):
+    """Create a JSON representation of an item to be returned.
+
+    Args:
+      document: The item's search.Document.
+      image_urls: The serving URLs of the item's images.
+    Returns:
+      A dictionary representation of the item.
+    """
+    # TODO: Figure out how to convert DateTimeProperty.
+    location = document.field('location').value
+    return {
+        'item_id': document.doc_id,
+        'seller_id': document.field('user_id').value,
+        'date_time_added': '',
+        'date_time_modified': '',
+        'title': document.field('title').value,
+        'category': document.field('category').value,
+        'description': document.field('description').value,
+        'price': document.field('price').value,
+        'currency': document.field('currency').value,
+        'image': list(image_urls),
+        'lat': location.latitude,
+        'lng': location.longitude,
+    }
+
+
+def _stored_item_dict(item):
+    """Create a JSON representation of an item from its models.Item.
+
+    Args:
+      item: The models.Item, with its document fields.
+    Returns:
+      A dictionary like the ones returned by _item_dict().
+    """
+    document = item.document
+    return {
+        'item_id': str(item.key.id()),
+        'seller_id': document['user_id'],
+        'date_time_added': '',
+        'date_time_modified': '',
+        'title': document['title'],
+        'category': document['category'],
+        'description': document['description'],
+        'price': document['price'],
+        'currency': document['currency'],
+        'image': [i.url for i in item.image],
+        'lat': document['lat'],
+        'lng': document['lng'],
+    }
+
+
+# The fields of the search results that are needed to pick the items for a
+# user. The rest of the fields are only read for the items that are returned.
+_SCAN_FIELDS = ['user_id', 'location']
+
+
+def _scan_entry(cell, document):
+    """Create the representation of a search result that items are picked by.
+
+    Args:
+      cell: The geohash cell of the index that the document was found in.
+      document: The item's search.Document, with at least the _SCAN_FIELDS.
+    Returns:
+      A dictionary with the item's 'item_id', 'seller_id', 'lat' and 'lng',
+      like the ones returned by _item_dict(), and the 'cell'.
+    """
+    location = document.field('location').value
+    return {
+        'item_id': document.doc_id,
+        'seller_id': document.field('user_id').value,
+        'lat': location.latitude,
+        'lng': location.longitude,
+        'cell': cell,
+    }
+
+
+def _encode_cursor(cell_cursors):
+    """Encode the cursors of the regions of a search into a web-safe cursor.
+
+    Args:
+      cell_cursors: A dictionary from the geohash cells of the regions that
+        aren't exhausted yet to their web-safe cursors, which are None for
+        regions that weren't searched yet.
+    Returns:
+      The cursor, or None if all the regions are exhausted.
+    """
+    if not cell_cursors:
+        return None
+    return base64.urlsafe_b64encode(json.encode(cell_cursors))
+
+
+def _decode_cursor(cursor, cells):
+    """Decode a cursor from _encode_cursor().
+
+    Args:
+      cursor: The web-safe cursor, or None for the first page.
+      cells: The geohash cells of the regions that are searched.
+    Returns:
+      The cursors of the regions that aren't exhausted yet, like the ones
+      passed to _encode_cursor().
+    """
+    if not cursor:
+        return dict.fromkeys(cells)
+    try:
+        cell_cursors = json.decode(base64.urlsafe_b64decode(str(cursor)))
+        if not isinstance(cell_cursors, dict):
+            raise ValueError()
+    except (TypeError, ValueError):
+        # Cursors from before items were split by region are for the
+        # original index.
+        cell_cursors = {'': cursor}
+    return dict((cell, c) for cell, c in cell_cursors.iteritems()
+                if cell in cells)
+
+
+def _get_item_dicts(area, entries):
+    """Read the full representations of picked search results.
+
+    The ones that aren't cached are read from their Items, in one batch.
+
+    Args:
+      area: The search_cache.SearchArea that the items were found in.
+      entries: The dictionaries returned by _scan_entry().
+    Returns:
+      The list of item dicts, in order. Items that were deleted are skipped.
+    """
+    item_ids = [e['item_id'] for e in entries]
+    keys = search_cache.item_keys(area, item_ids)
+    cached = search_cache.get_items(keys)
+    missed_ids = [i for i, item_dict in zip(item_ids, cached)
+                  if item_dict is None]
+    items = dict(zip(missed_ids, ndb.get_multi(
+        [ndb.Key(models.Item, long(i)) for i in missed_ids])))
+
+    item_dicts = []
+    missed = {}
+    for entry, key, item_dict in zip(entries, keys, cached):
+        if item_dict is None:
+            item = items[entry['item_id']]
+            # The item may have been deleted after the search.
+            if not item or item.deleted:
+                continue
+            if item.document:
+                item_dict = _stored_item_dict(item)
+            else:
+                # Items posted before their fields were stored with them are
+                # read from their search documents.
+                document = item_search.get_index(entry.get('cell', '')).get(
+                    entry['item_id'])
+                if not document:
+                    continue
+                item_dict = _item_dict(document, [i.url for i in item.image])
+            missed[key] = item_dict
+        item_dicts.append(item_dict)
+    search_cache.put_items(missed)
+    return item_dicts
+
+
+def _page_prefix(page, limit):
+    """Cut a page from _ItemSearch.fetch_page_async() short.
+
+    Args:
+      page: The page, with the 'cursors' after each of its results.
+      limit: The maximum number of results to keep.
+    Returns:
+      A page with the 'items' and the 'cursor' that continues after them.
+    """
+    if len(page['items']) <= limit:
+        return {'items': page['items'], 'cursor': page['cursor']}
+    return {'items': page['items'][:limit],
+            'cursor': page['cursors'][limit - 1]}
+
+
+class _ItemSearch(object):
+    """A search for items around a search_cache.SearchArea.
+
+    The search doesn't depend on the user, so that its results can be shared
+    by everyone searching around the same place. It covers the user's search
+    radius from anywhere in their cell, and the results are then narrowed
+    down for the user.
+    """
+    def __init__(self, area, category=None, search_terms=(),
+                 retrieval=constants.RETRIEVAL_NEARBY):
+        """Constructor.
+
+        Args:
+          area: The search_cache.SearchArea to search.
+          category: The category to search, if any.
+          search_terms: The sorted list of unique lowercase search terms.
+          retrieval: The constants.RETRIEVAL_* mode that orders the results.
+        """
+        self.area = area
+        self.category = category
+        self.search_terms = search_terms
+        self.retrieval = retrieval
+
+        self.query = item_search.build_query(area.lat, area.lng,
+                                             area.radius_km, category,
+                                             search_terms)
+        self.sort_options = item_search.build_sort_options(retrieval)
+
+    def fetch_page_async(self, page_cursor, limit=None):
+        """Start fetching a page of search results.
+
+        Only the fields that the items are picked by are fetched, see
+        _scan_entry(). Pages of constants.NUM_ITEMS_PER_PAGE results are
+        searched and cached, whatever the limit, so that they are shared by
+        all the users, and then cut short to the limit.
+
+        Args:
+          page_cursor: The web-safe cursor of the page, or None for the first
+            page.
+          limit: The maximum number of results to return, up to
+            constants.NUM_ITEMS_PER_PAGE, which is the default.
+        Returns:
+          A function that returns the page, as a dictionary with the 'items'
+          and the web-safe 'cursor' of the next page, if any.
+        """
+        page_size = constants.NUM_ITEMS_PER_PAGE
+        if limit is None:
+            limit = page_size
+        cache_key = search_cache.page_key(self.area, self.category,
+                                          self.search_terms, self.retrieval,
+                                          page_cursor)
+        page = search_cache.get_page(cache_key)
+        if page is not None:
+            stats.increment('item_search_cache.hit')
+            return lambda: _page_prefix(page, limit)
+        stats.increment('item_search_cache.miss')
+
+        # Search the indexes of all the regions around the area at once.
+        cells = item_search.get_cells_for_circle(self.area.lat, self.area.lng,
+                                                 self.area.radius_km)
+        cell_cursors = _decode_cursor(page_cursor, cells)
+        returned_fields = list(_SCAN_FIELDS)
+        if self.retrieval == constants.RETRIEVAL_POPULAR:
+            returned_fields.append(item_search.LIKE_COUNT_FIELD)
+        search_futures = [
+            (cell, item_search.get_index(cell).search_async(
+                search.Query(self.query,
+                             options=search.QueryOptions(
+                                 limit=page_size,
+                                 cursor=search.Cursor(
+                                     web_safe_string=cell_cursors[cell],
+                                     per_result=True),
+                                 sort_options=self.sort_options,
+                                 returned_fields=returned_fields))))
+            for cell in cells if cell in cell_cursors]
+
+        def get_page():
+            cell_results = [(cell, search_future.get_result().results)
+                            for cell, search_future in search_futures]
+
+            # Merge the results in the order that a single index would have
+            # returned them in, keeping each region's results in order.
+            results = []
+            num_taken = collections.defaultdict(int)
+            while len(results) < page_size:
+                best = None
+                for cell, documents in cell_results:
+                    if num_taken[cell] == len(documents):
+                        continue
+                    document = documents[num_taken[cell]]
+                    key = self._sort_key(document)
+                    if not best or key > best[0]:
+                        best = (key, cell, document)
+                if not best:
+                    break
+                _, cell, document = best
+                results.append((cell, document))
+                num_taken[cell] += 1
+
+            def cursor_after(num_results):
+                """Return the cursor that continues after some results.
+
+                Every region continues after its last result among them, and
+                the ones that are exhausted are dropped.
+                """
+                next_cursors = dict(cell_cursors)
+                num_cell_results = collections.defaultdict(int)
+                for cell, document in results[:num_results]:
+                    next_cursors[cell] = document.cursor.web_safe_string
+                    num_cell_results[cell] += 1
+                for cell, documents in cell_results:
+                    exhausted = len(documents) < page_size
+                    if (exhausted and
+                            num_cell_results[cell] == len(documents)):
+                        del next_cursors[cell]
+                return _encode_cursor(next_cursors)
+
+            # The cursors after each result let the page be cut short.
+            page = {'items': [_scan_entry(cell, d) for cell, d in results],
+                    'cursor': cursor_after(len(results)),
+                    'cursors': [cursor_after(n + 1)
+                                for n in range(len(results))]}
+            search_cache.put_page(cache_key, page)
+            return _page_prefix(page, limit)
+        return get_page
+
+    def _sort_key(self, document):
+        """Return the key that a single index would order a result by."""
+        if self.retrieval == constants.RETRIEVAL_POPULAR:
+            # Documents indexed before like counts were stored in them
+            # count as having none, as in item_search.build_sort_options().
+            like_count = document[item_search.LIKE_COUNT_FIELD]
+            return (like_count[0].value if like_count else 0, document.rank)
+        return document.rank
+
+
 class List(base.BaseHandler):
     @ndb.toplevel
     def get(self):
@@ -146,6 +499,11 @@ class List(base.BaseHandler):
              'lng':          (float, True, lambda x: -180 <= x <= 180),
              'category':     (str, False, None),
              'search_query': (str, False, None),
+             'retrieval':    (str, False,
+                              lambda x: x in (constants.RETRIEVAL_NEARBY,
+                                              constants.RETRIEVAL_POPULAR)),
+             'image_size':   (str, False,
+                              lambda x: x in constants.IMAGE_RENDITION_SIZES),
              'cursor':       (str, False, None)})
         if not success:
             self.populate_error_response(error_codes.MALFORMED_REQUEST)
@@ -153,81 +511,313 @@ class List(base.BaseHandler):
         if not self.populate_user():
             return
 
-        cursor = search.Cursor()
-        if 'cursor' in self.args:
-            cursor = search.Cursor(web_safe_string=self.args['cursor'])
+        cursor = self.args.get('cursor')
 
-        # Populate a set containing the ids of all the items that the user has
-        # already seen. These will need to be skipped.
-        seen_item_ids = set(self.user.seen_item_ids)
+        # Start loading the ids of all the items that the user has already
+        # seen. These will need to be skipped.
+        seen_future = seen_items.get_async(self.user)
 
         # This will store dict representations
         returned_results = []
 
-        query = [
-            'distance(location, geopoint({}, {})) < {}'.format(
-                self.args['lat'], self.args['lng'],
-                self.user.distance_radius_km * 1000),
-            'NOT user_id={}'.format(self.user.key.id())]
-        if 'category' in self.args:
-            query.append('category={}'.format(self.args['category']))
-        if 'search_query' in self.args:
-            # Split the search query on whitespace, convert to lowercase and
-            # stem each word. then join on space and add to the query.
-            t = ['~' + t for t in self.args['search_query'].lower().split()]
-            query.append(' '.join(t))
-        begin_search = True
-        item_index = search.Index(constants.ITEM_INDEX_NAME)
+        area = search_cache.SearchArea(self.args['lat'], self.args['lng'],
+                                       self.user.distance_radius_km)
+        category = self.args.get('category')
+        # Convert the search query to lowercase and split it on whitespace.
+        # The order of the words doesn't matter to the search.
+        search_terms = sorted(
+            set(self.args.get('search_query', '').lower().split()))
+        retrieval = self.args.get('retrieval', constants.RETRIEVAL_NEARBY)
+        item_query = _ItemSearch(area, category, search_terms, retrieval)
+        # First pages of plain nearby listings are served from the user's
+        # candidate feed, when it has enough items queued up.
+        use_feed = (not cursor and not category and not search_terms and
+                    retrieval == constants.RETRIEVAL_NEARBY)
+
+        def is_candidate(item, seen_item_ids):
+            """Return whether an item can be listed for the user at all.
+
+            This skips items that the user has seen already, and the user's
+            own items.
+            """
+            return (long(item['item_id']) not in seen_item_ids and
+                    item['seller_id'] != str(self.user.key.id()))
+
+        def is_in_range(item):
+            """Return whether an item is within the user's search radius."""
+            return (geohash.distance_km(self.args['lat'], self.args['lng'],
+                                        item['lat'], item['lng']) <=
+                    self.user.distance_radius_km)
+
+        # Ask for as many search results as are likely to fill the response,
+        # given how many of them were skipped for the user lately.
+        ratio = skip_ratio.get(self.user.key)
+        num_scanned = 0
+        num_skipped = 0
+
         try:
-            while (len(returned_results) < constants.NUM_ITEMS_PER_REQUEST and
-                   (begin_search or cursor is not None)):
-                begin_search = False
-                search_response = item_index.search(
-                    search.Query(' AND '.join(query),
-                                 options=search.QueryOptions(
-                                     limit=constants.NUM_ITEMS_PER_PAGE,
-                                     cursor=cursor)))
-                cursor = search_response.cursor
-                for document in search_response.results:
-                    # Skip items that the user has seen already.
-                    if int(document.doc_id) in seen_item_ids:
-                        continue
-                    # Create a JSON representation of the item to be returned.
-                    item = models.Item.get_by_id(long(document.doc_id))
-
-                    image_list = []
-                    if item.image:
-                        # TODO: Generate proper collections of differently
-                        # sized image versions.
-                        image_list = [i.url for i in item.image]
-                    # TODO: Figure out how to convert DateTimeProperty.
-                    location = document.field('location').value
-                    item_dict = {
-                        'item_id': document.doc_id,
-                        'seller_id': document.field('user_id').value,
-                        'date_time_added': '',
-                        'date_time_modified': '',
-                        'title': document.field('title').value,
-                        'category': document.field('category').value,
-                        'description': document.field('description').value,
-                        'price': document.field('price').value,
-                        'currency': document.field('currency').value,
-                        'image': image_list,
-                        'lat': location.latitude,
-                        'lng': location.longitude,
-                    }
-                    returned_results.append(item_dict)
-                    if len(returned_results) == constants.NUM_ITEMS_PER_REQUEST:
-                        break
+            page_future = None
+            if not use_feed:
+                page_future = item_query.fetch_page_async(
+                    cursor, skip_ratio.page_limit(
+                        ratio, constants.NUM_ITEMS_PER_REQUEST))
+            seen_item_ids = seen_future.get_result()
+            if use_feed:
+                items, feed = candidate_feed.pop(
+                    self.user.key, area.cell, self.args['lat'],
+                    self.args['lng'], self.user.distance_radius_km,
+                    constants.NUM_ITEMS_PER_REQUEST,
+                    lambda i: is_candidate(i, seen_item_ids))
+                if candidate_feed.needs_refill(
+                        feed, area.cell, self.user.distance_radius_km):
+                    candidate_feed.start_refill(self.user.key,
+                                                self.args['lat'],
+                                                self.args['lng'], feed)
+                if items is not None:
+                    stats.increment('candidate_feed.hit')
+                    returned_results = _get_item_dicts(area, items)
+                    # The feed was searched with the same query, so its
+                    # cursor continues after the queued items. Items that
+                    # were deleted since they were queued are made up for
+                    # from there.
+                    cursor = feed.cursor
+                    num_missing = (constants.NUM_ITEMS_PER_REQUEST -
+                                   len(returned_results))
+                    if cursor and num_missing > 0:
+                        page_future = item_query.fetch_page_async(
+                            cursor, skip_ratio.page_limit(ratio, num_missing))
+                else:
+                    stats.increment('candidate_feed.miss')
+                    page_future = item_query.fetch_page_async(
+                        cursor, skip_ratio.page_limit(
+                            ratio, constants.NUM_ITEMS_PER_REQUEST))
+            while (page_future and
+                   len(returned_results) < constants.NUM_ITEMS_PER_REQUEST):
+                page = page_future()
+                cursor = page['cursor']
+                items = [i for i in page['items']
+                         if is_candidate(i, seen_item_ids) and is_in_range(i)]
+                num_scanned += len(page['items'])
+                num_skipped += len(page['items']) - len(items)
+
+                # Only start on the next page if this one can't possibly fill
+                # up the response, so that it overlaps with the datastore
+                # reads below.
+                page_future = None
+                num_missing = (constants.NUM_ITEMS_PER_REQUEST -
+                               len(returned_results))
+                if cursor and len(items) < num_missing:
+                    page_future = item_query.fetch_page_async(
+                        cursor, skip_ratio.page_limit(
+                            ratio, num_missing - len(items)))
+
+                # The next page, if any, is fetched while these are read.
+                while items and num_missing > 0:
+                    returned_results.extend(
+                        _get_item_dicts(area, items[:num_missing]))
+                    items = items[num_missing:]
+                    num_missing = (constants.NUM_ITEMS_PER_REQUEST -
+                                   len(returned_results))
+
+                # If items went missing, the next page might be needed after
+                # all.
+                if cursor and not page_future and num_missing > 0:
+                    page_future = item_query.fetch_page_async(
+                        cursor, skip_ratio.page_limit(ratio, num_missing))
 
         except search.Error as e:
             logging.error(
                 'Item search failed for query="{}". Message: {}'.format(
-                    query, e.message))
+                    item_query.query, e.message))
             self.populate_error_response(error_codes.SEARCH_ERROR)
             return
 
+        # Comparing these two tells how much of the search is wasted.
+        if num_scanned:
+            skip_ratio.record(self.user.key, num_scanned, num_skipped)
+            stats.increment('item_list.scanned', num_scanned)
+            stats.increment('item_list.returned', len(returned_results))
+
+        # Clients that ask for a size get that rendition of the images, and
+        # the others get the images as they were uploaded.
+        image_size = self.args.get('image_size')
+        if image_size:
+            returned_results = [
+                dict(i, image=[image_renditions.url(u, image_size)
+                               for u in i['image']])
+                for i in returned_results]
+
         response_dict = {'results': returned_results}
         if cursor:
-            response_dict['cursor'] = cursor.web_safe_string
+            response_dict['cursor'] = cursor
         self.populate_success_response(response_dict)
+
+
+class RefillCandidateFeed(base.BaseHandler):
+    """Search ahead for items to list for a user. See candidate_feed.py."""
+    @ndb.toplevel
+    def post(self):
+        success = self.parse_request(
+            {'user_id': (str, True, None),
+             'lat':     (float, True, lambda x: -90 <= x <= 90),
+             'lng':     (float, True, lambda x: -180 <= x <= 180)})
+        if not success:
+            self.populate_error_response(error_codes.MALFORMED_REQUEST)
+            return
+
+        user = models.User.get_by_id(self.args['user_id'])
+        if not user:
+            self.populate_success_response()
+            return
+        seen_future = seen_items.get_async(user)
+
+        area = search_cache.SearchArea(self.args['lat'], self.args['lng'],
+                                       user.distance_radius_km)
+        feed = candidate_feed.get(user.key)
+        if candidate_feed.is_current(feed, area.cell,
+                                     user.distance_radius_km):
+            if not feed.cursor:
+                # The search was exhausted already.
+                self.populate_success_response()
+                return
+            # Continue the search where the feed left off.
+            generation = feed.generation
+            cursor = feed.cursor
+            queued_item_ids = set(c['item_id'] for c in feed.candidates)
+        else:
+            generation = None
+            cursor = None
+            queued_item_ids = set()
+        num_missing = constants.CANDIDATE_FEED_SIZE - len(queued_item_ids)
+
+        # The items are only narrowed down to the ones the user hasn't seen,
+        # since the feed is used from anywhere in the cell. They are checked
+        # against the user's location when they are taken off the feed.
+        item_query = _ItemSearch(area)
+        seen_item_ids = seen_future.get_result()
+        candidates = []
+        try:
+            for _ in range(constants.MAX_PAGES_PER_CANDIDATE_FEED_REFILL):
+                page = item_query.fetch_page_async(cursor)()
+                cursor = page['cursor']
+                candidates.extend(
+                    i for i in page['items']
+                    if long(i['item_id']) not in seen_item_ids and
+                    i['seller_id'] != str(user.key.id()) and
+                    i['item_id'] not in queued_item_ids)
+                if not cursor or len(candidates) >= num_missing:
+                    break
+        except search.Error as e:
+            logging.error(
+                'Item search failed for query="{}". Message: {}'.format(
+                    item_query.query, e.message))
+            raise
+
+        candidate_feed.store(user.key, area.cell, user.distance_radius_km,
+                             generation, candidates, cursor)
+        self.populate_success_response()
+
+
+class DrainIndexOutbox(base.BaseHandler):
+    """Index the search documents of new items, see index_outbox.py.
+
+    This runs shortly after items are posted, and from cron, and continues
+    as a chain of push tasks for as long as there are more documents waiting
+    than fit in one batch. Documents that fail to index with a transient
+    error stay in the outbox for the next drain, and documents that can't
+    be indexed at all are logged and dropped, so that they don't hold up
+    the rest.
+    """
+    def get(self):
+        self.post()
+
+    @ndb.toplevel
+    def post(self):
+        pending, more = index_outbox.get_pending(
+            constants.MAX_DOCUMENTS_PER_PUT)
+        item_keys = [p.key.parent() for p in pending]
+        items = ndb.get_multi(item_keys)
+
+        # Items can be liked before they are indexed. Their like counts are
+        # left dirty until then, see like_state.FoldLikeCounts.
+        counts, _ = like_counter.read(
+            [item.key.id() for item in items if item and not item.deleted])
+
+        routes = item_search.get_routes()
+        documents = {}
+        for p, item in zip(pending, items):
+            if not item or item.deleted:
+                continue
+            cell = item_search.get_cells_for_point(
+                item.location.lat, item.location.lon, routes)[0]
+            try:
+                documents[item.key] = (cell, item_search.build_document(
+                    item.key.id(), p.document, counts[item.key.id()]))
+            except (TypeError, ValueError) as e:
+                logging.error(
+                    'Dropping the invalid search document of item_id={}. '
+                    'Message: {}'.format(item.key.id(), e))
+        try:
+            retry_ids = self._put(documents.values())
+            for doc_id in retry_ids:
+                del documents[ndb.Key(models.Item, long(doc_id))]
+
+            # The items may have been deleted while their documents were
+            # being built. Deletions only delete documents that are already
+            # indexed, so catch up with them here.
+            item_keys = documents.keys()
+            items = ndb.get_multi(item_keys, use_cache=False,
+                                  use_memcache=False)
+            for item_key, item in zip(item_keys, items):
+                cell, document = documents[item_key]
+                if not item or item.deleted:
+                    item_search.get_index(cell).delete(document.doc_id)
+        except search.Error as e:
+            logging.error(
+                'Indexing from the outbox failed. Message: {}'.format(
+                    e.message))
+            raise
+
+        ndb.delete_multi([p.key for p in pending
+                          if str(p.key.parent().id()) not in retry_ids])
+        for _, document in documents.itervalues():
+            location = document.field('location').value
+            search_cache.invalidate(location.latitude, location.longitude)
+
+        if more:
+            task_utils.add_task(self.request.path)
+        self.populate_success_response()
+
+    def _put(self, documents):
+        """Index a list of (cell, document) pairs.
+
+        Documents that the Search API rejects as invalid are logged and
+        skipped.
+
+        Returns:
+          The set of the ids of the documents that failed with a transient
+          error, and should be retried.
+        """
+        cell_documents = collections.defaultdict(list)
+        for cell, document in documents:
+            cell_documents[cell].append(document)
+        retry_ids = set()
+        for cell, documents in cell_documents.iteritems():
+            try:
+                item_search.get_index(cell).put(documents)
+            except search.PutError as e:
+                for document, result in zip(documents, e.results):
+                    if result.code == search.OperationResult.OK:
+                        continue
+                    if result.code == search.OperationResult.INVALID_REQUEST:
+                        logging.error(
+                            'Dropping the search document of item_id={}. '
+                            'Message: {}'.format(document.doc_id,
+                                                 result.message))
+                    else:
+                        logging.warning(
+                            'Indexing item_id={} failed, it will be retried. '
+                            'Message: {}'.format(document.doc_id,
+                                                 result.message))
+                        retry_ids.add(document.doc_id)
+        return retry_ids
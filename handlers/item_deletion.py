@@ -0,0 +1,247 @@
+import hashlib
+import logging
+
+from google.appengine.api import images
+from google.appengine.api import search
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+
+import base
+import constants
+import error_codes
+import inbox
+import item_search
+import like_counter
+import models
+import notifier
+import seen_items
+import task_utils
+
+# The URL of DeleteItemTask.
+_TASK_URL = '/admin/tasks/delete_item'
+
+# The stages of deleting an item, in the order they run. The document goes
+# before the images, so that a listed item never points at deleted images.
+_STAGES = ['conversations', 'notifications', 'document', 'images',
+           'seen_items', 'item']
+
+# The stages that only start once the item has been in the deletion log for
+# constants.DELETED_ITEM_RETENTION_SECONDS. Until then, the item stays in the
+# like states of its viewers, so that /updates can match it against the log.
+_DELAYED_STAGES = ['seen_items']
+
+
+def start(item):
+    """Record the deletion of a tombstoned item and start deleting its data.
+
+    This must be called in the cross-group transaction that tombstones the
+    item, so that the deletion is logged and started if and only if the
+    tombstone is stored.
+
+    Args:
+      item: The models.Item to delete.
+    """
+    models.DeletedItem(id=item.key.id()).put()
+    task_utils.add_task(_TASK_URL,
+                        {'item_id': item.key.id(), 'stage': _STAGES[0]},
+                        transactional=True)
+
+
+def get_deleted_item_ids(since):
+    """Return the ids of the items that were deleted after a point in time.
+
+    Items stay in the deletion log for
+    constants.DELETED_ITEM_RETENTION_SECONDS. The log is eventually
+    consistent, so callers should look a little further back than they need
+    to.
+
+    Args:
+      since: A datetime.
+    Returns:
+      A list of item ids.
+    """
+    return [k.id() for k in models.DeletedItem.query(
+        models.DeletedItem.delete_date > since).fetch(keys_only=True)]
+
+
+def _continue(item_id, stage, cursor=None):
+    """Enqueue the next batch of an item deletion.
+
+    The tasks are named after their position in the deletion, so that a
+    batch that runs twice doesn't fork the rest of the deletion.
+    """
+    args = {'item_id': item_id, 'stage': stage}
+    position = stage
+    countdown = None
+    if cursor:
+        args['cursor'] = cursor
+        position += '-' + hashlib.md5(cursor).hexdigest()
+    elif stage in _DELAYED_STAGES:
+        countdown = constants.DELETED_ITEM_RETENTION_SECONDS
+    try:
+        task_utils.add_task(_TASK_URL, args,
+                            name='delete-item-{}-{}'.format(item_id, position),
+                            countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class DeleteItemTask(base.BaseHandler):
+    """Run one batch of one stage of the deletion of a tombstoned item.
+
+    Every batch is idempotent, so failed tasks can simply be retried.
+    """
+    @ndb.toplevel
+    def post(self):
+        success = self.parse_request(
+            {'item_id': (long, True, None),
+             'stage':   (str, True, lambda x: x in _STAGES),
+             'cursor':  (str, False, None)})
+        if not success:
+            self.populate_error_response(error_codes.MALFORMED_REQUEST)
+            return
+
+        item = models.Item.get_by_id(self.args['item_id'])
+        if not item or not item.deleted:
+            # Either the deletion already finished, or this is a bogus task.
+            self.populate_success_response()
+            return
+
+        cursor = None
+        if 'cursor' in self.args:
+            cursor = Cursor(urlsafe=self.args['cursor'])
+
+        stage = self.args['stage']
+        cursor = getattr(self, '_delete_' + stage)(item, cursor)
+        if cursor:
+            _continue(item.key.id(), stage, cursor.urlsafe())
+        elif stage != _STAGES[-1]:
+            _continue(item.key.id(), _STAGES[_STAGES.index(stage) + 1])
+        self.populate_success_response()
+
+    def _delete_conversations(self, item, cursor):
+        """Delete a page of the conversations about the item.
+
+        Returns:
+          The cursor for the next page, or None if this was the last one.
+        """
+        conversations, cursor, more = models.Conversation.query(
+            models.Conversation.item_key == item.key).fetch_page(
+                constants.NUM_USERS_PER_PAGE, start_cursor=cursor)
+        conversation_keys = set(c.key for c in conversations)
+        conversation_ids = set(c.key.id() for c in conversations)
+
+        # Delete the conversations from the lists of both the buyers and the
+        # seller.
+        user_keys = set(c.buyer_key for c in conversations)
+        user_keys.add(item.user_key)
+        users = [user for user in ndb.get_multi(list(user_keys))
+                 if user and (
+                     conversation_keys.intersection(user.conversation_keys) or
+                     conversation_ids.intersection(
+                         user.ongoing_conversations))]
+        for user in users:
+            user.conversation_keys = \
+                [k for k in user.conversation_keys if k not in
+                 conversation_keys]
+            user.ongoing_conversations = \
+                [i for i in user.ongoing_conversations if i not in
+                 conversation_ids]
+        ndb.put_multi(users)
+
+        # Delete the messages before the conversations, so that a failure
+        # doesn't leave orphaned messages behind.
+        message_key_futures = [
+            models.Message.query(ancestor=c.key).fetch_async(keys_only=True)
+            for c in conversations]
+        ndb.delete_multi([k for f in message_key_futures
+                          for k in f.get_result()])
+        ndb.delete_multi([c.key for c in conversations])
+
+        # TODO: When push notifications are implemented, send a notification
+        #       here to all the clients of buyers for this item, so they delete
+        #       the conversation on their end.
+        return cursor if more else None
+
+    def _delete_notifications(self, item, cursor):
+        """Tell a page of the users that have seen the item about its deletion.
+
+        Every user that has seen the item has a LikeState for it, so the
+        users' clients are told about the deletion through the inboxes of the
+        users of those like states. A retried batch may tell a client twice,
+        which is harmless.
+
+        Returns:
+          The cursor for the next page, or None if this was the last one.
+        """
+        like_states, cursor, more = models.LikeState.query(
+            models.LikeState.item_key == item.key).fetch_page(
+                constants.NUM_USERS_PER_PAGE, start_cursor=cursor)
+        user_keys = list(set(like_state.user_key
+                             for like_state in like_states))
+        inbox_futures = [
+            inbox.append_async(user_key,
+                               [inbox.item_deleted_event(item.key.id())])
+            for user_key in user_keys]
+        for future in inbox_futures:
+            future.get_result()
+        notifier.get().notify(user_keys)
+        return cursor if more else None
+
+    def _delete_images(self, item, cursor):
+        """Delete all the image data associated to the item."""
+        for image in item.image:
+            try:
+                images.delete_serving_url(image.blob_key)
+            except images.Error as e:
+                # The serving URL is gone already if this is a retry.
+                logging.warning(
+                    'Serving URL delete failed for item_id={}. '
+                    'Message: {}'.format(item.key.id(), e.message))
+        blobstore.delete([image.blob_key for image in item.image])
+        return None
+
+    def _delete_document(self, item, cursor):
+        """Delete the search document of the item."""
+        try:
+            item_search.delete_document(item)
+        except search.Error as e:
+            logging.error(
+                'Index delete failed for item_id={}. Message: {}'.format(
+                    item.key.id(), e.message))
+            raise
+        return None
+
+    def _delete_seen_items(self, item, cursor):
+        """Delete a page of the likes/dislikes of the item.
+
+        This is also where the item is deleted from the seen items of the
+        users of those like states.
+
+        Returns:
+          The cursor for the next page, or None if this was the last one.
+        """
+        like_states, cursor, more = models.LikeState.query(
+            models.LikeState.item_key == item.key).fetch_page(
+                constants.NUM_USERS_PER_PAGE, start_cursor=cursor)
+        users = ndb.get_multi(
+            list(set(like_state.user_key for like_state in like_states)))
+        for user in users:
+            if user:
+                seen_items.remove(user, item.key.id())
+        ndb.delete_multi([like_state.key for like_state in like_states])
+        return cursor if more else None
+
+    def _delete_item(self, item, cursor):
+        """Delete the item itself, along with its deletion log entry.
+
+        The item's search document may still be waiting to be indexed, in
+        which case it is deleted as well.
+        """
+        like_counter.delete(item.key.id())
+        ndb.delete_multi([ndb.Key(models.DeletedItem, item.key.id()),
+                          models.PendingDocument.key_for(item.key),
+                          item.key])
+        return None
@@ -2,11 +2,21 @@ from google.appengine.api import search
 from google.appengine.ext import blobstore
 from google.appengine.ext import ndb
 import httplib
+import time
 from webapp2_extras import json
 
+import candidate_feed
 import constants
 import error_codes
+import index_outbox
+import item_search
+import like_counter
 import models
+import search_backend
+import search_cache
+import seen_items
+import skip_ratio
+import stats
 import test_utils
 
 
@@ -34,6 +44,36 @@ class PostTest(test_utils.HandlerTest):
         self.assertEqual(error_codes.MALFORMED_REQUEST.code,
                          response_body['error']['error_code'])
 
+    def test_post_unindexable(self):
+        # Atom fields can't be longer than 500 characters.
+        params = dict(self.params, category='c' * 501)
+        response = self.app.post(
+            '/item/post',
+            params=json.encode(params),
+            headers=self.headers_for_user(self.user.third_party_id),
+            expect_errors=True)
+        self.assertEqual(httplib.BAD_REQUEST, response.status_int)
+        self.assertEqual(0, models.Item.query().count())
+        self.assertEqual(0, models.PendingDocument.query().count())
+
+    def test_drain_skips_invalid_documents(self):
+        # A document that got into the outbox before posts were validated.
+        document = dict(self.params, user_id=str(self.user_key.id()),
+                        category='c' * 501)
+        index_outbox.put(models.Item(user_key=self.user_key,
+                                     location=ndb.GeoPt(0, 0)), document)
+        response = self.app.post(
+            '/item/post',
+            params=json.encode(self.params),
+            headers=self.headers_for_user(self.user.third_party_id))
+        item_id = json.decode(response.body)['item_id']
+        self.run_tasks()
+
+        # The invalid document is dropped, and doesn't hold up the others.
+        self.assertEqual(0, models.PendingDocument.query().count())
+        self.assertIsNotNone(item_search.get_index_for_point(0, 0).get(
+            str(item_id)))
+
     def test_post_simple(self):
         response = self.app.post(
             '/item/post',
@@ -48,8 +88,20 @@ class PostTest(test_utils.HandlerTest):
         self.assertIsNotNone(item)
         self.assertEqual(self.user_key, item.user_key)
 
-        # Check that the search document was created.
-        item_index = search.Index(name=constants.ITEM_INDEX_NAME)
+        self.assertEqual(ndb.GeoPt(0, 0), item.location)
+
+        # The search document waits in the outbox until it is indexed.
+        item_index = item_search.get_index_for_point(0, 0)
+        self.assertIsNone(item_index.get(str(item_id)))
+        self.assertIsNotNone(models.PendingDocument.key_for(item.key).get())
+        self.run_tasks()
+        self.assertIsNone(models.PendingDocument.key_for(item.key).get())
+
+        # Check that the search document was created, in the index of the
+        # item's region.
+        self.assertIsNone(search.Index(name=constants.ITEM_INDEX_NAME).get(
+            str(item_id)))
+        self.assertNotEqual(constants.ITEM_INDEX_NAME, item_index.name)
         doc = item_index.get(str(item_id))
         self.assertIsNotNone(doc)
         self.assertEqual('fake_title', doc.field('title').value)
@@ -59,17 +111,112 @@ class PostTest(test_utils.HandlerTest):
         self.assertEqual('other', doc.field('category').value)
         self.assertEqual(search.GeoPoint(0, 0), doc.field('location').value)
 
+    def test_delete_before_indexing(self):
+        response = self.app.post(
+            '/item/post',
+            params=json.encode(self.params),
+            headers=self.headers_for_user(self.user.third_party_id))
+        item_id = json.decode(response.body)['item_id']
+        response = self.app.post(
+            '/item/delete',
+            params=json.encode({'item_id': item_id}),
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        self.run_tasks()
+
+        self.assertIsNone(models.Item.get_by_id(item_id))
+        self.assertEqual(0, models.PendingDocument.query().count())
+        self.assertIsNone(item_search.get_index_for_point(0, 0).get(
+            str(item_id)))
+
+    def test_like_before_indexing(self):
+        response = self.app.post(
+            '/item/post',
+            params=json.encode(self.params),
+            headers=self.headers_for_user(self.user.third_party_id))
+        item_id = json.decode(response.body)['item_id']
+        liker = self.create_user('2')
+        response = self.app.post(
+            '/item/like',
+            params=json.encode({'item_id': item_id, 'like_state': 1}),
+            headers=self.headers_for_user(liker.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+
+        # There is no document to fold the like into yet, so it stays dirty.
+        self.app.get('/admin/tasks/fold_like_counts')
+        self.assertListEqual([item_id], like_counter.get_dirty_item_ids(10)[0])
+        self.run_tasks()
+        self.app.get('/admin/tasks/fold_like_counts')
+
+        doc = item_search.get_index_for_point(0, 0).get(str(item_id))
+        self.assertEqual(1, doc.field(item_search.LIKE_COUNT_FIELD).value)
+        self.assertListEqual([], like_counter.get_dirty_item_ids(10)[0])
+
+
+class PostBatchTest(test_utils.HandlerTest):
+    def post_batch(self, items):
+        return self.app.post(
+            '/item/post/batch',
+            params=json.encode({'items': items}),
+            headers=self.headers_for_user(self.user.third_party_id),
+            expect_errors=True)
+
+    def test_batch(self):
+        items = [dict(PostTest.params, title='title_{}'.format(i), lng=i)
+                 for i in range(3)]
+        # One invalid item, one that isn't even a dictionary, and one that
+        # can't be indexed.
+        items.insert(1, dict(PostTest.params, lat=900))
+        items.append('item')
+        items.append(dict(PostTest.params, category='c' * 501))
+        response = self.post_batch(items)
+        self.assertEqual(httplib.OK, response.status_int)
+        results = json.decode(response.body)['results']
+        self.assertListEqual([httplib.OK, httplib.BAD_REQUEST, httplib.OK,
+                              httplib.OK, httplib.BAD_REQUEST,
+                              httplib.BAD_REQUEST],
+                             [r['status'] for r in results])
+        self.assertEqual(error_codes.MALFORMED_REQUEST.code,
+                         results[1]['error']['error_code'])
+
+        item_ids = [r['item_id'] for r in results if 'item_id' in r]
+        self.assertEqual(3, len(set(item_ids)))
+        self.run_tasks()
+        for i, item_id in enumerate(item_ids):
+            item = models.Item.get_by_id(item_id)
+            self.assertEqual(self.user_key, item.user_key)
+            self.assertEqual(ndb.GeoPt(0, i), item.location)
+            doc = item_search.get_index_for_point(0, i).get(str(item_id))
+            self.assertEqual('title_{}'.format(i), doc.field('title').value)
+        self.assertEqual(0, models.PendingDocument.query().count())
+
+    def test_full_batch(self):
+        response = self.post_batch(
+            [PostTest.params] * constants.MAX_ITEMS_PER_BATCH)
+        self.assertEqual(httplib.OK, response.status_int)
+        results = json.decode(response.body)['results']
+        self.assertEqual(constants.MAX_ITEMS_PER_BATCH,
+                         len(set(r['item_id'] for r in results)))
+        self.assertEqual(constants.MAX_ITEMS_PER_BATCH,
+                         models.PendingDocument.query().count())
+
+    def test_batch_too_large(self):
+        response = self.post_batch(
+            [PostTest.params] * (constants.MAX_ITEMS_PER_BATCH + 1))
+        self.assertEqual(httplib.BAD_REQUEST, response.status_int)
+        self.assertEqual(0, models.Item.query().count())
+
 
 class ListTest(test_utils.HandlerTest):
     def setUp(self):
         super(ListTest, self).setUp()
         self.maxDiff = None
 
-        item_index = search.Index(name=constants.ITEM_INDEX_NAME)
+        item_index = item_search.get_index()
+        other_user_key = models.User.key_for('facebook', '2')
 
         # An item that belongs to the current user.
-        user_item = models.Item(
-            user_key=ndb.Key(models.User, self.user_key.id()))
+        user_item = models.Item(user_key=self.user_key)
         user_item_key = user_item.put()
         fields = [
             search.AtomField(name='user_id', value=str(self.user_key.id())),
@@ -85,11 +232,11 @@ class ListTest(test_utils.HandlerTest):
             search.Document(doc_id=str(user_item_key.id()), fields=fields))
 
         # Another user's item that this user already liked.
-        liked_item = models.Item(
-            user_key=ndb.Key(models.User, self.user_key.id() + 1))
+        liked_item = models.Item(user_key=other_user_key)
         liked_item_key = liked_item.put()
         fields = [
-            search.AtomField(name='user_id', value=str(self.user_key.id() + 1)),
+            search.AtomField(name='user_id',
+                             value=str(other_user_key.id())),
             search.TextField(name='title', value='liked_item_title'),
             search.TextField(name='category', value=''),
             search.TextField(name='description',
@@ -100,12 +247,8 @@ class ListTest(test_utils.HandlerTest):
                             value=search.GeoPoint(0, 0))]
         item_index.put(
             search.Document(doc_id=str(liked_item_key.id()), fields=fields))
-        like_state = models.LikeState(user_key=self.user_key,
-                                      item_key=liked_item_key,
-                                      like_state=True)
-        like_state.put()
-        self.user.seen_item_ids = [liked_item_key.id()]
-        self.user.put()
+        self.create_like_state(self.user_key, liked_item_key, True)
+        seen_items.add(self.user, [liked_item_key.id()])
 
         # Another user's item that this user hasn't seen. This one also has an
         # image attached to it.
@@ -114,11 +257,13 @@ class ListTest(test_utils.HandlerTest):
         blob_key = blobstore.BlobKey('blob_key')
         image = models.Image(blob_key=blob_key, url='/fake')
         new_item_a = models.Item(
-            user_key=ndb.Key(models.User, self.user_key.id() + 1),
+            user_key=other_user_key,
             image=[image])
         new_item_a_key = new_item_a.put()
+        self.new_item_a_key = new_item_a_key
         fields = [
-            search.AtomField(name='user_id', value=str(self.user_key.id() + 1)),
+            search.AtomField(name='user_id',
+                             value=str(other_user_key.id())),
             search.TextField(name='title', value='new_item_a_title'),
             search.TextField(name='category', value='category_a'),
             search.TextField(name='description',
@@ -132,7 +277,7 @@ class ListTest(test_utils.HandlerTest):
                             fields=fields))
         self.result_item_a = {
             u'item_id': unicode(new_item_a_key.id()),
-            u'seller_id': unicode(self.user_key.id() + 1),
+            u'seller_id': unicode(other_user_key.id()),
             u'date_time_added': u'',
             u'date_time_modified': u'',
             u'title': u'new_item_a_title',
@@ -146,11 +291,12 @@ class ListTest(test_utils.HandlerTest):
 
         # Another user's item that this user hasn't seen, but with a
         # different category.
-        new_item_b = models.Item(
-            user_key=ndb.Key(models.User, self.user_key.id() + 1))
+        new_item_b = models.Item(user_key=other_user_key)
         new_item_b_key = new_item_b.put()
+        self.new_item_b_key = new_item_b_key
         fields = [
-            search.AtomField(name='user_id', value=str(self.user_key.id() + 1)),
+            search.AtomField(name='user_id',
+                             value=str(other_user_key.id())),
             search.TextField(name='title', value='new_item_b_title'),
             search.TextField(name='category', value='category_b'),
             search.TextField(name='description',
@@ -164,7 +310,7 @@ class ListTest(test_utils.HandlerTest):
                             fields=fields))
         self.result_item_b = {
             u'item_id': unicode(new_item_b_key.id()),
-            u'seller_id': unicode(self.user_key.id() + 1),
+            u'seller_id': unicode(other_user_key.id()),
             u'date_time_added': u'',
             u'date_time_modified': u'',
             u'title': u'new_item_b_title',
@@ -196,6 +342,94 @@ class ListTest(test_utils.HandlerTest):
         self.compare_lists_of_dicts_ignore_order(
             [self.result_item_a, self.result_item_b], results)
 
+    def test_skips_concurrently_deleted_items(self):
+        # Delete new_item_a's entity, but leave its search document behind,
+        # as if it was deleted in the middle of the search.
+        self.new_item_a_key.delete()
+        response = self.app.get(
+            '/item/list',
+            params={'lat': 0, 'lng': 0},
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        results = json.decode(response.body)['results']
+        self.compare_lists_of_dicts_ignore_order([self.result_item_b], results)
+
+    def test_image_size(self):
+        response = self.app.get(
+            '/item/list',
+            params={'lat': 0, 'lng': 0, 'image_size': 'thumbnail'},
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        results = json.decode(response.body)['results']
+        self.result_item_a[u'image'] = [u'/fake=s{}'.format(
+            constants.IMAGE_RENDITION_SIZES['thumbnail'])]
+        self.compare_lists_of_dicts_ignore_order(
+            [self.result_item_a, self.result_item_b], results)
+
+        response = self.app.get(
+            '/item/list',
+            params={'lat': 0, 'lng': 0, 'image_size': 'huge'},
+            headers=self.headers_for_user(self.user.third_party_id),
+            expect_errors=True)
+        self.assertEqual(httplib.BAD_REQUEST, response.status_int)
+
+    def test_fields_from_item(self):
+        # Store new_item_b's fields in its entity, and leave only the fields
+        # that items are picked by in its search document, to ensure that
+        # the rest aren't read from there.
+        item_index = item_search.get_index()
+        document = item_index.get(str(self.new_item_b_key.id()))
+        item_index.put(search.Document(
+            doc_id=document.doc_id,
+            fields=[document.field('user_id'), document.field('location')]))
+        item = self.new_item_b_key.get()
+        item.image = [models.Image(url='/b1'), models.Image(url='/b2')]
+        item.document = {'user_id': document.field('user_id').value,
+                         'title': 'new_item_b_title',
+                         'category': 'category_b',
+                         'description': 'new_item_b_description',
+                         'price': 10.0,
+                         'currency': 'currency_b',
+                         'lat': 0,
+                         'lng': 0}
+        item.put()
+
+        response = self.app.get(
+            '/item/list',
+            params={'lat': 0, 'lng': 0},
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        results = json.decode(response.body)['results']
+        self.result_item_b[u'image'] = [u'/b1', u'/b2']
+        self.compare_lists_of_dicts_ignore_order(
+            [self.result_item_a, self.result_item_b], results)
+
+    def test_search_results_are_cached(self):
+        def get_results():
+            response = self.app.get(
+                '/item/list',
+                params={'lat': 0, 'lng': 0},
+                headers=self.headers_for_user(self.user.third_party_id))
+            self.assertEqual(httplib.OK, response.status_int)
+            return json.decode(response.body)['results']
+
+        self.compare_lists_of_dicts_ignore_order(
+            [self.result_item_a, self.result_item_b], get_results())
+
+        # Index another item behind the cache's back.
+        new_item_c = models.Item(user_key=models.User.key_for('facebook', '2'))
+        new_item_c_key = new_item_c.put()
+        item_index = item_search.get_index()
+        document = item_index.get(str(self.new_item_b_key.id()))
+        item_index.put(search.Document(doc_id=str(new_item_c_key.id()),
+                                       fields=document.fields))
+        self.compare_lists_of_dicts_ignore_order(
+            [self.result_item_a, self.result_item_b], get_results())
+
+        # Once the cache is invalidated around the item, it shows up.
+        search_cache.invalidate(0, 0)
+        self.assertEqual(3, len(get_results()))
+
     def test_distance_too_far(self):
         response = self.app.get(
             '/item/list',
@@ -232,6 +466,193 @@ class ListTest(test_utils.HandlerTest):
         # Only new_item_b has the token being searched for.
         self.compare_lists_of_dicts_ignore_order([self.result_item_b], results)
 
+    def test_get_popular(self):
+        item_index = item_search.get_index()
+        for item_key, like_count in [(self.new_item_a_key, 1),
+                                     (self.new_item_b_key, 5)]:
+            document = item_index.get(str(item_key.id()))
+            item_index.put(item_search.with_like_count(document, like_count))
+
+        response = self.app.get(
+            '/item/list',
+            params={'lat': 0, 'lng': 0,
+                    'retrieval': constants.RETRIEVAL_POPULAR},
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        results = json.decode(response.body)['results']
+
+        # The most liked item comes first.
+        self.assertListEqual([self.result_item_b, self.result_item_a],
+                             results)
+
+    def test_candidate_feed(self):
+        orig_num_items_per_request = constants.NUM_ITEMS_PER_REQUEST
+        constants.NUM_ITEMS_PER_REQUEST = 1
+
+        def get_results(lng=0):
+            response = self.app.get(
+                '/item/list',
+                params={'lat': 0, 'lng': lng},
+                headers=self.headers_for_user(self.user.third_party_id))
+            self.assertEqual(httplib.OK, response.status_int)
+            return json.decode(response.body)['results']
+
+        try:
+            # Without a feed, the items are searched for, and the feed is
+            # filled in the background.
+            self.assertEqual(1, len(get_results()))
+            self.assertIsNone(candidate_feed.get(self.user_key))
+            self.run_tasks()
+            feed = candidate_feed.get(self.user_key)
+            self.assertItemsEqual(
+                [unicode(self.new_item_a_key.id()),
+                 unicode(self.new_item_b_key.id())],
+                [c['item_id'] for c in feed.candidates])
+
+            # Now the items come from the feed, even if the search doesn't
+            # find them anymore. Their fields are read from the Items, as
+            # for items posted since the fields are stored with them.
+            for result in [self.result_item_a, self.result_item_b]:
+                item = models.Item.get_by_id(long(result['item_id']))
+                item.document = dict(
+                    (name, result[name])
+                    for name in ['title', 'category', 'description', 'price',
+                                 'currency', 'lat', 'lng'])
+                item.document['user_id'] = result['seller_id']
+                item.put()
+            item_search.get_index().delete([str(self.new_item_a_key.id()),
+                                            str(self.new_item_b_key.id())])
+            search_cache.invalidate(0, 0)
+            first_result = get_results()
+            self.assertEqual(1, len(first_result))
+            self.assertEqual(1, len(candidate_feed.get(
+                self.user_key).candidates))
+
+            # Far away from where the feed was built, the items are searched
+            # for again.
+            self.assertListEqual([], get_results(lng=90))
+            self.assertEqual(1, len(candidate_feed.get(
+                self.user_key).candidates))
+
+            second_result = get_results()
+            self.assertEqual(1, len(second_result))
+            self.assertItemsEqual([self.result_item_a, self.result_item_b],
+                                  first_result + second_result)
+        finally:
+            constants.NUM_ITEMS_PER_REQUEST = orig_num_items_per_request
+
+    def test_candidate_feed_keeps_items_out_of_range(self):
+        area = search_cache.SearchArea(0.01, 0.01, 10)
+        self.assertEqual(area.cell,
+                         search_cache.SearchArea(0.04, 0.04, 10).cell)
+        far = {'item_id': u'1', 'seller_id': u'2', 'lat': 0.01, 'lng': 0.105,
+               'cell': ''}
+        near = {'item_id': u'3', 'seller_id': u'2', 'lat': 0.01, 'lng': 0.01,
+                'cell': ''}
+        candidate_feed.store(self.user_key, area.cell, 10, None, [far, near],
+                             None)
+
+        # The first item is out of range here, but not elsewhere in the cell.
+        items, _ = candidate_feed.pop(self.user_key, area.cell, 0.01, 0.01,
+                                      10, 1, lambda i: True)
+        self.assertListEqual([near], items)
+        items, _ = candidate_feed.pop(self.user_key, area.cell, 0.04, 0.04,
+                                      10, 1, lambda i: True)
+        self.assertListEqual([far], items)
+
+    def test_candidate_feed_makes_up_for_deleted_items(self):
+        orig_num_items_per_request = constants.NUM_ITEMS_PER_REQUEST
+        orig_num_items_per_page = constants.NUM_ITEMS_PER_PAGE
+        constants.NUM_ITEMS_PER_REQUEST = 1
+        constants.NUM_ITEMS_PER_PAGE = 1
+
+        def get_response():
+            response = self.app.get(
+                '/item/list',
+                params={'lat': 0, 'lng': 0},
+                headers=self.headers_for_user(self.user.third_party_id))
+            self.assertEqual(httplib.OK, response.status_int)
+            return json.decode(response.body)
+
+        try:
+            body = get_response()
+            first_result = body['results'][0]
+
+            # Queue the first item, and delete it before it is listed.
+            area = search_cache.SearchArea(0, 0, self.user.distance_radius_km)
+            candidate_feed.store(
+                self.user_key, area.cell, self.user.distance_radius_km, None,
+                [{'item_id': first_result['item_id'],
+                  'seller_id': first_result['seller_id'],
+                  'lat': 0, 'lng': 0, 'cell': ''}],
+                body['cursor'])
+            item = models.Item.get_by_id(long(first_result['item_id']))
+            item.deleted = True
+            item.put()
+            search_cache.invalidate(0, 0)
+
+            # The search continues from the feed's cursor instead.
+            results = get_response()['results']
+            self.assertEqual(1, len(results))
+            self.assertNotEqual(first_result['item_id'],
+                                results[0]['item_id'])
+        finally:
+            constants.NUM_ITEMS_PER_REQUEST = orig_num_items_per_request
+            constants.NUM_ITEMS_PER_PAGE = orig_num_items_per_page
+
+    def test_skip_ratio(self):
+        orig_scanned = stats.get_all().get('item_list.scanned', 0)
+        response = self.app.get(
+            '/item/list',
+            params={'lat': 0, 'lng': 0},
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+
+        # The user's own item and the liked item were skipped.
+        self.assertEqual(4, stats.get_all()['item_list.scanned'] -
+                         orig_scanned)
+        self.assertEqual(0.5, skip_ratio.get(self.user_key))
+
+    def test_regions(self):
+        # Move new_item_b to a region next to new_item_a's.
+        item_index = item_search.get_index()
+        document = item_index.get(str(self.new_item_b_key.id()))
+        fields = [f for f in document.fields if f.name != 'location']
+        fields.append(search.GeoField(name='location',
+                                      value=search.GeoPoint(0.01, -0.01)))
+        regional_index = item_search.get_index_for_point(0.01, -0.01)
+        self.assertNotEqual(item_search.get_index_for_point(0, 0).name,
+                            regional_index.name)
+        regional_index.put(search.Document(doc_id=document.doc_id,
+                                           fields=fields))
+        item_index.delete(document.doc_id)
+
+        orig_num_items_per_request = constants.NUM_ITEMS_PER_REQUEST
+        orig_num_items_per_page = constants.NUM_ITEMS_PER_PAGE
+        constants.NUM_ITEMS_PER_REQUEST = 1
+        constants.NUM_ITEMS_PER_PAGE = 1
+        try:
+            # Page through the results of both regions.
+            item_ids = []
+            params = {'lat': 0, 'lng': 0}
+            while True:
+                response = self.app.get(
+                    '/item/list',
+                    params=params,
+                    headers=self.headers_for_user(self.user.third_party_id))
+                self.assertEqual(httplib.OK, response.status_int)
+                json_body = json.decode(response.body)
+                item_ids.extend(r['item_id'] for r in json_body['results'])
+                if 'cursor' not in json_body:
+                    break
+                params['cursor'] = json_body['cursor']
+        finally:
+            constants.NUM_ITEMS_PER_REQUEST = orig_num_items_per_request
+            constants.NUM_ITEMS_PER_PAGE = orig_num_items_per_page
+
+        self.assertItemsEqual([unicode(self.new_item_a_key.id()),
+                               unicode(self.new_item_b_key.id())], item_ids)
+
     def test_cursor(self):
         orig_num_items_per_request = constants.NUM_ITEMS_PER_REQUEST
         orig_num_items_per_page = constants.NUM_ITEMS_PER_PAGE
@@ -283,6 +704,18 @@ class ListTest(test_utils.HandlerTest):
             constants.NUM_ITEMS_PER_PAGE = orig_num_items_per_page
 
 
+class InMemoryListTest(ListTest):
+    """Runs the list tests against the in-process search engine."""
+    def setUp(self):
+        self.original_backend = search_backend.get()
+        search_backend.set_backend(search_backend.InMemorySearchBackend())
+        super(InMemoryListTest, self).setUp()
+
+    def tearDown(self):
+        search_backend.set_backend(self.original_backend)
+        super(InMemoryListTest, self).tearDown()
+
+
 class DeleteTest(test_utils.HandlerTest):
     def test_delete_invalid_item(self):
         # Ensure that there is no item with id=7.
@@ -301,8 +734,7 @@ class DeleteTest(test_utils.HandlerTest):
 
     def test_delete_wrong_user(self):
         # Set up an item that is owned by a different user.
-        item = models.Item(
-            user_key=ndb.Key(models.User, self.user_key.id() + 1))
+        item = models.Item(user_key=models.User.key_for('facebook', '2'))
         item_key = item.put()
         response = self.app.post(
             '/item/delete',
@@ -341,25 +773,23 @@ class DeleteTest(test_utils.HandlerTest):
         self.assertIsNotNone(item_index.get(str(item_key.id())))
 
         # Set up a second user that has seen this item.
-        other_user = models.User(login_type='facebook',
-                                 third_party_id='2',
-                                 seen_item_ids=[item_key.id()])
-        other_user_key = other_user.put()
-        like_state = models.LikeState(user_key=other_user_key,
-                                      item_key=item_key,
-                                      like_state=True)
-        like_state_key = like_state.put()
+        other_user = self.create_user('2')
+        seen_items.add(other_user, [item_key.id()])
+        other_user_key = other_user.key
+        like_state_key = self.create_like_state(other_user_key, item_key,
+                                                True).key
         self.assertIsNotNone(like_state_key.get())
 
         # Set up a chat conversation between other_user and the test user
         # about this item.
-        conversation = models.Conversation(item_key=item_key,
-                                           buyer_key=other_user_key)
-        conversation_key = conversation.put()
-        self.assertIsNotNone(conversation_key.get())
+        conversation_key = self.create_conversation(
+            item_key, other_user_key,
+            [models.Message(user_key=other_user_key, message='hello')])
+        message_key = models.Message.key_for(conversation_key, 1)
+        self.assertIsNotNone(message_key.get())
 
         # Add the conversation to the list of the other user's conversations.
-        other_user.ongoing_conversations = [conversation_key.id()]
+        other_user.conversation_keys = [conversation_key]
         other_user.put()
 
         # Delete the item.
@@ -369,14 +799,31 @@ class DeleteTest(test_utils.HandlerTest):
             headers=self.headers_for_user(self.user.third_party_id))
         self.assertEqual(httplib.OK, response.status_int)
 
-        # Check that the other user's seen_item_ids list no longer has this
-        # item's id, and their ongoing_conversations list doesn't have the
+        # The item is tombstoned and unlisted right away, and can't be
+        # deleted again.
+        self.assertTrue(item_key.get().deleted)
+        self.assertIsNone(item_index.get(str(item_key.id())))
+        response = self.app.post(
+            '/item/delete',
+            params=json.encode({'item_id': item_key.id()}),
+            headers=self.headers_for_user(self.user.third_party_id),
+            expect_errors=True)
+        self.assertEqual(httplib.BAD_REQUEST, response.status_int)
+        response_body = json.decode(response.body)
+        self.assertEqual(error_codes.INVALID_ITEM.code,
+                         response_body['error']['error_code'])
+
+        # The rest of the data is deleted in the background.
+        self.run_tasks()
+
+        # Check that the other user's seen items no longer have this
+        # item's id, and their conversation_keys list doesn't have the
         # associated conversation either.
         # We need to refetch other_user because the version we have is a
         # local copy.
         other_user = other_user_key.get()
-        self.assertListEqual([], other_user.seen_item_ids)
-        self.assertListEqual([], other_user.ongoing_conversations)
+        self.assertListEqual([], self.get_seen_item_ids(other_user_key))
+        self.assertListEqual([], other_user.conversation_keys)
 
         # Check that the associated search document was deleted.
         self.assertIsNone(item_index.get(str(item_key.id())))
@@ -387,9 +834,82 @@ class DeleteTest(test_utils.HandlerTest):
         # Check that the like state was deleted.
         self.assertIsNone(like_state_key.get())
 
-        # Check that the conversation was deleted.
+        # Check that the conversation and its messages were deleted.
         self.assertIsNone(conversation_key.get())
+        self.assertIsNone(message_key.get())
 
-        # Check that the item itself was deleted.
+        # Check that the item itself was deleted, along with its deletion
+        # log entry.
         self.assertIsNone(item_key.get())
+        self.assertIsNone(ndb.Key(models.DeletedItem, item_key.id()).get())
+
+    def test_delete_pages_through_viewers(self):
+        item = models.Item(user_key=self.user_key)
+        item_key = item.put()
+        viewers = [self.create_user(str(i)) for i in range(2, 5)]
+        for viewer in viewers:
+            seen_items.add(viewer, [item_key.id(), item_key.id() + 1])
+            self.create_like_state(viewer.key, item_key, False)
 
+        orig_num_users_per_page = constants.NUM_USERS_PER_PAGE
+        constants.NUM_USERS_PER_PAGE = 2
+        try:
+            response = self.app.post(
+                '/item/delete',
+                params=json.encode({'item_id': item_key.id()}),
+                headers=self.headers_for_user(self.user.third_party_id))
+            self.assertEqual(httplib.OK, response.status_int)
+            self.run_tasks()
+        finally:
+            constants.NUM_USERS_PER_PAGE = orig_num_users_per_page
+
+        for viewer in viewers:
+            self.assertListEqual([item_key.id() + 1],
+                                 self.get_seen_item_ids(viewer.key))
+        self.assertListEqual(
+            [], models.LikeState.query(
+                models.LikeState.item_key == item_key).fetch())
+        self.assertIsNone(item_key.get())
+
+    def test_deletion_batches_are_idempotent(self):
+        item = models.Item(user_key=self.user_key, deleted=True)
+        item_key = item.put()
+        viewer = self.create_user('2')
+        seen_items.add(viewer, [item_key.id()])
+        self.create_like_state(viewer.key, item_key, True)
+
+        # Run the seen items batch twice, as if the task was retried.
+        for _ in range(2):
+            response = self.app.post(
+                '/admin/tasks/delete_item',
+                params=json.encode({'item_id': item_key.id(),
+                                    'stage': 'seen_items'}),
+                headers={'Content-Type': 'application/json'})
+            self.assertEqual(httplib.OK, response.status_int)
+        self.assertListEqual([], self.get_seen_item_ids(viewer.key))
+
+        # Both runs enqueued the next stage, but under the same task name, so
+        # the rest of the deletion only runs once.
+        taskqueue_stub = self.testbed.get_stub('taskqueue')
+        self.assertEqual(1, len(taskqueue_stub.get_filtered_tasks()))
+        self.run_tasks()
+        self.assertIsNone(item_key.get())
+
+    def test_seen_items_cleanup_is_delayed(self):
+        item = models.Item(user_key=self.user_key, deleted=True)
+        item_key = item.put()
+
+        # Finishing the stage before the seen items cleanup schedules it for
+        # when the item leaves the deletion log.
+        response = self.app.post(
+            '/admin/tasks/delete_item',
+            params=json.encode({'item_id': item_key.id(),
+                                'stage': 'images'}),
+            headers={'Content-Type': 'application/json'})
+        self.assertEqual(httplib.OK, response.status_int)
+        taskqueue_stub = self.testbed.get_stub('taskqueue')
+        tasks = taskqueue_stub.get_filtered_tasks()
+        self.assertEqual(1, len(tasks))
+        self.assertGreater(
+            tasks[0].eta_posix - time.time(),
+            constants.DELETED_ITEM_RETENTION_SECONDS - 60)
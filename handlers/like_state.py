@@ -1,8 +1,68 @@
+import collections
+import httplib
+import logging
+
+from google.appengine.api import search
 from google.appengine.ext import ndb
 
+import constants
 import error_codes
 import base
+import item_search
+import like_counter
 import models
+import seen_items
+import task_utils
+
+
+@ndb.transactional
+def _upsert_like_states(user, like_states):
+    """Record a user's like states for items, marking the items as seen.
+
+    For each item, an existing like state is simply updated, otherwise a new
+    one is stored. Both the like states and the seen items are in the user's
+    entity group, so this is a single transaction.
+
+    Args:
+      user: The models.User.
+      like_states: A list of (item key, like state) pairs, where the like
+        state is a boolean.
+    Returns:
+      A dictionary from item ids to the changes of their like counts.
+    """
+    like_state_keys = [models.LikeState.key_for(user.key, item_key.id())
+                       for item_key, _ in like_states]
+    existing_like_states = dict(
+        (like_state.key, like_state)
+        for like_state in ndb.get_multi(like_state_keys) if like_state)
+
+    new_item_ids = []
+    like_count_deltas = {}
+    for like_state_key, (item_key, like_state) in zip(like_state_keys,
+                                                      like_states):
+        item_like_state = existing_like_states.get(like_state_key)
+        if item_like_state:
+            if item_like_state.like_state != like_state:
+                like_count_deltas[item_key.id()] = (
+                    like_count_deltas.get(item_key.id(), 0) +
+                    (1 if like_state else -1))
+            item_like_state.like_state = like_state
+        else:
+            item_like_state = models.LikeState(key=like_state_key,
+                                               item_key=item_key,
+                                               user_key=user.key,
+                                               like_state=like_state)
+            existing_like_states[like_state_key] = item_like_state
+            new_item_ids.append(item_key.id())
+            if like_state:
+                like_count_deltas[item_key.id()] = (
+                    like_count_deltas.get(item_key.id(), 0) + 1)
+    ndb.put_multi(existing_like_states.values())
+
+    # Mark that the user has now seen the new items.
+    if new_item_ids:
+        seen_items.add(user, new_item_ids)
+    return like_count_deltas
 
 
 class Post(base.BaseHandler):
@@ -21,26 +81,131 @@ class Post(base.BaseHandler):
         if not self.populate_item(self.args['item_id']):
             return
 
-        entities_to_update = []
-
-        # Check if we already recorded a like state for this user, item pair.
-        # If it exists, simply update it, otherwise store a new one.
-        query = models.LikeState.query(
-            models.LikeState.item_key == self.item.key)
-        item_like_state = query.filter(
-            models.LikeState.user_key == self.user.key).get()
-        if item_like_state:
-            item_like_state.like_state = bool(self.args['like_state'])
-        else:
-            item_like_state = models.LikeState(
-                item_key=self.item.key,
-                user_key=self.user.key,
-                like_state=bool(self.args['like_state']))
-            # Mark that the user has now seen this item.
-            self.user.seen_item_ids.append(self.item.key.id())
-            entities_to_update.append(self.user)
-        entities_to_update.append(item_like_state)
-        ndb.put_multi_async(entities_to_update)
+        like_count_deltas = _upsert_like_states(
+            self.user, [(self.item.key, bool(self.args['like_state']))])
+        # The like counts are outside the user's entity group. They are only
+        # used to rank items, so they are simply updated after the fact.
+        like_counter.increment(like_count_deltas)
         self.populate_success_response()
 
 
+class PostBatch(base.BaseHandler):
+    """Record many like/dislike decisions of the user in one request.
+
+    The 'likes' argument is a list of {'item_id': ..., 'like_state': ...}
+    dictionaries. The response has one result per decision, in the same
+    order, each of which is either a success or an error.
+    """
+    @ndb.toplevel
+    def post(self):
+        success = self.parse_request(
+            {'likes': (list, True,
+                       lambda x: 0 < len(x) <= constants.MAX_LIKES_PER_BATCH)})
+        # We need to do some more processing to validate each decision.
+        likes = []
+        if success:
+            try:
+                for like in self.args['likes']:
+                    if set(like.keys()) != set(['item_id', 'like_state']):
+                        raise ValueError()
+                    like_state = int(like['like_state'])
+                    if like_state not in (0, 1):
+                        raise ValueError()
+                    likes.append((long(like['item_id']), bool(like_state)))
+            except (AttributeError, TypeError, ValueError):
+                success = False
+        if not success:
+            self.populate_error_response(error_codes.MALFORMED_REQUEST)
+            return
+
+        if not self.populate_user():
+            return
+
+        # Validate all the items at once.
+        items = ndb.get_multi([ndb.Key(models.Item, item_id)
+                               for item_id, _ in likes])
+        results = []
+        valid_likes = []
+        for (item_id, like_state), item in zip(likes, items):
+            if not item or item.deleted:
+                result = base.error_dict(error_codes.INVALID_ITEM)
+            else:
+                result = {'status': httplib.OK}
+                valid_likes.append((item.key, like_state))
+            result['item_id'] = item_id
+            results.append(result)
+
+        if valid_likes:
+            like_counter.increment(
+                _upsert_like_states(self.user, valid_likes))
+        self.populate_success_response({'results': results})
+
+
+class FoldLikeCounts(base.BaseHandler):
+    """Store the changed like counts of items in their search documents.
+
+    This runs from cron, and continues as a chain of push tasks for as long
+    as there are more changed counts than fit in one batch.
+    """
+    def get(self):
+        self.post()
+
+    @ndb.toplevel
+    def post(self):
+        item_ids, more = like_counter.get_dirty_item_ids(
+            constants.MAX_DOCUMENTS_PER_PUT)
+        counts, shards = like_counter.read(item_ids)
+
+        items = ndb.get_multi([ndb.Key(models.Item, item_id)
+                               for item_id in item_ids])
+        try:
+            # Group the documents by the regional index that they are in.
+            documents = collections.defaultdict(list)
+            unindexed_keys = []
+            for item_id, item in zip(item_ids, items):
+                if not item:
+                    continue
+                # The document is gone if the item was deleted, or not there
+                # yet if it is still in the index outbox.
+                cell, document = item_search.find_document(item)
+                if not document:
+                    unindexed_keys.append(item.key)
+                    continue
+                documents[cell].append(item_search.with_like_count(
+                    document, counts[item_id]))
+            for cell, cell_documents in documents.iteritems():
+                item_search.get_index(cell).put(cell_documents)
+
+            # The items may have been deleted while their documents were
+            # being rewritten, in which case the documents are deleted again.
+            folded = [(cell, document)
+                      for cell, cell_documents in documents.iteritems()
+                      for document in cell_documents]
+            items = ndb.get_multi(
+                [ndb.Key(models.Item, long(document.doc_id))
+                 for _, document in folded],
+                use_cache=False, use_memcache=False)
+            for (cell, document), item in zip(folded, items):
+                if not item or item.deleted:
+                    item_search.get_index(cell).delete(document.doc_id)
+        except search.Error as e:
+            logging.error('Like count fold failed. Message: {}'.format(
+                e.message))
+            raise
+
+        # The counts of items that are waiting to be indexed stay dirty, so
+        # that they are folded once the documents exist, in case the drain
+        # read them before the latest likes.
+        pending_ids = set(
+            p.key.parent().id() for p in ndb.get_multi(
+                [models.PendingDocument.key_for(item_key)
+                 for item_key in unindexed_keys]) if p)
+        folded_shards = [shard for shard in shards
+                         if shard.item_id not in pending_ids]
+        like_counter.mark_clean(folded_shards)
+
+        # Only continue if this made progress, rather than spinning on
+        # items that are waiting to be indexed.
+        if more and len(pending_ids) < len(item_ids):
+            task_utils.add_task(self.request.path)
+        self.populate_success_response()
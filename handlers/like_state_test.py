@@ -1,8 +1,13 @@
+from google.appengine.api import search
 from google.appengine.ext import ndb
 import httplib
 from webapp2_extras import json
 
+import constants
+import item_search
+import like_counter
 import models
+import seen_items
 import test_utils
 
 
@@ -12,16 +17,15 @@ class PostTest(test_utils.HandlerTest):
 
         # Set up an item not owned by the user.
         item = models.Item(
-            user_key=ndb.Key(models.User, self.user_key.id() + 1))
+            user_key=models.User.key_for('facebook', '2'))
         self.item_key = item.put()
 
     def get_like_state(self):
-        query = models.LikeState.query(
-            models.LikeState.item_key == self.item_key)
-        return query.filter(models.LikeState.user_key == self.user.key).get()
+        return models.LikeState.key_for(self.user_key,
+                                        self.item_key.id()).get()
 
     def test_add_like(self):
-        self.assertListEqual([], self.user.seen_item_ids)
+        self.assertListEqual([], self.get_seen_item_ids(self.user_key))
 
         response = self.app.post(
             '/item/like',
@@ -32,13 +36,12 @@ class PostTest(test_utils.HandlerTest):
         like_state = self.get_like_state()
         self.assertIsNotNone(like_state)
         self.assertTrue(like_state.like_state)
-        # Refetch the user to make sure we have a fresh state, and ensure
-        # that the item id was added to the seen items list.
-        self.user = self.user_key.get()
-        self.assertListEqual([self.item_key.id()], self.user.seen_item_ids)
+        # Ensure that the item id was added to the seen items.
+        self.assertListEqual([self.item_key.id()],
+                             self.get_seen_item_ids(self.user_key))
 
     def test_add_dislike(self):
-        self.assertListEqual([], self.user.seen_item_ids)
+        self.assertListEqual([], self.get_seen_item_ids(self.user_key))
 
         response = self.app.post(
             '/item/like',
@@ -49,13 +52,12 @@ class PostTest(test_utils.HandlerTest):
         like_state = self.get_like_state()
         self.assertIsNotNone(like_state)
         self.assertFalse(like_state.like_state)
-        # Refetch the user to make sure we have a fresh state, and ensure
-        # that the item id was added to the seen items list.
-        self.user = self.user_key.get()
-        self.assertListEqual([self.item_key.id()], self.user.seen_item_ids)
+        # Ensure that the item id was added to the seen items.
+        self.assertListEqual([self.item_key.id()],
+                             self.get_seen_item_ids(self.user_key))
 
     def test_update(self):
-        self.assertListEqual([], self.user.seen_item_ids)
+        self.assertListEqual([], self.get_seen_item_ids(self.user_key))
 
         response = self.app.post(
             '/item/like',
@@ -67,10 +69,9 @@ class PostTest(test_utils.HandlerTest):
         self.assertIsNotNone(like_state)
         self.assertTrue(like_state.like_state)
 
-        # Refetch the user to make sure we have a fresh state, and ensure
-        # that the item id was added to the seen items list.
-        self.user = self.user_key.get()
-        self.assertListEqual([self.item_key.id()], self.user.seen_item_ids)
+        # Ensure that the item id was added to the seen items.
+        self.assertListEqual([self.item_key.id()],
+                             self.get_seen_item_ids(self.user_key))
 
         response = self.app.post(
             '/item/like',
@@ -81,7 +82,239 @@ class PostTest(test_utils.HandlerTest):
         like_state = self.get_like_state()
         self.assertIsNotNone(like_state)
         self.assertFalse(like_state.like_state)
-        # Refetch the user to make sure we have a fresh state, and ensure
-        # that the list is still the same.
-        self.user = self.user_key.get()
-        self.assertListEqual([self.item_key.id()], self.user.seen_item_ids)
\ No newline at end of file
+        # Ensure that the seen items are still the same.
+        self.assertListEqual([self.item_key.id()],
+                             self.get_seen_item_ids(self.user_key))
+        # There should only ever be one like state for the pair.
+        self.assertEqual(1, len(models.LikeState.query().fetch(
+            keys_only=True)))
+
+    def test_legacy_seen_item_ids_are_migrated(self):
+        # A user whose seen items were stored in the deprecated list, with
+        # ids other than the liked item's.
+        legacy_ids = [self.item_key.id() + 1, self.item_key.id() + 2]
+        self.user.seen_item_ids = legacy_ids
+        self.user.put()
+        self.assertListEqual(legacy_ids,
+                             self.get_seen_item_ids(self.user_key))
+
+        response = self.app.post(
+            '/item/like',
+            params=json.encode({'item_id': self.item_key.id(),
+                                'like_state': 1}),
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        self.assertListEqual(sorted(legacy_ids + [self.item_key.id()]),
+                             self.get_seen_item_ids(self.user_key))
+        self.assertListEqual([], self.user_key.get().seen_item_ids)
+
+    def test_legacy_migration_keeps_user_changes(self):
+        self.user.seen_item_ids = [self.item_key.id() + 1]
+        self.user.put()
+        stale_user = self.user_key.get()
+        user = self.user_key.get(use_cache=False)
+        user.name = 'changed_name'
+        user.put()
+
+        seen_items.add(stale_user, [self.item_key.id()])
+        user = self.user_key.get(use_cache=False)
+        self.assertEqual('changed_name', user.name)
+        self.assertListEqual([], user.seen_item_ids)
+
+    def test_seen_items_are_sharded(self):
+        orig_max_seen_items_per_shard = constants.MAX_SEEN_ITEMS_PER_SHARD
+        constants.MAX_SEEN_ITEMS_PER_SHARD = 2
+        try:
+            self.assertListEqual([3, 1, 2],
+                                 seen_items.add(self.user, [3, 1, 2]))
+            self.assertListEqual([4], seen_items.add(self.user, [4, 2]))
+            self.assertListEqual([5], seen_items.add(self.user, [5]))
+            first_shard = ndb.Key(models.SeenItems, 1,
+                                  parent=self.user_key).get()
+            self.assertEqual(3, first_shard.num_shards)
+            self.assertListEqual([1, 2, 3, 4, 5],
+                                 self.get_seen_item_ids(self.user_key))
+
+            self.assertTrue(seen_items.remove(self.user, 3))
+            self.assertFalse(seen_items.remove(self.user, 3))
+            self.assertListEqual([1, 2, 4, 5],
+                                 self.get_seen_item_ids(self.user_key))
+        finally:
+            constants.MAX_SEEN_ITEMS_PER_SHARD = orig_max_seen_items_per_shard
+
+
+class PostBatchTest(test_utils.HandlerTest):
+    def setUp(self):
+        super(PostBatchTest, self).setUp()
+
+        # Set up some items not owned by the user.
+        other_user_key = models.User.key_for('facebook', '2')
+        self.item_keys = [models.Item(user_key=other_user_key).put()
+                          for _ in range(3)]
+
+    def post_batch(self, likes):
+        return self.app.post(
+            '/item/like/batch',
+            params=json.encode({'likes': likes}),
+            headers=self.headers_for_user(self.user.third_party_id),
+            expect_errors=True)
+
+    def test_batch(self):
+        # Start with an existing dislike, which should be updated.
+        self.create_like_state(self.user_key, self.item_keys[0], False)
+        seen_items.add(self.user, [self.item_keys[0].id()])
+
+        response = self.post_batch(
+            [{'item_id': self.item_keys[0].id(), 'like_state': 1},
+             {'item_id': self.item_keys[1].id(), 'like_state': 0},
+             {'item_id': self.item_keys[2].id(), 'like_state': 1}])
+        self.assertEqual(httplib.OK, response.status_int)
+        results = json.decode(response.body)['results']
+        self.assertListEqual(
+            [{'item_id': item_key.id(), 'status': httplib.OK}
+             for item_key in self.item_keys], results)
+
+        like_states = [models.LikeState.key_for(self.user_key,
+                                                item_key.id()).get()
+                       for item_key in self.item_keys]
+        self.assertListEqual([True, False, True],
+                             [l.like_state for l in like_states])
+        self.assertEqual(3, len(models.LikeState.query().fetch(
+            keys_only=True)))
+        self.assertListEqual(sorted(k.id() for k in self.item_keys),
+                             self.get_seen_item_ids(self.user_key))
+
+    def test_invalid_items_fail_individually(self):
+        deleted_item = self.item_keys[1].get()
+        deleted_item.deleted = True
+        deleted_item.put()
+        missing_item_id = self.item_keys[2].id() + 1
+
+        response = self.post_batch(
+            [{'item_id': self.item_keys[0].id(), 'like_state': 1},
+             {'item_id': self.item_keys[1].id(), 'like_state': 1},
+             {'item_id': missing_item_id, 'like_state': 0}])
+        self.assertEqual(httplib.OK, response.status_int)
+        results = json.decode(response.body)['results']
+        self.assertListEqual(
+            [self.item_keys[0].id(), self.item_keys[1].id(), missing_item_id],
+            [r['item_id'] for r in results])
+        self.assertListEqual([httplib.OK, httplib.BAD_REQUEST,
+                              httplib.BAD_REQUEST],
+                             [r['status'] for r in results])
+        self.assertEqual('InvalidItem', results[1]['error']['status'])
+        self.assertEqual('InvalidItem', results[2]['error']['status'])
+
+        # Only the valid decision is recorded.
+        self.assertEqual(1, len(models.LikeState.query().fetch(
+            keys_only=True)))
+        self.assertListEqual([self.item_keys[0].id()],
+                             self.get_seen_item_ids(self.user_key))
+
+    def test_malformed(self):
+        for likes in [[],
+                      [{'item_id': self.item_keys[0].id()}],
+                      [{'item_id': self.item_keys[0].id(), 'like_state': 2}],
+                      [{'item_id': 'abc', 'like_state': 1}],
+                      [self.item_keys[0].id()],
+                      [{'item_id': self.item_keys[0].id(), 'like_state': 1}] *
+                      (constants.MAX_LIKES_PER_BATCH + 1)]:
+            response = self.post_batch(likes)
+            self.assertEqual(httplib.BAD_REQUEST, response.status_int)
+        self.assertEqual(0, len(models.LikeState.query().fetch(
+            keys_only=True)))
+
+    def test_duplicate_items(self):
+        item_id = self.item_keys[0].id()
+        response = self.post_batch([{'item_id': item_id, 'like_state': 1},
+                                    {'item_id': item_id, 'like_state': 0},
+                                    {'item_id': item_id, 'like_state': 1}])
+        self.assertEqual(httplib.OK, response.status_int)
+        self.assertTrue(models.LikeState.key_for(self.user_key,
+                                                 item_id).get().like_state)
+        # Every decision counts, not just the last one.
+        counts, _ = like_counter.read([item_id])
+        self.assertEqual(1, counts[item_id])
+
+        response = self.post_batch([{'item_id': item_id, 'like_state': 0},
+                                    {'item_id': item_id, 'like_state': 1},
+                                    {'item_id': item_id, 'like_state': 0}])
+        self.assertEqual(httplib.OK, response.status_int)
+        counts, _ = like_counter.read([item_id])
+        self.assertEqual(0, counts[item_id])
+
+
+class LikeCountTest(test_utils.HandlerTest):
+    def setUp(self):
+        super(LikeCountTest, self).setUp()
+
+        # An indexed item not owned by the user.
+        self.item_key = models.Item(
+            user_key=models.User.key_for('facebook', '2')).put()
+        item_search.get_index().put(search.Document(
+            doc_id=str(self.item_key.id()),
+            fields=[search.NumberField(name=item_search.LIKE_COUNT_FIELD,
+                                       value=0)]))
+        self.second_user = self.create_user('2')
+
+    def like(self, user, like_state):
+        response = self.app.post(
+            '/item/like',
+            params=json.encode({'item_id': self.item_key.id(),
+                                'like_state': like_state}),
+            headers=self.headers_for_user(user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+
+    def get_like_count(self):
+        counts, _ = like_counter.read([self.item_key.id()])
+        return counts[self.item_key.id()]
+
+    def test_likes_are_counted(self):
+        self.like(self.user, 1)
+        self.like(self.second_user, 0)
+        self.assertEqual(1, self.get_like_count())
+        # Liking again doesn't count twice.
+        self.like(self.user, 1)
+        self.assertEqual(1, self.get_like_count())
+        # Changing a like state moves the count both ways.
+        self.like(self.second_user, 1)
+        self.assertEqual(2, self.get_like_count())
+        self.like(self.user, 0)
+        self.assertEqual(1, self.get_like_count())
+
+    def test_fold(self):
+        self.like(self.user, 1)
+        self.like(self.second_user, 1)
+
+        response = self.app.get('/admin/tasks/fold_like_counts')
+        self.assertEqual(httplib.OK, response.status_int)
+        document = item_search.get_index().get(str(self.item_key.id()))
+        self.assertEqual(2, document.field(item_search.LIKE_COUNT_FIELD).value)
+        self.assertEqual(0, len(models.LikeCounterShard.query(
+            models.LikeCounterShard.dirty == True).fetch()))
+
+        # A count that changes after it was read stays dirty.
+        _, shards = like_counter.read([self.item_key.id()])
+        self.like(self.user, 0)
+        like_counter.mark_clean(shards)
+        self.assertListEqual([self.item_key.id()],
+                             like_counter.get_dirty_item_ids(10)[0])
+
+        # So does one that another fold cleaned in the meantime.
+        _, shards = like_counter.read([self.item_key.id()])
+        self.like(self.user, 1)
+        self.app.get('/admin/tasks/fold_like_counts')
+        like_counter.mark_clean(shards)
+        self.assertListEqual([self.item_key.id()],
+                             like_counter.get_dirty_item_ids(10)[0])
+
+    def test_fold_deleted_item(self):
+        self.like(self.user, 1)
+        item = self.item_key.get()
+        item.deleted = True
+        item.put()
+
+        response = self.app.get('/admin/tasks/fold_like_counts')
+        self.assertEqual(httplib.OK, response.status_int)
+        self.assertIsNone(
+            item_search.get_index().get(str(self.item_key.id())))
@@ -0,0 +1,359 @@
+import collections
+import datetime
+import logging
+
+from google.appengine.api import search
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import base
+import chat_messages
+import constants
+import error_codes
+import item_search
+import models
+import task_utils
+
+# Migrations and backfills are run as chains of push tasks. Each task
+# processes one batch and enqueues the next one with the position it stopped
+# at, so an interrupted migration can be resumed by POSTing the last logged
+# position. Every step is idempotent, so re-running a batch is harmless.
+
+
+def _rekey_search_documents(items, user_id):
+    """Point the user_id field of the items' search documents to user_id."""
+    documents = collections.defaultdict(list)
+    for item in items:
+        cell, document = item_search.find_document(item)
+        if not document:
+            continue
+        fields = [f for f in document.fields if f.name != 'user_id']
+        fields.append(search.AtomField(name='user_id', value=str(user_id)))
+        documents[cell].append(search.Document(doc_id=document.doc_id,
+                                               fields=fields))
+    for cell, cell_documents in documents.iteritems():
+        index = item_search.get_index(cell)
+        for i in range(0, len(cell_documents),
+                       constants.MAX_DOCUMENTS_PER_PUT):
+            index.put(cell_documents[i:i + constants.MAX_DOCUMENTS_PER_PUT])
+
+
+def _rekey_user(old_user):
+    """Move a user stored under an allocated id to its login-derived key.
+
+    All the references to the old key are rewritten before the old user is
+    deleted, so a failure at any point leaves the old user in place to be
+    picked up again.
+    """
+    old_key = old_user.key
+    new_key = models.User.key_for(old_user.login_type, old_user.third_party_id)
+
+    # The user might have authenticated since the deploy, which creates a
+    # fresh entity under the new key. In that case, merge the two.
+    new_user = new_key.get()
+    if new_user:
+        new_user.seen_item_ids = sorted(
+            set(new_user.seen_item_ids) | set(old_user.seen_item_ids))
+        new_user.ongoing_conversations = sorted(
+            set(new_user.ongoing_conversations) |
+            set(old_user.ongoing_conversations))
+        new_user.conversation_keys = sorted(
+            set(new_user.conversation_keys) |
+            set(old_user.conversation_keys))
+    else:
+        new_user = models.User(key=new_key, **old_user.to_dict())
+    new_user.put()
+
+    items = models.Item.query(models.Item.user_key == old_key).fetch()
+    for item in items:
+        item.user_key = new_key
+    ndb.put_multi(items)
+    _rekey_search_documents(items, new_key.id())
+
+    like_states = models.LikeState.query(
+        models.LikeState.user_key == old_key).fetch()
+    for like_state in like_states:
+        like_state.user_key = new_key
+    ndb.put_multi(like_states)
+
+    # Both participants of a conversation keep it in their list, so this
+    # reaches every conversation the user sent messages in.
+    conversations = ndb.get_multi(
+        [ndb.Key(models.Conversation, c)
+         for c in old_user.ongoing_conversations])
+    conversations = [c for c in conversations if c]
+    messages = []
+    for conversation in conversations:
+        if conversation.buyer_key == old_key:
+            conversation.buyer_key = new_key
+        for message in conversation.legacy_messages:
+            if message.user_key == old_key:
+                message.user_key = new_key
+        for message in models.Message.query(ancestor=conversation.key):
+            if message.user_key == old_key:
+                message.user_key = new_key
+                messages.append(message)
+    ndb.put_multi(conversations + messages)
+
+    old_key.delete()
+
+
+class MigrateUserKeys(base.BaseHandler):
+    """Re-key users that were stored under datastore-allocated ids."""
+    @ndb.toplevel
+    def post(self):
+        success = self.parse_request({'cursor': (str, False, None)})
+        if not success:
+            self.populate_error_response(error_codes.MALFORMED_REQUEST)
+            return
+
+        cursor = None
+        if 'cursor' in self.args:
+            cursor = Cursor(urlsafe=self.args['cursor'])
+
+        users, cursor, more = models.User.query().fetch_page(
+            constants.NUM_ENTITIES_PER_MIGRATION_BATCH, start_cursor=cursor)
+        for user in users:
+            # Users that are already keyed by their login have string ids.
+            if isinstance(user.key.id(), basestring):
+                continue
+            _rekey_user(user)
+
+        if more and cursor:
+            logging.info('User key migration continues at cursor={}'.format(
+                cursor.urlsafe()))
+            task_utils.add_task(self.request.path,
+                                {'cursor': cursor.urlsafe()})
+        self.populate_success_response()
+
+
+class MigrateLikeStateKeys(base.BaseHandler):
+    """Move like states under their users, keyed by the item id.
+
+    This must run after MigrateUserKeys, since the new keys are children of
+    the users' keys.
+    """
+    @ndb.toplevel
+    def post(self):
+        success = self.parse_request({'cursor': (str, False, None)})
+        if not success:
+            self.populate_error_response(error_codes.MALFORMED_REQUEST)
+            return
+
+        cursor = None
+        if 'cursor' in self.args:
+            cursor = Cursor(urlsafe=self.args['cursor'])
+
+        # Duplicates that end up in different batches are merged into the
+        # keyed like state that the first batch stored.
+        like_states, cursor, more = models.LikeState.query().fetch_page(
+            constants.NUM_ENTITIES_PER_MIGRATION_BATCH, start_cursor=cursor)
+        pairs = {}
+        for like_state in like_states:
+            if like_state.key.parent():
+                continue
+            pairs.setdefault((like_state.user_key, like_state.item_key),
+                             []).append(like_state)
+        for old_like_states in pairs.itervalues():
+            _rekey_like_state(old_like_states)
+
+        if more and cursor:
+            logging.info(
+                'Like state key migration continues at cursor={}'.format(
+                    cursor.urlsafe()))
+            task_utils.add_task(self.request.path,
+                                {'cursor': cursor.urlsafe()})
+        self.populate_success_response()
+
+
+@ndb.transactional
+def _migrate_conversation_messages(conversation_key):
+    """Move the messages of a conversation into child entities."""
+    conversation = conversation_key.get()
+    messages = chat_messages.migrate(conversation)
+    if messages:
+        ndb.put_multi([conversation] + messages)
+
+
+class MigrateConversationMessages(base.BaseHandler):
+    """Move the messages stored inside conversations into child entities."""
+    @ndb.toplevel
+    def post(self):
+        success = self.parse_request({'cursor': (str, False, None)})
+        if not success:
+            self.populate_error_response(error_codes.MALFORMED_REQUEST)
+            return
+
+        cursor = None
+        if 'cursor' in self.args:
+            cursor = Cursor(urlsafe=self.args['cursor'])
+
+        conversations, cursor, more = models.Conversation.query().fetch_page(
+            constants.NUM_ENTITIES_PER_MIGRATION_BATCH, start_cursor=cursor)
+        for conversation in conversations:
+            if conversation.legacy_messages:
+                _migrate_conversation_messages(conversation.key)
+
+        if more and cursor:
+            logging.info(
+                'Conversation message migration continues at cursor={}'.format(
+                    cursor.urlsafe()))
+            task_utils.add_task(self.request.path,
+                                {'cursor': cursor.urlsafe()})
+        self.populate_success_response()
+
+
+@ndb.transactional(xg=True)
+def _rekey_conversation(old_key):
+    """Move a conversation stored under an allocated id to its derived key.
+
+    If a conversation already exists under the new key, which happens when
+    two first messages raced, the two are merged, with the messages ordered
+    by the time they were sent.
+    """
+    old_conversation = old_key.get()
+    if not old_conversation:
+        return
+    new_key = models.Conversation.key_for(old_conversation.item_key,
+                                          old_conversation.buyer_key)
+    new_conversation = new_key.get()
+    messages = chat_messages.get_all(old_conversation)
+    old_message_keys = [m.key for m in messages if m.key]
+    if new_conversation:
+        messages.extend(chat_messages.get_all(new_conversation))
+    else:
+        new_conversation = models.Conversation(
+            key=new_key,
+            item_key=old_conversation.item_key,
+            buyer_key=old_conversation.buyer_key)
+    messages.sort(key=lambda m: m.create_date)
+
+    # Rewrite all the messages in their new positions.
+    new_conversation.legacy_messages = []
+    new_conversation.message_count = 0
+    new_messages = []
+    for message in messages:
+        new_messages.extend(chat_messages.append(
+            new_conversation,
+            models.Message(user_key=message.user_key,
+                           user_name=message.user_name,
+                           message=message.message,
+                           create_date=message.create_date)))
+
+    # Both participants keep the conversation in their lists.
+    item = old_conversation.item_key.get()
+    user_keys = [old_conversation.buyer_key]
+    if item:
+        user_keys.append(item.user_key)
+    users = [user for user in ndb.get_multi(user_keys) if user]
+    for user in users:
+        if old_key.id() in user.ongoing_conversations:
+            user.ongoing_conversations.remove(old_key.id())
+        if new_key not in user.conversation_keys:
+            user.conversation_keys.append(new_key)
+
+    ndb.put_multi([new_conversation] + new_messages + users)
+    ndb.delete_multi(old_message_keys + [old_key])
+
+
+class MigrateConversationKeys(base.BaseHandler):
+    """Re-key conversations by their item and buyer.
+
+    This must run after MigrateUserKeys, since the new keys are derived from
+    the buyers' keys.
+    """
+    @ndb.toplevel
+    def post(self):
+        success = self.parse_request({'cursor': (str, False, None)})
+        if not success:
+            self.populate_error_response(error_codes.MALFORMED_REQUEST)
+            return
+
+        cursor = None
+        if 'cursor' in self.args:
+            cursor = Cursor(urlsafe=self.args['cursor'])
+
+        conversation_keys, cursor, more = \
+            models.Conversation.query().fetch_page(
+                constants.NUM_ENTITIES_PER_MIGRATION_BATCH,
+                start_cursor=cursor, keys_only=True)
+        for conversation_key in conversation_keys:
+            # Conversations that are already keyed by their participants have
+            # string ids.
+            if isinstance(conversation_key.id(), basestring):
+                continue
+            _rekey_conversation(conversation_key)
+
+        if more and cursor:
+            logging.info(
+                'Conversation key migration continues at cursor={}'.format(
+                    cursor.urlsafe()))
+            task_utils.add_task(self.request.path,
+                                {'cursor': cursor.urlsafe()})
+        self.populate_success_response()
+
+
+class SplitIndexRegion(base.BaseHandler):
+    """Split the search index of a geohash cell into its subcells' indexes.
+
+    New documents in the cell go to its subcells as soon as the split is
+    recorded. The cell's own documents are then moved over in batches, and
+    the cell stops being searched once they are all gone. The original index
+    is the cell '', and splitting it moves the documents of the items that
+    were posted before items were split by region. See item_search.py.
+    """
+    @ndb.toplevel
+    def post(self):
+        success = self.parse_request({'cell': (str, False, None)})
+        if not success:
+            self.populate_error_response(error_codes.MALFORMED_REQUEST)
+            return
+
+        cell = self.args.get('cell', '')
+        route = item_search.split(cell)
+        routes = item_search.get_routes(fresh=True)
+        index = item_search.get_index(cell)
+        documents = index.get_range(
+            limit=constants.MAX_DOCUMENTS_PER_PUT).results
+
+        if documents:
+            items = ndb.get_multi([ndb.Key(models.Item, long(d.doc_id))
+                                   for d in documents])
+            moved_documents = collections.defaultdict(list)
+            updated_items = []
+            for document, item in zip(documents, items):
+                location = document['location']
+                if not location:
+                    # The document can't be found by any search anyway.
+                    logging.warning('Dropping document without a location, '
+                                    'doc_id={}'.format(document.doc_id))
+                    continue
+                lat = location[0].value.latitude
+                lng = location[0].value.longitude
+                new_cell = item_search.get_cells_for_point(lat, lng,
+                                                           routes)[0]
+                moved_documents[new_cell].append(document)
+                # Record where legacy items are, so that their documents can
+                # be found once they are moved.
+                if item and not item.location:
+                    item.location = ndb.GeoPt(lat, lng)
+                    updated_items.append(item)
+            ndb.put_multi(updated_items)
+            for new_cell, cell_documents in moved_documents.iteritems():
+                item_search.get_index(new_cell).put(cell_documents)
+            index.delete([d.doc_id for d in documents])
+            logging.info('Index region split continues for cell={}'.format(
+                cell))
+            task_utils.add_task(self.request.path, {'cell': cell})
+        else:
+            # Instances may keep storing new documents in the cell until
+            # their cached routes expire, so check again after that.
+            wait = (constants.INDEX_ROUTE_CACHE_TTL_SECONDS -
+                    (datetime.datetime.utcnow() -
+                     route.split_date).total_seconds())
+            if wait >= 0:
+                task_utils.add_task(self.request.path, {'cell': cell},
+                                    countdown=wait + 1)
+            else:
+                item_search.mark_moved(cell)
+        self.populate_success_response()
@@ -0,0 +1,347 @@
+import datetime
+from google.appengine.api import search
+from google.appengine.ext import ndb
+import httplib
+from webapp2_extras import json
+
+import chat_messages
+import constants
+import item_search
+import models
+import test_utils
+
+
+class MigrateUserKeysTest(test_utils.HandlerTest):
+    def setUp(self):
+        super(MigrateUserKeysTest, self).setUp()
+
+        # A user that was stored under an allocated id.
+        self.legacy_user = models.User(login_type='facebook',
+                                       third_party_id='2',
+                                       name='legacy_name')
+        self.legacy_user.put()
+        legacy_key = self.legacy_user.key
+
+        # An item owned by the legacy user, along with its search document.
+        self.item = models.Item(user_key=legacy_key)
+        self.item.put()
+        search.Index(name=constants.ITEM_INDEX_NAME).put(
+            search.Document(
+                doc_id=str(self.item.key.id()),
+                fields=[search.AtomField(name='user_id',
+                                         value=str(legacy_key.id()))]))
+
+        # An item owned by the test user, which the legacy user liked and is
+        # chatting about.
+        self.other_item = models.Item(user_key=self.user_key)
+        self.other_item.put()
+        self.like_state = models.LikeState(user_key=legacy_key,
+                                           item_key=self.other_item.key,
+                                           like_state=True)
+        self.like_state.put()
+        self.conversation = models.Conversation(
+            item_key=self.other_item.key,
+            buyer_key=legacy_key,
+            legacy_messages=[models.Message(user_key=legacy_key,
+                                            user_name='legacy_name',
+                                            message='hello'),
+                             models.Message(user_key=self.user_key,
+                                            user_name='test_name',
+                                            message='hi')])
+        self.conversation.put()
+        self.legacy_user.seen_item_ids = [self.other_item.key.id()]
+        self.legacy_user.ongoing_conversations = [self.conversation.key.id()]
+        self.legacy_user.put()
+
+    def migrate(self):
+        response = self.app.post(
+            '/admin/migrate/user_keys',
+            params=json.encode({}),
+            headers={'Content-Type': 'application/json'})
+        self.assertEqual(httplib.OK, response.status_int)
+        self.run_tasks()
+
+    def check_migrated(self):
+        new_key = models.User.key_for('facebook', '2')
+        self.assertIsNone(self.legacy_user.key.get())
+        user = new_key.get()
+        self.assertIsNotNone(user)
+        self.assertEqual('legacy_name', user.name)
+        self.assertListEqual([self.other_item.key.id()], user.seen_item_ids)
+        self.assertListEqual([self.conversation.key.id()],
+                             user.ongoing_conversations)
+
+        self.assertEqual(new_key, self.item.key.get().user_key)
+        document = search.Index(name=constants.ITEM_INDEX_NAME).get(
+            str(self.item.key.id()))
+        self.assertEqual(new_key.id(), document.field('user_id').value)
+        self.assertEqual(new_key, self.like_state.key.get().user_key)
+
+        conversation = self.conversation.key.get()
+        self.assertEqual(new_key, conversation.buyer_key)
+        self.assertEqual(new_key, conversation.legacy_messages[0].user_key)
+        self.assertEqual(self.user_key,
+                         conversation.legacy_messages[1].user_key)
+
+        # The test user was already keyed properly and should be untouched.
+        self.assertIsNotNone(self.user_key.get())
+
+    def test_migrate(self):
+        self.migrate()
+        self.check_migrated()
+
+    def test_migrate_is_idempotent(self):
+        self.migrate()
+        self.migrate()
+        self.check_migrated()
+
+    def test_migrate_merges_with_new_user(self):
+        # The user authenticated after the deploy, before being migrated.
+        self.create_user('2', name='legacy_name')
+        self.migrate()
+        self.check_migrated()
+
+    def test_migrate_in_batches(self):
+        orig_batch_size = constants.NUM_ENTITIES_PER_MIGRATION_BATCH
+        constants.NUM_ENTITIES_PER_MIGRATION_BATCH = 1
+        try:
+            self.migrate()
+        finally:
+            constants.NUM_ENTITIES_PER_MIGRATION_BATCH = orig_batch_size
+        self.check_migrated()
+
+
+class MigrateLikeStateKeysTest(test_utils.HandlerTest):
+    def test_migrate_deduplicates(self):
+        item_key = models.Item(user_key=self.user_key).put()
+        other_item_key = models.Item(user_key=self.user_key).put()
+        # Duplicate legacy like states, from a client retrying quickly.
+        for like_state in [False, True, False]:
+            models.LikeState(user_key=self.user_key,
+                             item_key=item_key,
+                             like_state=like_state).put()
+        models.LikeState(user_key=self.user_key,
+                         item_key=other_item_key,
+                         like_state=False).put()
+
+        orig_batch_size = constants.NUM_ENTITIES_PER_MIGRATION_BATCH
+        constants.NUM_ENTITIES_PER_MIGRATION_BATCH = 2
+        try:
+            response = self.app.post(
+                '/admin/migrate/like_state_keys',
+                params=json.encode({}),
+                headers={'Content-Type': 'application/json'})
+            self.assertEqual(httplib.OK, response.status_int)
+            self.run_tasks()
+        finally:
+            constants.NUM_ENTITIES_PER_MIGRATION_BATCH = orig_batch_size
+
+        like_states = models.LikeState.query().fetch()
+        self.assertEqual(2, len(like_states))
+        like_state = models.LikeState.key_for(
+            self.user_key, item_key.id()).get()
+        self.assertTrue(like_state.like_state)
+        other_like_state = models.LikeState.key_for(
+            self.user_key, other_item_key.id()).get()
+        self.assertFalse(other_like_state.like_state)
+
+
+class MigrateConversationMessagesTest(test_utils.HandlerTest):
+    def setUp(self):
+        super(MigrateConversationMessagesTest, self).setUp()
+
+        item = models.Item(user_key=models.User.key_for('facebook', '2'))
+        item.put()
+        self.conversation = models.Conversation(
+            item_key=item.key,
+            buyer_key=self.user_key,
+            legacy_messages=[models.Message(user_key=self.user_key,
+                                            user_name='test_name',
+                                            message=str(i))
+                             for i in range(3)])
+        self.conversation.put()
+
+    def migrate(self):
+        response = self.app.post(
+            '/admin/migrate/conversation_messages',
+            params=json.encode({}),
+            headers={'Content-Type': 'application/json'})
+        self.assertEqual(httplib.OK, response.status_int)
+        self.run_tasks()
+
+    def check_migrated(self):
+        conversation = self.conversation.key.get()
+        self.assertListEqual([], conversation.legacy_messages)
+        self.assertEqual(3, conversation.message_count)
+        self.assertEqual('2', conversation.last_message)
+        messages = models.Message.query(ancestor=conversation.key).fetch()
+        self.assertListEqual([1, 2, 3], [m.key.id() for m in messages])
+        self.assertListEqual(['0', '1', '2'], [m.message for m in messages])
+
+    def test_migrate(self):
+        self.migrate()
+        self.check_migrated()
+
+    def test_migrate_is_idempotent(self):
+        self.migrate()
+        self.migrate()
+        self.check_migrated()
+
+
+class MigrateConversationKeysTest(test_utils.HandlerTest):
+    def setUp(self):
+        super(MigrateConversationKeysTest, self).setUp()
+
+        # The test user is chatting with a seller about their item, in a
+        # conversation stored under an allocated id.
+        self.seller = self.create_user('2', name='seller_name')
+        self.item = models.Item(user_key=self.seller.key)
+        self.item.put()
+        self.legacy_conversation = models.Conversation(
+            item_key=self.item.key,
+            buyer_key=self.user_key,
+            legacy_messages=[
+                models.Message(user_key=self.user_key,
+                               user_name='test_name',
+                               message='hello',
+                               create_date=datetime.datetime(2015, 1, 1)),
+                models.Message(user_key=self.seller.key,
+                               user_name='seller_name',
+                               message='hi',
+                               create_date=datetime.datetime(2015, 1, 3))])
+        self.legacy_conversation.put()
+        for user in [self.user, self.seller]:
+            user.ongoing_conversations = [self.legacy_conversation.key.id()]
+            user.put()
+        self.new_key = models.Conversation.key_for(self.item.key,
+                                                   self.user_key)
+
+    def migrate(self):
+        response = self.app.post(
+            '/admin/migrate/conversation_keys',
+            params=json.encode({}),
+            headers={'Content-Type': 'application/json'})
+        self.assertEqual(httplib.OK, response.status_int)
+        self.run_tasks()
+
+    def check_migrated(self, expected_messages):
+        self.assertIsNone(self.legacy_conversation.key.get())
+        conversation = self.new_key.get()
+        self.assertEqual(self.item.key, conversation.item_key)
+        self.assertEqual(self.user_key, conversation.buyer_key)
+        self.assertEqual(len(expected_messages), conversation.message_count)
+        self.assertListEqual(
+            expected_messages,
+            [m.message for m in chat_messages.get_all(conversation)])
+        for user_key in [self.user_key, self.seller.key]:
+            user = user_key.get()
+            self.assertListEqual([], user.ongoing_conversations)
+            self.assertListEqual([self.new_key], user.conversation_keys)
+
+    def test_migrate(self):
+        self.migrate()
+        self.check_migrated(['hello', 'hi'])
+
+    def test_migrate_is_idempotent(self):
+        self.migrate()
+        self.migrate()
+        self.check_migrated(['hello', 'hi'])
+
+    def test_migrate_merges_with_new_conversation(self):
+        # A message was sent since the deploy, which created the conversation
+        # under its new key.
+        self.create_conversation(
+            self.item.key, self.user_key,
+            [models.Message(user_key=self.user_key,
+                            user_name='test_name',
+                            message='still there?',
+                            create_date=datetime.datetime(2015, 1, 2))])
+        self.migrate()
+        self.check_migrated(['hello', 'still there?', 'hi'])
+
+
+class SplitIndexRegionTest(test_utils.HandlerTest):
+    def setUp(self):
+        super(SplitIndexRegionTest, self).setUp()
+        self.orig_route_cache_ttl = constants.INDEX_ROUTE_CACHE_TTL_SECONDS
+        # Don't wait for other instances to pick up the split.
+        constants.INDEX_ROUTE_CACHE_TTL_SECONDS = -1
+
+    def tearDown(self):
+        constants.INDEX_ROUTE_CACHE_TTL_SECONDS = self.orig_route_cache_ttl
+        super(SplitIndexRegionTest, self).tearDown()
+
+    def split(self, cell=None):
+        params = {'cell': cell} if cell is not None else {}
+        response = self.app.post(
+            '/admin/migrate/split_index_region',
+            params=json.encode(params),
+            headers={'Content-Type': 'application/json'})
+        self.assertEqual(httplib.OK, response.status_int)
+        self.run_tasks()
+        item_search.clear_route_cache()
+
+    def test_split_original_index(self):
+        # Items that were indexed before documents were split by region.
+        item_index = search.Index(name=constants.ITEM_INDEX_NAME)
+        locations = [(0, 0), (45, 90)]
+        item_keys = []
+        for lat, lng in locations:
+            item_key = models.Item(user_key=self.user_key).put()
+            item_keys.append(item_key)
+            item_index.put(search.Document(
+                doc_id=str(item_key.id()),
+                fields=[search.GeoField(name='location',
+                                        value=search.GeoPoint(lat, lng))]))
+
+        self.split()
+
+        self.assertEqual(0, len(item_index.get_range().results))
+        self.assertTrue(item_search.get_route('').moved)
+        for item_key, (lat, lng) in zip(item_keys, locations):
+            item = item_key.get()
+            self.assertEqual(ndb.GeoPt(lat, lng), item.location)
+            self.assertIsNotNone(item_search.get_index_for_point(
+                lat, lng).get(str(item_key.id())))
+            self.assertEqual(item_search.get_index_for_point(lat, lng).name,
+                             item_search.get_index(
+                                 item_search.find_document(item)[0]).name)
+
+    def test_split_drops_documents_without_location(self):
+        item_index = search.Index(name=constants.ITEM_INDEX_NAME)
+        item_key = models.Item(user_key=self.user_key).put()
+        item_index.put(search.Document(
+            doc_id=str(item_key.id()),
+            fields=[search.TextField(name='title', value='title')]))
+
+        self.split()
+
+        self.assertEqual(0, len(item_index.get_range().results))
+        self.assertTrue(item_search.get_route('').moved)
+
+    def test_split_region(self):
+        response = self.app.post(
+            '/item/post',
+            params=json.encode({'title': 'title',
+                                'description': 'description',
+                                'price': 10.0,
+                                'currency': 'USD',
+                                'category': 'other',
+                                'lat': 0,
+                                'lng': 0}),
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        item_id = str(json.decode(response.body)['item_id'])
+        self.run_tasks()
+        cell = item_search.get_cells_for_point(0, 0)[0]
+        self.assertEqual(constants.INDEX_REGION_PRECISION, len(cell))
+        self.assertIsNotNone(item_search.get_index(cell).get(item_id))
+
+        self.split(cell)
+
+        self.assertIsNone(item_search.get_index(cell).get(item_id))
+        new_cell = item_search.get_cells_for_point(0, 0)[0]
+        self.assertEqual(constants.INDEX_REGION_PRECISION + 1, len(new_cell))
+        self.assertIsNotNone(item_search.get_index(new_cell).get(item_id))
+        self.assertNotIn(cell, item_search.get_cells_for_circle(0, 0, 10))
+        self.assertIn(new_cell, item_search.get_cells_for_circle(0, 0, 10))
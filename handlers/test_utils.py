@@ -2,8 +2,11 @@ from google.appengine.ext import ndb
 import unittest
 import webtest
 
+import chat_messages
+import item_search
 import main
 import models
+import seen_items
 import user_utils
 
 
@@ -12,7 +15,9 @@ class HandlerTest(unittest.TestCase):
     nosegae_blobstore = True
     nosegae_datastore_v3 = True
     nosegae_images = True
+    nosegae_memcache = True
     nosegae_search = True
+    nosegae_taskqueue = True
 
     app = webtest.TestApp(main.app)
 
@@ -22,12 +27,13 @@ class HandlerTest(unittest.TestCase):
         def mock_get_facebook_user_id(fb_access_token):
             return str(fb_access_token)
         user_utils.get_facebook_user_id = mock_get_facebook_user_id
+        user_utils.clear_token_cache()
+        item_search.clear_route_cache()
 
-        self.user = models.User(login_type='facebook',
-                                third_party_id='1',
-                                name='test_name',
-                                distance_radius_km=10)
-        self.user_key = self.user.put()
+        self.user = self.create_user('1',
+                                     name='test_name',
+                                     distance_radius_km=10)
+        self.user_key = self.user.key
 
     def tearDown(self):
         # Delete all the data.
@@ -43,3 +49,56 @@ class HandlerTest(unittest.TestCase):
             'X-Auth-Token': str(user_id),
             'Content-Type': 'application/json'
         }
+
+    def create_user(self, third_party_id, **kwargs):
+        """Store a Facebook user, keyed the same way as in production."""
+        user = models.User(
+            key=models.User.key_for('facebook', third_party_id),
+            login_type='facebook',
+            third_party_id=third_party_id,
+            **kwargs)
+        user.put()
+        return user
+
+    def create_like_state(self, user_key, item_key, like_state):
+        """Store a user's like state for an item, keyed as in production."""
+        like_state = models.LikeState(
+            key=models.LikeState.key_for(user_key, item_key.id()),
+            user_key=user_key,
+            item_key=item_key,
+            like_state=like_state)
+        like_state.put()
+        return like_state
+
+    def create_conversation(self, item_key, buyer_key, messages):
+        """Store a conversation along with its messages.
+
+        Returns:
+          The key of the conversation.
+        """
+        conversation = models.Conversation(
+            key=models.Conversation.key_for(item_key, buyer_key),
+            item_key=item_key,
+            buyer_key=buyer_key)
+        for message in messages:
+            chat_messages.append(conversation, message)
+        ndb.put_multi([conversation] + messages)
+        return conversation.key
+
+    def get_seen_item_ids(self, user_key):
+        """Return the sorted ids of the items that a user has seen."""
+        return sorted(seen_items.get(user_key.get()))
+
+    def run_tasks(self):
+        """Run all the queued push tasks, until no more are enqueued."""
+        taskqueue_stub = self.testbed.get_stub('taskqueue')
+        tasks = taskqueue_stub.get_filtered_tasks()
+        while tasks:
+            # Tasks on the default queue have no queue_name.
+            for queue_name in set(task.queue_name or 'default'
+                                  for task in tasks):
+                taskqueue_stub.FlushQueue(queue_name)
+            for task in tasks:
+                self.app.post(task.url, task.payload,
+                              headers={'Content-Type': 'application/json'})
+            tasks = taskqueue_stub.get_filtered_tasks()
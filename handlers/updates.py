@@ -1,15 +1,54 @@
 import datetime
+import httplib
 from google.appengine.ext import ndb
 
 import base
+import chat_messages
 import constants
 import error_codes
+import inbox
+import item_deletion
 import models
+import notifier
+import seen_items
+import stats
+import update_versions
 
 _EPOCH_START = datetime.datetime(1970, 1, 1)
 
 
+def _message_dict(item_id, message):
+    timestamp = (message.create_date - _EPOCH_START).total_seconds()
+    return {'user_name': message.user_name,
+            'message': message.message,
+            'item_id': item_id,
+            'date_sent': str(message.create_date),
+            'timestamp': timestamp}
+
+
+def _etag(version):
+    return str(version)
+
+
 class List(base.BaseHandler):
+    """Return what changed for the user since their last check-in.
+
+    Clients pass the cursor returned by their previous check-in, and get the
+    events of their inbox that came after it, along with a new cursor. Clients
+    that don't pass a cursor get the messages since the user's last activity
+    instead, and the items they've seen that were deleted since then, along
+    with a cursor to use from then on. Their deletions are read from the
+    inbox too, from the cursor kept in their watermark.
+
+    The item_ids argument is deprecated, since deleted items are tracked on
+    the server in both cases.
+
+    Complete responses carry an ETag. Clients that send it back in
+    If-None-Match get a bodiless 304 when nothing happened since, without
+    any datastore access. If they also pass a number of seconds to wait, the
+    request hangs until something happens or the time is up, instead of
+    returning the 304 right away.
+    """
     @ndb.toplevel
     def get(self):
         # Grab a timestamp first, before we do anything, to ensure that we
@@ -18,7 +57,10 @@ class List(base.BaseHandler):
         now = datetime.datetime.utcnow()
 
         success = self.parse_request(
-            {'item_ids': (list, False, lambda x: len(x) < constants.MAX_ITEMS)})
+            {'item_ids': (list, False, lambda x: len(x) < constants.MAX_ITEMS),
+             'cursor': (long, False, lambda x: x >= 0),
+             'wait': (int, False,
+                      lambda x: 0 < x <= constants.MAX_UPDATES_WAIT_SECONDS)})
         # We need to do some more processing since we want to ensure the
         # item_ids list contains longs.
         item_ids_to_check = []
@@ -31,50 +73,159 @@ class List(base.BaseHandler):
             self.populate_error_response(error_codes.MALFORMED_REQUEST)
             return
 
-        # Load the current user.
-        if not self.populate_user():
+        # Take the fast path if nothing happened since the last check-in.
+        # The user doesn't need to be loaded for that, since the key of the
+        # user follows from the login.
+        fb_user_id = self.get_facebook_user_id()
+        if not fb_user_id:
+            return
+        user_key = models.User.key_for('facebook', fb_user_id)
+        if self.request.if_none_match:
+            version = update_versions.peek(user_key)
+            if (version is not None and
+                    _etag(version) in self.request.if_none_match):
+                # Hang on until something happens, if the client asked to.
+                if not ('wait' in self.args and notifier.get().wait(
+                        user_key, version, self.args['wait'])):
+                    stats.increment('updates.not_modified')
+                    self.response.status_int = httplib.NOT_MODIFIED
+                    return
+        version = update_versions.get(user_key)
+
+        # Load the current user, without resolving the token again.
+        if not self.populate_user(fb_user_id):
             return
 
         # Don't let people query for random item ids. Ensure that only the
         # ones that the user has seen can be checked.
-        if not set(item_ids_to_check).issubset(self.user.seen_item_ids):
-            self.populate_error_response(error_codes.INVALID_ITEM)
-            return
+        if item_ids_to_check:
+            seen_item_ids = seen_items.get(self.user)
+            if not all(i in seen_item_ids for i in item_ids_to_check):
+                self.populate_error_response(error_codes.INVALID_ITEM)
+                return
 
-        # Get all the new messages since the last check-in.
-        messages = []
-        conversations = ndb.get_multi([ndb.Key(models.Conversation, c) for c in
-                                       self.user.ongoing_conversations])
-        for conversation in conversations:
-            # Skip all conversations that predate the user's last activity.
-            if conversation.last_activity_date <= self.user.last_active:
-                continue
-            for message in conversation.messages:
-                # Skip all the messages that predate the user's last activity.
-                if message.create_date <= self.user.last_active:
-                    continue
-                timestamp = (message.create_date - _EPOCH_START).total_seconds()
-                messages.append(
-                    {'user_name': message.user_name,
-                     'message': message.message,
-                     'item_id': conversation.item_key.id(),
-                     'date_sent': str(message.create_date),
-                     'timestamp': timestamp})
+        if 'cursor' in self.args:
+            messages, deleted_item_ids, cursor, more = self._read_inbox(
+                self.args['cursor'])
+        else:
+            watermark = self._get_watermark()
+            if watermark.inbox_cursor is None:
+                # Grab the cursor before reading the deletion log, so that
+                # nothing that happens in between is lost.
+                cursor = inbox.get_cursor(self.user.key)
+                more = False
+                deleted_item_ids = self._read_deletion_log(
+                    watermark.last_active)
+            else:
+                # The deletions come from the user's inbox, and the messages
+                # from the conversations, where the client expects them.
+                _, deleted_item_ids, cursor, more = self._read_inbox(
+                    watermark.inbox_cursor)
+            messages = self._read_conversations(watermark.last_active)
+
+            # Move the watermark forward. If nothing was delivered, leaving
+            # it where it was just means that the next check-in looks at a
+            # slightly longer period, so the write is skipped unless the
+            # watermark got too old.
+            if (messages or cursor != watermark.inbox_cursor or
+                    now - watermark.last_active > datetime.timedelta(
+                        seconds=constants.MAX_WATERMARK_AGE_SECONDS)):
+                watermark.last_active = now
+                watermark.inbox_cursor = cursor
+                watermark.put_async()
 
         # Check which of the provided items have been deleted by retrieving
         # them, then listing the ones that didn't get retrieved.
-        deleted_item_ids = []
         items = ndb.get_multi(
             [ndb.Key(models.Item, i) for i in item_ids_to_check])
         for i in range(0, len(items)):
-            if not items[i]:
+            if not items[i] or items[i].deleted:
                 deleted_item_ids.append(item_ids_to_check[i])
 
         response_dict = {'messages': messages,
-                         'deleted': deleted_item_ids}
+                         'deleted': sorted(set(deleted_item_ids)),
+                         'cursor': cursor,
+                         'more': more}
+        # The response is only up to date with the version if it has
+        # everything up to now.
+        if version is not None and not more:
+            self.response.etag = _etag(version)
+        self.populate_success_response(response_dict)
 
-        # Update the last_active timestamp.
-        self.user.last_active = now
-        self.user.put_async()
+    def _read_inbox(self, cursor):
+        """Read the events of the user's inbox that come after a cursor.
 
-        self.populate_success_response(response_dict)
+        Returns:
+          A (messages, deleted_item_ids, cursor, more) tuple, where cursor is
+          the cursor for the next check-in and more is True if there are more
+          events to read from it already.
+        """
+        events, cursor, more = inbox.read(self.user.key, cursor)
+        messages = []
+        deleted_item_ids = []
+        for event in events:
+            if event.type == inbox.MESSAGE:
+                messages.append(_message_dict(event.item_id, event.message))
+            elif event.type == inbox.ITEM_DELETED:
+                deleted_item_ids.append(event.item_id)
+        return messages, deleted_item_ids, cursor, more
+
+    def _get_watermark(self):
+        """Load the user's models.UpdatesWatermark.
+
+        Users that haven't checked in since the watermark was moved out of
+        the User get a new one, starting at their last activity.
+        """
+        watermark_key = ndb.Key(models.UpdatesWatermark, self.user.key.id())
+        watermark = watermark_key.get()
+        if not watermark:
+            watermark = models.UpdatesWatermark(
+                key=watermark_key, last_active=self.user.last_active)
+        return watermark
+
+    def _read_deletion_log(self, last_active):
+        """Find the items that the user has seen, deleted since a check-in.
+
+        This is only for watermarks from before they kept an inbox cursor.
+        Every user that has seen an item has a like state for it, so the
+        logged items are matched against the user's like states.
+
+        Args:
+          last_active: The datetime of the user's last check-in.
+        Returns:
+          A list of item ids.
+        """
+        since = last_active - datetime.timedelta(
+            seconds=constants.DELETION_LOG_MARGIN_SECONDS)
+        item_ids = item_deletion.get_deleted_item_ids(since)
+        like_states = ndb.get_multi(
+            [models.LikeState.key_for(self.user.key, i) for i in item_ids])
+        return [i for i, like_state in zip(item_ids, like_states)
+                if like_state]
+
+    def _read_conversations(self, last_active):
+        """Read all the new messages since the user's last activity.
+
+        This costs as much as the number of the user's conversations, so it
+        is only here for clients that don't pass a cursor yet.
+
+        Args:
+          last_active: The datetime of the user's last check-in.
+        """
+        messages = []
+        conversations = ndb.get_multi(
+            self.user.conversation_keys +
+            [ndb.Key(models.Conversation, c)
+             for c in self.user.ongoing_conversations])
+        # Skip all conversations that predate the user's last activity, and
+        # load the new messages of the others in parallel.
+        conversations = [c for c in conversations
+                         if c and c.last_activity_date > last_active]
+        new_message_futures = [
+            chat_messages.get_since_async(c, last_active)
+            for c in conversations]
+        for conversation, future in zip(conversations, new_message_futures):
+            for message in future.get_result():
+                messages.append(
+                    _message_dict(conversation.item_key.id(), message))
+        return messages
@@ -1,10 +1,16 @@
 import datetime
+import threading
+import time
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 import httplib
 from webapp2_extras import json
 
+import constants
 import error_codes
 import models
+import notifier
+import seen_items
 import test_utils
 
 _EPOCH_START = datetime.datetime(1970, 1, 1)
@@ -17,31 +23,26 @@ class ListTest(test_utils.HandlerTest):
         seen_item_ids = []
         ongoing_conversations = []
 
-        other_user = ndb.Key(models.User, self.user_key.id() + 1)
+        other_user = models.User.key_for('facebook', '2')
 
         # Another user's item that this user liked, but which has been deleted.
         deleted_item = models.Item(user_key=other_user)
         self.deleted_item_key = deleted_item.put()
-        like_state = models.LikeState(user_key=self.user_key,
-                                      item_key=self.deleted_item_key,
-                                      like_state=True)
-        like_state.put()
+        self.create_like_state(self.user_key, self.deleted_item_key, True)
         seen_item_ids.append(self.deleted_item_key.id())
         self.deleted_item_key.delete()
 
         # Another user's item that this user is having a conversation about,
-        # but nothing changed since last time..
+        # but nothing changed since last time. This conversation predates
+        # both child messages and conversation keys.
         new_item_a = models.Item(user_key=other_user)
         self.new_item_a_key = new_item_a.put()
-        like_state_a = models.LikeState(user_key=self.user_key,
-                                        item_key=self.new_item_a_key,
-                                        like_state=True)
-        like_state_a.put()
+        self.create_like_state(self.user_key, self.new_item_a_key, True)
         seen_item_ids.append(self.new_item_a_key.id())
         conversation_a = models.Conversation(
             item_key=self.new_item_a_key,
             buyer_key=self.user_key,
-            messages=[
+            legacy_messages=[
                 models.Message(user_key=self.user_key,
                                user_name='test_user',
                                message='first_a',
@@ -54,32 +55,25 @@ class ListTest(test_utils.HandlerTest):
         # and which has two new messages.
         new_item_b = models.Item(user_key=other_user)
         self.new_item_b_key = new_item_b.put()
-        like_state_b = models.LikeState(user_key=self.user_key,
-                                        item_key=self.new_item_b_key,
-                                        like_state=True)
-        like_state_b.put()
+        self.create_like_state(self.user_key, self.new_item_b_key, True)
         seen_item_ids.append(self.new_item_b_key.id())
         b_datetime = datetime.datetime.utcnow()
         b_timestamp = (b_datetime - _EPOCH_START).total_seconds()
-        conversation_b = models.Conversation(
-            item_key=self.new_item_b_key,
-            buyer_key=self.user_key,
-            messages=[
-                models.Message(user_key=self.user_key,
-                               user_name='test_user',
-                               message='first_b',
-                               create_date=_EPOCH_START),
-                models.Message(user_key=other_user,
-                               user_name='other_user',
-                               message='response_b_1',
-                               create_date=b_datetime),
-                models.Message(user_key=other_user,
-                               user_name='other_user',
-                               message='response_b_2',
-                               create_date=b_datetime)],
-        )
-        conversation_b_key = conversation_b.put()
-        ongoing_conversations.append(conversation_b_key.id())
+        conversation_b_key = self.create_conversation(
+            self.new_item_b_key, self.user_key,
+            [models.Message(user_key=self.user_key,
+                            user_name='test_user',
+                            message='first_b',
+                            create_date=_EPOCH_START),
+             models.Message(user_key=other_user,
+                            user_name='other_user',
+                            message='response_b_1',
+                            create_date=b_datetime),
+             models.Message(user_key=other_user,
+                            user_name='other_user',
+                            message='response_b_2',
+                            create_date=b_datetime)])
+        conversation_keys = [conversation_b_key]
 
         self.expected_messages = [
             {u'user_name': u'other_user',
@@ -94,8 +88,9 @@ class ListTest(test_utils.HandlerTest):
              u'timestamp': b_timestamp}
         ]
 
-        self.user.seen_item_ids = seen_item_ids
+        seen_items.add(self.user, seen_item_ids)
         self.user.ongoing_conversations = ongoing_conversations
+        self.user.conversation_keys = conversation_keys
         self.user.last_active = datetime.datetime(2000, 1, 1)
         self.user.put()
 
@@ -112,10 +107,7 @@ class ListTest(test_utils.HandlerTest):
 
     def test_deleted_must_be_seen(self):
         # Remove the deleted_item_key from the list of items this user has seen.
-        deleted_item_index = self.user.seen_item_ids.index(
-            self.deleted_item_key.id())
-        del self.user.seen_item_ids[deleted_item_index]
-        self.user.put()
+        seen_items.remove(self.user, self.deleted_item_key.id())
         response = self.app.get(
             '/updates',
             params={'item_ids': [self.deleted_item_key.id(),
@@ -128,6 +120,58 @@ class ListTest(test_utils.HandlerTest):
         self.assertEqual(error_codes.INVALID_ITEM.code,
                          response_body['error']['error_code'])
 
+    def test_deleted_items_are_tracked(self):
+        # The owner of an item that this user has seen deletes it.
+        seller = self.create_user('2')
+        item_key = models.Item(user_key=seller.key).put()
+        seen_items.add(self.user, [item_key.id()])
+        self.create_like_state(self.user_key, item_key, True)
+        response = self.app.post(
+            '/item/delete',
+            params=json.encode({'item_id': item_key.id()}),
+            headers=self.headers_for_user(seller.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+
+        # The deletion is reported without the client asking about the item.
+        response = self.app.get(
+            '/updates',
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        self.assertListEqual([item_key.id()],
+                             json.decode(response.body)['deleted'])
+
+    def test_deleted_items_from_inbox(self):
+        # The first check-in moves the watermark to the end of the inbox.
+        response = self.app.get(
+            '/updates',
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        watermark_key = ndb.Key(models.UpdatesWatermark, self.user_key.id())
+        self.assertEqual(0, watermark_key.get().inbox_cursor)
+
+        seller = self.create_user('2')
+        item_key = models.Item(user_key=seller.key).put()
+        seen_items.add(self.user, [item_key.id()])
+        self.create_like_state(self.user_key, item_key, True)
+        response = self.app.post(
+            '/item/delete',
+            params=json.encode({'item_id': item_key.id()}),
+            headers=self.headers_for_user(seller.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        self.run_tasks()
+
+        response = self.app.get(
+            '/updates',
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertListEqual([item_key.id()],
+                             json.decode(response.body)['deleted'])
+        self.assertEqual(1, watermark_key.get().inbox_cursor)
+        # The deletion is only reported once.
+        response = self.app.get(
+            '/updates',
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertListEqual([], json.decode(response.body)['deleted'])
+
     def test_new_messages(self):
         response = self.app.get(
             '/updates',
@@ -136,3 +180,214 @@ class ListTest(test_utils.HandlerTest):
         messages = json.decode(response.body)['messages']
         self.assertListEqual(self.expected_messages, messages)
 
+    def test_watermark(self):
+        response = self.app.get(
+            '/updates',
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        self.assertListEqual(self.expected_messages,
+                             json.decode(response.body)['messages'])
+
+        # The watermark moved past the delivered messages, without touching
+        # the user.
+        watermark_key = ndb.Key(models.UpdatesWatermark, self.user_key.id())
+        last_active = watermark_key.get().last_active
+        self.assertGreater(last_active, datetime.datetime(2000, 1, 1))
+        self.assertEqual(datetime.datetime(2000, 1, 1),
+                         self.user_key.get().last_active)
+
+        # Nothing new was delivered, so the recent watermark stays as is.
+        response = self.app.get(
+            '/updates',
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        self.assertListEqual([], json.decode(response.body)['messages'])
+        self.assertEqual(last_active, watermark_key.get().last_active)
+
+    def test_legacy_check_in_returns_cursor(self):
+        response = self.app.get(
+            '/updates',
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        self.assertEqual(0, json.decode(response.body)['cursor'])
+
+
+class InboxTest(test_utils.HandlerTest):
+    def setUp(self):
+        super(InboxTest, self).setUp()
+
+        # The test user likes another user's item.
+        self.seller = self.create_user('2', name='seller_name')
+        self.item_key = models.Item(user_key=self.seller.key).put()
+        seen_items.add(self.user, [self.item_key.id()])
+        self.create_like_state(self.user_key, self.item_key, True)
+
+    def send_message(self, sender, receiver_key, message):
+        response = self.app.post(
+            '/chat/post',
+            params=json.encode({'item_id': self.item_key.id(),
+                                'receiver_id': receiver_key.id(),
+                                'message': message}),
+            headers=self.headers_for_user(sender.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+
+    def check_in(self, user, cursor):
+        response = self.app.get(
+            '/updates',
+            params={'cursor': cursor},
+            headers=self.headers_for_user(user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        return json.decode(response.body)
+
+    def test_messages(self):
+        self.send_message(self.user, self.seller.key, 'hello')
+        self.send_message(self.seller, self.user_key, 'hi')
+
+        # Both participants get both messages.
+        for user in [self.user, self.seller]:
+            body = self.check_in(user, 0)
+            self.assertListEqual(['hello', 'hi'],
+                                 [m['message'] for m in body['messages']])
+            self.assertListEqual(
+                [self.item_key.id()] * 2,
+                [m['item_id'] for m in body['messages']])
+            self.assertEqual(2, body['cursor'])
+            self.assertFalse(body['more'])
+
+        # Nothing new happened since the last cursor.
+        body = self.check_in(self.user, 2)
+        self.assertListEqual([], body['messages'])
+        self.assertEqual(2, body['cursor'])
+
+        self.send_message(self.seller, self.user_key, 'still there?')
+        body = self.check_in(self.user, 2)
+        self.assertListEqual(['still there?'],
+                             [m['message'] for m in body['messages']])
+        self.assertEqual(3, body['cursor'])
+
+    def test_not_modified(self):
+        self.send_message(self.user, self.seller.key, 'hello')
+        response = self.app.get(
+            '/updates',
+            params={'cursor': 0},
+            headers=self.headers_for_user(self.user.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        etag = response.headers['ETag']
+        cursor = json.decode(response.body)['cursor']
+
+        # Nothing happened since the last check-in.
+        headers = self.headers_for_user(self.user.third_party_id)
+        headers['If-None-Match'] = etag
+        response = self.app.get('/updates', params={'cursor': cursor},
+                                headers=headers)
+        self.assertEqual(httplib.NOT_MODIFIED, response.status_int)
+
+        # A new message changes the version.
+        self.send_message(self.seller, self.user_key, 'hi')
+        response = self.app.get('/updates', params={'cursor': cursor},
+                                headers=headers)
+        self.assertEqual(httplib.OK, response.status_int)
+        self.assertListEqual(['hi'], [m['message'] for m in
+                                      json.decode(response.body)['messages']])
+        self.assertNotEqual(etag, response.headers['ETag'])
+
+        # If the version counter is evicted, the full path is taken.
+        etag = response.headers['ETag']
+        cursor = json.decode(response.body)['cursor']
+        memcache.flush_all()
+        headers['If-None-Match'] = etag
+        response = self.app.get('/updates', params={'cursor': cursor},
+                                headers=headers)
+        self.assertEqual(httplib.OK, response.status_int)
+        self.assertListEqual([], json.decode(response.body)['messages'])
+
+    def test_wait(self):
+        orig_notifier = notifier.get()
+        notifier.set_notifier(notifier.InProcessNotifier())
+        try:
+            response = self.app.get(
+                '/updates',
+                params={'cursor': 0},
+                headers=self.headers_for_user(self.user.third_party_id))
+            self.assertEqual(httplib.OK, response.status_int)
+            headers = self.headers_for_user(self.user.third_party_id)
+            headers['If-None-Match'] = response.headers['ETag']
+
+            # Nothing happens, so the request times out.
+            response = self.app.get('/updates',
+                                    params={'cursor': 0, 'wait': 1},
+                                    headers=headers)
+            self.assertEqual(httplib.NOT_MODIFIED, response.status_int)
+
+            # Something happens while the request is waiting.
+            timer = threading.Timer(
+                0.1, lambda: notifier.get().notify([self.user_key]))
+            timer.start()
+            start = time.time()
+            response = self.app.get(
+                '/updates',
+                params={'cursor': 0,
+                        'wait': constants.MAX_UPDATES_WAIT_SECONDS},
+                headers=headers)
+            timer.join()
+            self.assertEqual(httplib.OK, response.status_int)
+            self.assertLess(time.time() - start,
+                            constants.MAX_UPDATES_WAIT_SECONDS)
+        finally:
+            notifier.set_notifier(orig_notifier)
+
+    def test_wait_is_capped(self):
+        orig_notifier = notifier.get()
+        orig_max_waiting = constants.MAX_WAITING_UPDATES_REQUESTS
+        constants.MAX_WAITING_UPDATES_REQUESTS = 0
+        notifier.set_notifier(notifier.InProcessNotifier())
+        try:
+            response = self.app.get(
+                '/updates',
+                params={'cursor': 0},
+                headers=self.headers_for_user(self.user.third_party_id))
+            headers = self.headers_for_user(self.user.third_party_id)
+            headers['If-None-Match'] = response.headers['ETag']
+
+            # With no room for another waiting request, it returns at once.
+            start = time.time()
+            response = self.app.get(
+                '/updates',
+                params={'cursor': 0,
+                        'wait': constants.MAX_UPDATES_WAIT_SECONDS},
+                headers=headers)
+            self.assertEqual(httplib.NOT_MODIFIED, response.status_int)
+            self.assertLess(time.time() - start,
+                            constants.MAX_UPDATES_WAIT_SECONDS)
+        finally:
+            constants.MAX_WAITING_UPDATES_REQUESTS = orig_max_waiting
+            notifier.set_notifier(orig_notifier)
+
+    def test_paging(self):
+        orig_max_events = constants.MAX_INBOX_EVENTS_PER_REQUEST
+        constants.MAX_INBOX_EVENTS_PER_REQUEST = 2
+        try:
+            for message in ['1', '2', '3']:
+                self.send_message(self.user, self.seller.key, message)
+            body = self.check_in(self.user, 0)
+            self.assertListEqual(['1', '2'],
+                                 [m['message'] for m in body['messages']])
+            self.assertTrue(body['more'])
+            body = self.check_in(self.user, body['cursor'])
+            self.assertListEqual(['3'],
+                                 [m['message'] for m in body['messages']])
+            self.assertFalse(body['more'])
+        finally:
+            constants.MAX_INBOX_EVENTS_PER_REQUEST = orig_max_events
+
+    def test_deleted_items(self):
+        response = self.app.post(
+            '/item/delete',
+            params=json.encode({'item_id': self.item_key.id()}),
+            headers=self.headers_for_user(self.seller.third_party_id))
+        self.assertEqual(httplib.OK, response.status_int)
+        self.run_tasks()
+
+        body = self.check_in(self.user, 0)
+        self.assertListEqual([self.item_key.id()], body['deleted'])
+        self.assertEqual(1, body['cursor'])
@@ -3,7 +3,6 @@ from google.appengine.ext import ndb
 import base
 import error_codes
 import models
-import user_utils
 
 
 class Authenticate(base.BaseHandler):
@@ -18,26 +17,16 @@ class Authenticate(base.BaseHandler):
         fb_access_token = self.request.headers.get('x-auth-token')
 
         # Use the token to get the Facebook user id.
-        try:
-            fb_user_id = user_utils.get_facebook_user_id(fb_access_token)
-        except user_utils.FacebookTokenExpiredException:
-            self.populate_error_response(error_codes.FACEBOOK_TOKEN_ERROR)
-            return
-        except user_utils.FacebookException as e:
-            self.populate_error_response(error_codes.FACEBOOK_ERROR, e.error)
-            return
-
-        # Check if the user is already registered, and if so, just return.
-        user = models.User.query(models.User.third_party_id == fb_user_id).get()
-        if user:
-            self.populate_success_response({'token': fb_access_token})
+        fb_user_id = self.get_facebook_user_id()
+        if not fb_user_id:
             return
 
-        # Store a new user entry.
-        user = models.User(login_type='facebook',
-                           third_party_id=fb_user_id,
-                           name=self.args['name'])
-        user.put_async()
+        # Store a new user entry, unless the user is already registered.
+        user_key = models.User.key_for('facebook', fb_user_id)
+        models.User.get_or_insert(user_key.id(),
+                                  login_type='facebook',
+                                  third_party_id=fb_user_id,
+                                  name=self.args['name'])
         self.populate_success_response({'token': fb_access_token})
 
 
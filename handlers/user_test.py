@@ -4,6 +4,7 @@ from webapp2_extras import json
 import error_codes
 import models
 import test_utils
+import user_utils
 
 
 class AuthenticateTest(test_utils.HandlerTest):
@@ -78,3 +79,66 @@ class UpdateTest(test_utils.HandlerTest):
         self.user = self.user_key.get()
         self.assertEqual('changed_name', self.user.name)
         self.assertEqual(100, self.user.distance_radius_km)
+
+    def test_update_legacy_user(self):
+        # A user that was stored under an allocated id.
+        legacy_user = models.User(login_type='facebook', third_party_id='2',
+                                  name='legacy_name')
+        legacy_user.put()
+        response = self.app.post(
+            '/user/update',
+            params=json.encode({'name': 'changed_name',
+                                'distance_radius_km': 100}),
+            headers=self.headers_for_user(2))
+        self.assertEqual(httplib.OK, response.status_int)
+        self.assertEqual('changed_name', legacy_user.key.get().name)
+
+
+class TokenCacheTest(test_utils.HandlerTest):
+    def setUp(self):
+        super(TokenCacheTest, self).setUp()
+        self.facebook_calls = []
+        mock_get_facebook_user_id = user_utils.get_facebook_user_id
+
+        def counting_get_facebook_user_id(fb_access_token):
+            self.facebook_calls.append(fb_access_token)
+            return mock_get_facebook_user_id(fb_access_token)
+        user_utils.get_facebook_user_id = counting_get_facebook_user_id
+
+    def update(self):
+        return self.app.post(
+            '/user/update',
+            params=json.encode({'name': 'changed_name',
+                                'distance_radius_km': 100}),
+            headers=self.headers_for_user(self.user.third_party_id))
+
+    def test_token_is_resolved_once(self):
+        self.assertEqual(httplib.OK, self.update().status_int)
+        self.assertEqual(httplib.OK, self.update().status_int)
+        self.assertListEqual([self.user.third_party_id], self.facebook_calls)
+
+    def test_memcache_tier(self):
+        self.assertEqual(httplib.OK, self.update().status_int)
+        # Simulate a different instance by dropping the local tier.
+        user_utils.clear_token_cache()
+        self.assertEqual(httplib.OK, self.update().status_int)
+        self.assertEqual(1, len(self.facebook_calls))
+
+    def test_expired_token_is_cached(self):
+        def expired_get_facebook_user_id(fb_access_token):
+            self.facebook_calls.append(fb_access_token)
+            raise user_utils.FacebookTokenExpiredException()
+        user_utils.get_facebook_user_id = expired_get_facebook_user_id
+
+        for _ in range(2):
+            response = self.app.post(
+                '/user/update',
+                params=json.encode({'name': 'changed_name',
+                                    'distance_radius_km': 100}),
+                headers=self.headers_for_user(self.user.third_party_id),
+                expect_errors=True)
+            self.assertEqual(httplib.BAD_REQUEST, response.status_int)
+            response_body = json.decode(response.body)
+            self.assertEqual(error_codes.FACEBOOK_TOKEN_ERROR.code,
+                             response_body['error']['error_code'])
+        self.assertEqual(1, len(self.facebook_calls))
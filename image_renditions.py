@@ -0,0 +1,19 @@
+import constants
+
+
+def url(serving_url, rendition):
+    """Return the URL of a rendition of an image.
+
+    The image service resizes an image when a size is appended to its serving
+    URL, and caches the result. So the renditions don't need to be generated
+    or stored when the image is uploaded, and the serving URL that is stored
+    in models.Image and in the search document is enough to get any of them.
+
+    Args:
+      serving_url: The URL returned by images.get_serving_url().
+      rendition: One of the names in constants.IMAGE_RENDITION_SIZES.
+    Returns:
+      The URL of the rendition.
+    """
+    return '{}=s{}'.format(serving_url,
+                           constants.IMAGE_RENDITION_SIZES[rendition])
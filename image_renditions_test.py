@@ -0,0 +1,14 @@
+import unittest
+
+import image_renditions
+
+
+class UrlTest(unittest.TestCase):
+    def test_url(self):
+        self.assertEqual('http://images/abc=s100',
+                         image_renditions.url('http://images/abc',
+                                              'thumbnail'))
+        self.assertEqual('http://images/abc=s400',
+                         image_renditions.url('http://images/abc', 'card'))
+        self.assertEqual('http://images/abc=s1600',
+                         image_renditions.url('http://images/abc', 'full'))
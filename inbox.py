@@ -0,0 +1,95 @@
+from google.appengine.ext import ndb
+
+import constants
+import models
+
+# A new message in one of the user's conversations.
+MESSAGE = 'message'
+
+# An item that the user has seen was deleted.
+ITEM_DELETED = 'item_deleted'
+
+
+def _inbox_key(user_key):
+    return ndb.Key(models.Inbox, user_key.id())
+
+
+def _event_key(user_key, sequence):
+    return ndb.Key(models.InboxEvent, sequence, parent=_inbox_key(user_key))
+
+
+def message_event(item_id, message):
+    """Create the event for a new message about an item."""
+    return models.InboxEvent(
+        type=MESSAGE,
+        item_id=item_id,
+        message=models.Message(user_key=message.user_key,
+                               user_name=message.user_name,
+                               message=message.message,
+                               create_date=message.create_date))
+
+
+def item_deleted_event(item_id):
+    """Create the event for the deletion of an item."""
+    return models.InboxEvent(type=ITEM_DELETED, item_id=item_id)
+
+
+@ndb.transactional_tasklet
+def append_async(user_key, events):
+    """Append events to the end of a user's inbox.
+
+    This joins the current transaction, if there is one.
+
+    Args:
+      user_key: The key of the user.
+      events: The unsaved models.InboxEvent entities.
+    Returns:
+      A future that completes when the events are stored.
+    """
+    inbox = yield _inbox_key(user_key).get_async()
+    if not inbox:
+        inbox = models.Inbox(key=_inbox_key(user_key))
+    for event in events:
+        inbox.last_sequence += 1
+        event.key = _event_key(user_key, inbox.last_sequence)
+    yield ndb.put_multi_async([inbox] + events)
+
+
+def append(user_key, events):
+    """Synchronous version of append_async()."""
+    append_async(user_key, events).get_result()
+
+
+def get_cursor(user_key):
+    """Return the cursor for the end of a user's inbox.
+
+    Args:
+      user_key: The key of the user.
+    Returns:
+      The sequence number of the last event in the inbox.
+    """
+    inbox = _inbox_key(user_key).get()
+    return inbox.last_sequence if inbox else 0
+
+
+def read(user_key, cursor):
+    """Read the events of a user's inbox that come after a cursor.
+
+    Args:
+      user_key: The key of the user.
+      cursor: The sequence number of the last event that was already read.
+    Returns:
+      A (events, cursor, more) triple, where events is the list of
+      models.InboxEvent in the order they happened, cursor is the sequence
+      number of the last of them, and more is True if there are more events
+      to read from the returned cursor.
+    """
+    query = models.InboxEvent.query(
+        models.InboxEvent.key >= _event_key(user_key, cursor + 1),
+        ancestor=_inbox_key(user_key)).order(models.InboxEvent.key)
+    events = query.fetch(constants.MAX_INBOX_EVENTS_PER_REQUEST + 1)
+    more = len(events) > constants.MAX_INBOX_EVENTS_PER_REQUEST
+    events = events[:constants.MAX_INBOX_EVENTS_PER_REQUEST]
+    if events:
+        cursor = events[-1].key.id()
+    return events, cursor, more
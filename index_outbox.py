@@ -0,0 +1,107 @@
+import logging
+import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import constants
+import models
+import task_utils
+
+# The search documents of new items are stored in the same transaction as the
+# items, as models.PendingDocument children, and indexed in batches by
+# handlers.item.DrainIndexOutbox. This keeps the Search API off the critical
+# path of posting an item, and an item can't be lost to an indexing error.
+
+# The URL of handlers.item.DrainIndexOutbox.
+_DRAIN_URL = '/admin/tasks/drain_index_outbox'
+
+
+def put(item, document):
+    """Store a new item along with its search document.
+
+    Args:
+      item: The unsaved models.Item.
+      document: The fields of the item's search document, see
+        item_search.build_document().
+    Returns:
+      The key of the item.
+    """
+    item.key = ndb.Key(models.Item, models.Item.allocate_ids(1)[0])
+    _put_async(item, document).get_result()
+    return item.key
+
+
+def put_multi(items, documents):
+    """Store new items along with their search documents.
+
+    The ids of the items are allocated at once. Each item is written along
+    with its document in its own transaction, and the transactions run in
+    parallel, so a failure only loses the item that it happened to.
+
+    Args:
+      items: The list of unsaved models.Item.
+      documents: The fields of the items' search documents, in the same
+        order.
+    Returns:
+      The list of the keys of the items, with None for the ones that failed
+      to be stored.
+    """
+    first_id, _ = models.Item.allocate_ids(len(items))
+    futures = []
+    for i, (item, document) in enumerate(zip(items, documents)):
+        item.key = ndb.Key(models.Item, first_id + i)
+        futures.append(_put_async(item, document))
+    item_keys = []
+    for item, future in zip(items, futures):
+        try:
+            future.get_result()
+            item_keys.append(item.key)
+        except datastore_errors.Error as e:
+            logging.warning('Storing item_id={} failed. Message: {}'.format(
+                item.key.id(), e))
+            item_keys.append(None)
+    return item_keys
+
+
+@ndb.transactional_tasklet
+def _put_async(item, document):
+    # The document is a child of the item, so this is a single entity group.
+    yield ndb.put_multi_async([
+        item, models.PendingDocument(key=models.PendingDocument.key_for(
+            item.key), document=document)])
+
+
+def start_drain():
+    """Make sure that the outbox is drained soon.
+
+    The documents that are stored within the same
+    constants.INDEX_OUTBOX_DRAIN_DELAY_SECONDS share a drain task. A cron job
+    also drains the outbox, in case this fails after the item was stored.
+    """
+    delay = constants.INDEX_OUTBOX_DRAIN_DELAY_SECONDS
+    try:
+        task_utils.add_task(
+            _DRAIN_URL,
+            name='drain-index-outbox-{}'.format(int(time.time() / delay)),
+            countdown=delay)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def get_pending(limit):
+    """Return the oldest documents that are waiting to be indexed.
+
+    The query is eventually consistent, so the newest documents may be
+    missing.
+
+    Args:
+      limit: The maximum number of documents to return.
+    Returns:
+      A (pending_documents, more) pair, where pending_documents is a list of
+      models.PendingDocument, and more tells whether there are more of them.
+    """
+    pending = models.PendingDocument.query().order(
+        models.PendingDocument.create_date).fetch(limit + 1)
+    return pending[:limit], len(pending) > limit
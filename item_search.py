@@ -0,0 +1,315 @@
+import datetime
+import time
+
+from google.appengine.api import search
+from google.appengine.ext import ndb
+
+import constants
+import geohash
+import models
+import search_backend
+
+# The number of likes of an item, as of the last time it was folded in from
+# the item's like counter. Documents that were indexed before this was
+# stored in them don't have this field.
+LIKE_COUNT_FIELD = 'like_count'
+
+
+# The search documents of the items are split into regional indexes by the
+# geohash cell of their location. The original index covers the whole world,
+# which is the cell ''. It is split into the cells of
+# constants.INDEX_REGION_PRECISION, and any other cell is split into the 32
+# cells one character longer. The splits are recorded in models.IndexRoute
+# entities.
+#
+# While a cell is split, its own index still holds the documents that were
+# stored before, until they are moved to its subcells (see
+# handlers.migration.SplitIndexRegion), so it keeps being searched.
+
+# The routes of the cells, along with when they were loaded, cached by each
+# instance.
+_routes = None
+_routes_time = 0
+
+
+def _index_name(cell):
+    if not cell:
+        return constants.ITEM_INDEX_NAME
+    return '{}-{}'.format(constants.ITEM_INDEX_NAME, cell)
+
+
+def _root_route_key():
+    return ndb.Key(models.IndexRoute, _index_name(''))
+
+
+def _route_key(cell):
+    if not cell:
+        return _root_route_key()
+    return ndb.Key(models.IndexRoute, _index_name(cell),
+                   parent=_root_route_key())
+
+
+def _default_route(cell):
+    # Documents were split by region from the start, except for the ones
+    # that were stored before, in the original index.
+    if not cell:
+        return models.IndexRoute(key=_route_key(cell), split=True)
+    return models.IndexRoute(key=_route_key(cell))
+
+
+def _subcell_precision(cell):
+    return len(cell) + 1 if cell else constants.INDEX_REGION_PRECISION
+
+
+def get_routes(fresh=False):
+    """Return the routes of the cells that aren't in their default state.
+
+    Args:
+      fresh: Whether to bypass the instance's cache.
+    Returns:
+      A dictionary from geohash cells to models.IndexRoute entities.
+    """
+    global _routes, _routes_time
+    if (fresh or _routes is None or time.time() - _routes_time >
+            constants.INDEX_ROUTE_CACHE_TTL_SECONDS):
+        # The ids of the subcells' routes are the names of their indexes.
+        prefix_length = len(constants.ITEM_INDEX_NAME) + 1
+        routes = models.IndexRoute.query(ancestor=_root_route_key()).fetch()
+        _routes = dict(
+            (r.key.id()[prefix_length:] if r.key.parent() else '', r)
+            for r in routes)
+        _routes_time = time.time()
+    return _routes
+
+
+def clear_route_cache():
+    """Clear the instance's cache of the routes. Used in tests."""
+    global _routes
+    _routes = None
+
+
+def get_route(cell, routes=None):
+    """Return the route of a cell.
+
+    Args:
+      cell: The geohash of the cell, or '' for the whole world.
+      routes: The routes from get_routes(), if already loaded.
+    """
+    if routes is None:
+        routes = get_routes()
+    return routes.get(cell) or _default_route(cell)
+
+
+@ndb.transactional
+def split(cell):
+    """Start storing the new documents in a cell in its subcells' indexes.
+
+    Returns:
+      The cell's models.IndexRoute.
+    """
+    route = _route_key(cell).get() or _default_route(cell)
+    if not route.split or not route.split_date:
+        route.split = True
+        route.split_date = datetime.datetime.utcnow()
+        route.put()
+    return route
+
+
+@ndb.transactional
+def mark_moved(cell):
+    """Record that a cell's own index doesn't have any documents left."""
+    route = _route_key(cell).get() or _default_route(cell)
+    route.moved = True
+    route.put()
+
+
+def get_index(cell=''):
+    """Return the index of the items in a cell.
+
+    The index comes from the search_backend in use.
+
+    Args:
+      cell: The geohash of the cell. The default is the original index, which
+        covers the whole world.
+    """
+    return search_backend.get().get_index(_index_name(cell))
+
+
+def get_cells_for_point(lat, lng, routes=None):
+    """Return the cells whose indexes may hold the document of an item.
+
+    Args:
+      lat: The latitude of the item.
+      lng: The longitude of the item.
+      routes: The routes from get_routes(), if already loaded.
+    Returns:
+      The list of cells, starting with the one that new documents go to.
+    """
+    cells = []
+    cell = ''
+    while True:
+        route = get_route(cell, routes)
+        if not route.moved:
+            cells.append(cell)
+        if not route.split:
+            break
+        cell = geohash.encode(lat, lng, _subcell_precision(cell))
+    cells.reverse()
+    return cells
+
+
+def get_cells_for_circle(lat, lng, radius_km):
+    """Return the cells whose indexes must be searched around a point.
+
+    Args:
+      lat: The latitude of the center of the search.
+      lng: The longitude of the center of the search.
+      radius_km: The search radius.
+    Returns:
+      The sorted list of cells.
+    """
+    routes = get_routes()
+    cells = []
+    to_visit = ['']
+    while to_visit:
+        cell = to_visit.pop()
+        route = get_route(cell, routes)
+        if not route.moved:
+            cells.append(cell)
+        if route.split:
+            to_visit.extend(
+                c for c in geohash.covering(lat, lng, radius_km,
+                                            _subcell_precision(cell))
+                if c.startswith(cell))
+    return sorted(cells)
+
+
+def get_index_for_point(lat, lng):
+    """Return the index that a new document at a location goes to."""
+    return get_index(get_cells_for_point(lat, lng)[0])
+
+
+def _get_item_cells(item):
+    if not item.location:
+        # The item's document was stored before documents were split by
+        # region, and hasn't been moved since.
+        return ['']
+    return get_cells_for_point(item.location.lat, item.location.lon)
+
+
+def find_document(item):
+    """Find the search document of an item.
+
+    Args:
+      item: The models.Item.
+    Returns:
+      A (cell, document) pair, where the cell is the one whose index holds
+      the document, or (None, None) if the item doesn't have a document.
+    """
+    doc_id = str(item.key.id())
+    for cell in _get_item_cells(item):
+        document = get_index(cell).get(doc_id)
+        if document:
+            return cell, document
+    return None, None
+
+
+def delete_document(item):
+    """Delete the search document of an item, wherever it is."""
+    doc_id = str(item.key.id())
+    for cell in _get_item_cells(item):
+        get_index(cell).delete(doc_id)
+
+
+def build_query(lat, lng, radius_km, category=None, search_terms=()):
+    """Build the query string of a search for items.
+
+    Args:
+      lat: The latitude of the center of the search.
+      lng: The longitude of the center of the search.
+      radius_km: The search radius.
+      category: The category to search, if any.
+      search_terms: The search terms, if any.
+    """
+    query = ['distance(location, geopoint({}, {})) < {}'.format(
+        lat, lng, radius_km * 1000)]
+    if category:
+        query.append('category={}'.format(category))
+    if search_terms:
+        # Stem each word.
+        query.append(' '.join('~' + t for t in search_terms))
+    return ' AND '.join(query)
+
+
+def build_sort_options(retrieval):
+    """Return the search.SortOptions of a constants.RETRIEVAL_* mode.
+
+    Returns:
+      The sort options, or None to order the results by rank.
+    """
+    if retrieval != constants.RETRIEVAL_POPULAR:
+        return None
+    # Let the search service rank the items by their like counts. Documents
+    # that were indexed before like counts were stored in them count as
+    # having none.
+    return search.SortOptions(expressions=[
+        search.SortExpression(expression=LIKE_COUNT_FIELD,
+                              direction=search.SortExpression.DESCENDING,
+                              default_value=0)])
+
+
+def build_document(item_id, document, like_count=0):
+    """Create the search document of an item.
+
+    Args:
+      item_id: The id of the models.Item, which is shared with the document.
+      document: A dictionary with the item's 'user_id', 'category', 'title',
+        'description', 'price', 'currency', 'lat' and 'lng', as stored in
+        its models.PendingDocument.
+      like_count: The number of likes of the item so far. Later likes are
+        folded in by like_state.FoldLikeCounts.
+    Returns:
+      The search.Document.
+    """
+    fields = [
+        # Include the user ID so we can skip items owned by a user in
+        # queries.
+        search.AtomField(name='user_id', value=document['user_id']),
+        search.AtomField(name='category', value=document['category']),
+        search.TextField(name='title', value=document['title']),
+        search.TextField(name='description', value=document['description']),
+        search.NumberField(name='price', value=document['price']),
+        search.TextField(name='currency', value=document['currency']),
+        search.GeoField(name='location',
+                        value=search.GeoPoint(document['lat'],
+                                              document['lng']))]
+    fields.append(search.NumberField(name=LIKE_COUNT_FIELD, value=like_count))
+    return search.Document(doc_id=str(item_id), fields=fields)
+
+
+def with_like_count(document, like_count):
+    """Return a copy of a search document with its like count replaced.
+
+    Args:
+      document: The item's search.Document.
+      like_count: The number of likes of the item.
+    Returns:
+      The new search.Document.
+    """
+    return _with_fields(
+        document, [LIKE_COUNT_FIELD],
+        [search.NumberField(name=LIKE_COUNT_FIELD, value=like_count)])
+
+
+def _with_fields(document, names, fields):
+    """Return a copy of a search document with some of its fields replaced.
+
+    Args:
+      document: The search.Document.
+      names: The names of the fields to remove.
+      fields: The fields to add.
+    Returns:
+      The new search.Document.
+    """
+    fields = [f for f in document.fields if f.name not in names] + fields
+    return search.Document(doc_id=document.doc_id, fields=fields)
@@ -0,0 +1,121 @@
+import random
+
+from google.appengine.ext import ndb
+
+import constants
+import models
+
+# The number of likes of every item is split across shards, so that likes of
+# a popular item don't contend on a single entity. The counts are folded into
+# the items' search documents in the background, see
+# handlers.like_state.FoldLikeCounts.
+
+
+def _shard_keys(item_id):
+    return [ndb.Key(models.LikeCounterShard, '{}:{}'.format(item_id, i))
+            for i in range(constants.NUM_LIKE_COUNTER_SHARDS)]
+
+
+@ndb.transactional_tasklet
+def _increment_shard_async(shard_key, item_id, delta):
+    shard = yield shard_key.get_async()
+    if not shard:
+        shard = models.LikeCounterShard(key=shard_key, item_id=item_id)
+    shard.count += delta
+    shard.num_increments += 1
+    shard.dirty = True
+    yield shard.put_async()
+
+
+def increment(deltas):
+    """Add to the like counts of items.
+
+    Each item's count is changed in a random shard, in its own transaction.
+
+    Args:
+      deltas: A dictionary from item ids to the amounts to add to their like
+        counts.
+    """
+    futures = [
+        _increment_shard_async(random.choice(_shard_keys(item_id)), item_id,
+                               delta)
+        for item_id, delta in deltas.iteritems() if delta]
+    for future in futures:
+        future.get_result()
+
+
+def get_dirty_item_ids(limit):
+    """Return the ids of items whose counts changed since they were folded.
+
+    Args:
+      limit: The maximum number of shards to look at.
+    Returns:
+      An (item_ids, more) pair, where more tells whether there may be more
+      changed shards than were looked at.
+    """
+    shards = models.LikeCounterShard.query(
+        models.LikeCounterShard.dirty == True).fetch(limit)
+    return list(set(shard.item_id for shard in shards)), len(shards) == limit
+
+
+def read(item_ids):
+    """Read the like counts of items.
+
+    Args:
+      item_ids: The ids of the items.
+    Returns:
+      A (counts, shards) pair, where counts is a dictionary from item ids to
+      their like counts, and shards is the list of the models.LikeCounterShard
+      entities that they were summed from, for mark_clean(). The shards that
+      don't exist yet are included as new entities.
+    """
+    keys = [(item_id, key) for item_id in item_ids
+            for key in _shard_keys(item_id)]
+    shards = [
+        shard or models.LikeCounterShard(key=key, item_id=item_id)
+        for (item_id, key), shard in zip(
+            keys, ndb.get_multi([key for _, key in keys]))]
+    counts = dict((item_id, 0) for item_id in item_ids)
+    for shard in shards:
+        counts[shard.item_id] += shard.count
+    return counts, shards
+
+
+def _is_dirty(shard, current):
+    # A shard that changed since it was read may have been folded by a
+    # concurrent fold, which read the newer count, before this fold wrote
+    # the older one. So it is marked dirty again.
+    return current.num_increments != shard.num_increments
+
+
+@ndb.transactional_tasklet
+def _mark_clean_async(shard):
+    current = yield shard.key.get_async()
+    if current and current.dirty != _is_dirty(shard, current):
+        current.dirty = _is_dirty(shard, current)
+        yield current.put_async()
+
+
+def mark_clean(shards):
+    """Record that the counts read by read() were folded.
+
+    Shards that changed since they were read stay, or become, dirty, so that
+    their new counts get folded as well.
+
+    Args:
+      shards: The shards returned by read().
+    """
+    # Most shards need no change, so they are checked outside of
+    # transactions first.
+    currents = ndb.get_multi([shard.key for shard in shards],
+                             use_cache=False, use_memcache=False)
+    futures = [_mark_clean_async(shard)
+               for shard, current in zip(shards, currents)
+               if current and current.dirty != _is_dirty(shard, current)]
+    for future in futures:
+        future.get_result()
+
+
+def delete(item_id):
+    """Delete the like count of an item."""
+    ndb.delete_multi(_shard_keys(item_id))
@@ -13,19 +13,35 @@ routes = [
 
     # Item creation.
     Route(r'/item/post', handler='handlers.item.Post', name='post'),
+    Route(r'/item/post/batch', handler='handlers.item.PostBatch',
+          name='post_batch'),
     Route(r'/item/image/upload_url', handler='handlers.image.GetUploadUrl',
           name='upload_url'),
     Route(r'/item/image/upload', handler='handlers.image.Upload',
           name='upload'),
+    Route(r'/admin/tasks/drain_index_outbox',
+          handler='handlers.item.DrainIndexOutbox',
+          name='drain_index_outbox'),
 
     # Item deletion.
     Route(r'/item/delete', handler='handlers.item.Delete', name='delete'),
+    Route(r'/admin/tasks/delete_item',
+          handler='handlers.item_deletion.DeleteItemTask',
+          name='delete_item_task'),
 
     # Liking and disliking of items.
     Route(r'/item/like', handler='handlers.like_state.Post', name='like'),
+    Route(r'/item/like/batch', handler='handlers.like_state.PostBatch',
+          name='like_batch'),
+    Route(r'/admin/tasks/fold_like_counts',
+          handler='handlers.like_state.FoldLikeCounts',
+          name='fold_like_counts'),
 
     # Retrieving items for display to users.
     Route(r'/item/list', handler='handlers.item.List', name='list'),
+    Route(r'/admin/tasks/refill_candidate_feed',
+          handler='handlers.item.RefillCandidateFeed',
+          name='refill_candidate_feed'),
 
     # Chatting.
     Route(r'/chat/post', handler='handlers.conversation.Post', name='post'),
@@ -35,7 +51,25 @@ routes = [
 
     # Administrative, for development.
     Route(r'/clear_all', handler='handlers.handlers.ClearAllEntry',
-          name='clear_all')
+          name='clear_all'),
+    Route(r'/admin/stats', handler='handlers.handlers.Stats', name='stats'),
+
+    # Data migrations, run as chains of push tasks.
+    Route(r'/admin/migrate/user_keys',
+          handler='handlers.migration.MigrateUserKeys',
+          name='migrate_user_keys'),
+    Route(r'/admin/migrate/like_state_keys',
+          handler='handlers.migration.MigrateLikeStateKeys',
+          name='migrate_like_state_keys'),
+    Route(r'/admin/migrate/conversation_messages',
+          handler='handlers.migration.MigrateConversationMessages',
+          name='migrate_conversation_messages'),
+    Route(r'/admin/migrate/conversation_keys',
+          handler='handlers.migration.MigrateConversationKeys',
+          name='migrate_conversation_keys'),
+    Route(r'/admin/migrate/split_index_region',
+          handler='handlers.migration.SplitIndexRegion',
+          name='split_index_region')
 ]
 
 app = webapp2.WSGIApplication(routes, debug=DEBUG)
@@ -2,6 +2,8 @@ from google.appengine.ext import ndb
 
 
 class User(ndb.Model):
+    # Users are keyed by their login, see key_for().
+
     # The type of login being used. Currently, only 'facebook' is allowed.
     login_type = ndb.StringProperty(required=True)
 
@@ -16,15 +18,48 @@ class User(ndb.Model):
     # items.
     distance_radius_km = ndb.IntegerProperty(default=10, indexed=False)
 
-    # All the currently-live items that the user has seen.
-    seen_item_ids = ndb.IntegerProperty(repeated=True)
+    # Deprecated: the items that the user has seen are stored in SeenItems
+    # entities instead. This is only read to seed the user's first SeenItems
+    # shard, at which point it is cleared.
+    seen_item_ids = ndb.IntegerProperty(repeated=True, indexed=False)
 
-    # All the ongoing conversations that this user is part of.
+    # Deprecated: the ids of the conversations that this user was part of
+    # before conversations were keyed by their participants. See
+    # conversation_keys.
     ongoing_conversations = ndb.IntegerProperty(repeated=True)
 
-    # The last time this user pinged for status.
+    # The keys of all the ongoing conversations that this user is part of.
+    conversation_keys = ndb.KeyProperty('Conversation', repeated=True,
+                                        indexed=False)
+
+    # Deprecated: the last time this user pinged for status, before that was
+    # stored in UpdatesWatermark. Only read for users without a watermark.
     last_active = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
 
+    @classmethod
+    def key_for(cls, login_type, third_party_id):
+        """Return the key of the user with the given third-party login.
+
+        Args:
+          login_type: The type of login, e.g. 'facebook'.
+          third_party_id: The user's ID in the third-party login system.
+        Returns:
+          The ndb.Key for the user.
+        """
+        return ndb.Key(cls, '{}:{}'.format(login_type, third_party_id))
+
+
+class SeenItems(ndb.Model):
+    # A shard of the set of currently-live items that a user has seen. These
+    # are children of the User, with ids 1, 2, ... up to the num_shards value
+    # of the first shard. See seen_items.py.
+
+    # The sorted item ids, packed by seen_set.SeenSet.
+    item_ids = ndb.BlobProperty()
+
+    # The number of shards for this user. Only meaningful in the first shard.
+    num_shards = ndb.IntegerProperty(default=1, indexed=False)
+
 
 class Image(ndb.Model):
     # The key for the actual image data in Blobstore.
@@ -47,8 +82,34 @@ class Item(ndb.Model):
     # The list of images associated to this item. Limited to 5 in the app.
     image = ndb.StructuredProperty(Image, repeated=True, indexed=False)
 
+    # Whether this item was deleted. Deleted items are kept around as
+    # tombstones while the rest of their data is deleted in the background.
+    deleted = ndb.BooleanProperty(default=False, indexed=False)
+
+    # Where the item is, which decides the search index of its document.
+    # Items that were posted before documents were split by region don't
+    # have this until their documents are moved, see item_search.py.
+    location = ndb.GeoPtProperty(indexed=False)
+
+    # The fields of the item's search document, as for
+    # item_search.build_document(), so that listed items can be read in one
+    # batch rather than document by document. Items that were posted before
+    # this was added only have their fields in their search documents.
+    document = ndb.JsonProperty(indexed=False)
+
+
+class DeletedItem(ndb.Model):
+    # The log of recently deleted items, keyed by the item id. Entries are
+    # removed along with the item's tombstone, see item_deletion.py.
+
+    # The time/date that the item was deleted.
+    delete_date = ndb.DateTimeProperty(auto_now_add=True, indexed=True)
+
 
 class LikeState(ndb.Model):
+    # Like states are children of the user, keyed by the item id, see
+    # key_for().
+
     # The user that liked/disliked the item.
     user_key = ndb.KeyProperty(User, indexed=True)
 
@@ -58,8 +119,23 @@ class LikeState(ndb.Model):
     # Whether or not this is a like or dislike.
     like_state = ndb.BooleanProperty(indexed=True)
 
+    @classmethod
+    def key_for(cls, user_key, item_id):
+        """Return the key of a user's like state for an item.
+
+        Args:
+          user_key: The key of the user.
+          item_id: The id of the item.
+        Returns:
+          The ndb.Key for the like state.
+        """
+        return ndb.Key(cls, item_id, parent=user_key)
+
 
 class Message(ndb.Model):
+    # Messages are children of their Conversation, keyed by their position in
+    # it, starting at 1. See key_for().
+
     # The key for the user that sent this message.
     user_key = ndb.KeyProperty(User, indexed=True)
 
@@ -73,16 +149,170 @@ class Message(ndb.Model):
     # The time/date that this message was created.
     create_date = ndb.DateTimeProperty(auto_now_add=True, indexed=True)
 
+    @classmethod
+    def key_for(cls, conversation_key, position):
+        """Return the key of the message at a position in a conversation.
+
+        Args:
+          conversation_key: The key of the conversation.
+          position: The 1-based position of the message.
+        Returns:
+          The ndb.Key for the message.
+        """
+        return ndb.Key(cls, position, parent=conversation_key)
+
 
 class Conversation(ndb.Model):
+    # Conversations are keyed by the item and the buyer, see key_for().
+
     # The key for the item this conversation corresponds to.
     item_key = ndb.KeyProperty(Item, indexed=True)
 
     # The key for the user that wants to buy the item.
     buyer_key = ndb.KeyProperty(User, indexed=True)
 
-    # The ordered list of messages in this conversation.
-    messages = ndb.StructuredProperty(Message, repeated=True, indexed=False)
+    # Deprecated: the messages are stored as child Message entities instead.
+    # This is only set on conversations that haven't been migrated yet.
+    legacy_messages = ndb.StructuredProperty(Message, repeated=True,
+                                             indexed=False, name='messages')
+
+    # The number of messages in this conversation.
+    message_count = ndb.IntegerProperty(default=0, indexed=False)
+
+    # The contents of the last message in this conversation.
+    last_message = ndb.TextProperty()
 
     # The last time anything happened in this conversation.
     last_activity_date = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, item_key, buyer_key):
+        """Return the key of the conversation between a buyer and a seller.
+
+        Since the seller is determined by the item, there is at most one
+        conversation per item and buyer.
+
+        Args:
+          item_key: The key of the item.
+          buyer_key: The key of the user that wants to buy the item.
+        Returns:
+          The ndb.Key for the conversation.
+        """
+        return ndb.Key(cls, '{}:{}'.format(item_key.id(), buyer_key.id()))
+
+
+class UpdatesWatermark(ndb.Model):
+    # The point up to which a user's clients have received their updates,
+    # keyed by the id of the user's key. This is kept apart from the User so
+    # that polling doesn't rewrite the User or contend with its entity group.
+
+    # The last time this user pinged for status and got everything up to it.
+    last_active = ndb.DateTimeProperty(indexed=False)
+
+    # The position in the user's inbox up to which deleted items were
+    # reported, for clients that don't pass a cursor. This is None for
+    # watermarks that predate it, which are caught up from the deletion log.
+    inbox_cursor = ndb.IntegerProperty(indexed=False)
+
+
+class Inbox(ndb.Model):
+    # The change feed of a user, keyed by the id of the user's key. This is a
+    # root entity, so that writing to it doesn't contend with the user's own
+    # entity group. See inbox.py.
+
+    # The sequence number of the last event in the inbox.
+    last_sequence = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class InboxEvent(ndb.Model):
+    # Events are children of the Inbox, keyed by their sequence number,
+    # starting at 1.
+
+    # The type of the event, one of the event types in inbox.py.
+    type = ndb.StringProperty(indexed=False)
+
+    # The item that the event is about.
+    item_id = ndb.IntegerProperty(indexed=False)
+
+    # For new messages, a copy of the message.
+    message = ndb.StructuredProperty(Message, indexed=False)
+
+
+class LikeCounterShard(ndb.Model):
+    # A shard of the number of likes of an item, keyed by the item id and the
+    # shard number. See like_counter.py.
+
+    # The id of the item.
+    item_id = ndb.IntegerProperty(indexed=False)
+
+    # The number of likes counted in this shard.
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+    # The number of times the count was changed. Unlike the count, this never
+    # comes back to a previous value, so it tells whether the shard changed.
+    num_increments = ndb.IntegerProperty(default=0, indexed=False)
+
+    # Whether the count changed since it was last folded into the item's
+    # search document.
+    dirty = ndb.BooleanProperty(default=False, indexed=True)
+
+
+class CandidateFeed(ndb.Model):
+    # The items that are queued up to be listed for a user, keyed by the id
+    # of the user's key. See candidate_feed.py.
+
+    # The geohash of the search area cell that the feed was built for.
+    cell = ndb.StringProperty(indexed=False)
+
+    # The search radius of the user when the feed was built.
+    radius_km = ndb.IntegerProperty(indexed=False)
+
+    # The queued items, as the dictionaries that handlers.item.List returns,
+    # in the order that they were found in.
+    candidates = ndb.JsonProperty(compressed=True)
+
+    # The web-safe cursor of the search results after the queued items, or
+    # None if the search was exhausted.
+    cursor = ndb.StringProperty(indexed=False)
+
+    # The number of times the feed was refilled. Refill tasks are named after
+    # it, so that the feed is only refilled once at a time.
+    generation = ndb.IntegerProperty(default=0, indexed=False)
+
+    # When the feed was first searched. Stale feeds are built again, so that
+    # they pick up new items.
+    create_date = ndb.DateTimeProperty(indexed=False)
+
+
+class IndexRoute(ndb.Model):
+    # How the search documents of the items in a geohash cell are split
+    # across search indexes, keyed by the name of the cell's index. The routes
+    # of all the cells are children of the route of the whole world, whose
+    # index is the original constants.ITEM_INDEX_NAME. See item_search.py.
+
+    # Whether new documents in the cell go to the indexes of its subcells.
+    split = ndb.BooleanProperty(default=False, indexed=False)
+
+    # When the cell was split.
+    split_date = ndb.DateTimeProperty(indexed=False)
+
+    # Whether all the documents in the cell's own index were moved to the
+    # indexes of its subcells, so that it doesn't need to be searched.
+    moved = ndb.BooleanProperty(default=False, indexed=False)
+
+
+class PendingDocument(ndb.Model):
+    # The search document of an item that is waiting to be indexed. It is
+    # stored along with the item, as its only child, see key_for() and
+    # index_outbox.py.
+
+    # The fields of the document, see item_search.build_document().
+    document = ndb.JsonProperty()
+
+    # When the item was posted. Documents are indexed in this order.
+    create_date = ndb.DateTimeProperty(auto_now_add=True, indexed=True)
+
+    @classmethod
+    def key_for(cls, item_key):
+        """Return the key of the pending search document of an item."""
+        return ndb.Key(cls, 1, parent=item_key)
@@ -0,0 +1,119 @@
+import collections
+import threading
+import time
+
+import constants
+import stats
+import update_versions
+
+
+class Notifier(object):
+    """Wakes up the /updates requests that are waiting on users.
+
+    A user's clients can hang on /updates until something happens for the
+    user. Whatever makes something happen calls notify(), and the waiting
+    requests call wait(). Both rely on the users' version counters, see
+    update_versions.py.
+
+    This one polls the version counters in memcache, which works across
+    instances, at the cost of a memcache read every
+    constants.NOTIFIER_POLL_INTERVAL_SECONDS for each waiting request.
+
+    A waiting request holds a request thread, so only
+    constants.MAX_WAITING_UPDATES_REQUESTS of them wait at the same time in
+    each process. The others return right away, and their clients poll
+    again.
+    """
+    def __init__(self):
+        self._waiting = threading.BoundedSemaphore(
+            constants.MAX_WAITING_UPDATES_REQUESTS)
+
+    def notify(self, user_keys):
+        """Let the waiting requests of users know that something happened.
+
+        This must be called after the new data is stored.
+
+        Args:
+          user_keys: The keys of the users.
+        """
+        update_versions.bump(user_keys)
+
+    def wait(self, user_key, version, timeout):
+        """Wait until the version of a user moves past a given one.
+
+        Args:
+          user_key: The key of the user.
+          version: The version that the caller already has.
+          timeout: The maximum number of seconds to wait.
+        Returns:
+          True if the version changed, False if the wait timed out, or if
+          too many requests are waiting already.
+        """
+        if not self._waiting.acquire(False):
+            stats.increment('updates.wait_rejected')
+            return False
+        try:
+            return self._wait(user_key, version, timeout)
+        finally:
+            self._waiting.release()
+
+    def _wait(self, user_key, version, timeout):
+        deadline = time.time() + timeout
+        while True:
+            if update_versions.peek(user_key) != version:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(remaining,
+                           constants.NOTIFIER_POLL_INTERVAL_SECONDS))
+
+
+class InProcessNotifier(Notifier):
+    """A Notifier that only wakes up requests in the same process.
+
+    This is meant for tests and the development server, where everything runs
+    in a single process.
+    """
+    def __init__(self):
+        super(InProcessNotifier, self).__init__()
+        self._condition = threading.Condition()
+        self._generations = collections.defaultdict(int)
+
+    def notify(self, user_keys):
+        super(InProcessNotifier, self).notify(user_keys)
+        with self._condition:
+            for user_key in user_keys:
+                self._generations[user_key] += 1
+            self._condition.notify_all()
+
+    def _wait(self, user_key, version, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            generation = self._generations[user_key]
+        # The version is read without holding the lock, which would hold up
+        # every other waiting request for the memcache call. A notify() in
+        # the meantime still moves the generation.
+        if update_versions.peek(user_key) != version:
+            return True
+        with self._condition:
+            while self._generations[user_key] == generation:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+
+_notifier = Notifier()
+
+
+def get():
+    """Return the Notifier in use."""
+    return _notifier
+
+
+def set_notifier(notifier):
+    """Replace the Notifier in use, e.g. with an InProcessNotifier in tests."""
+    global _notifier
+    _notifier = notifier
@@ -0,0 +1,341 @@
+import base64
+import collections
+import heapq
+import re
+
+from google.appengine.api import search
+from webapp2_extras import json
+
+import geohash
+
+
+class SearchBackend(object):
+    """Provides the indexes that the search documents of the items are in.
+
+    This one uses the App Engine Search API. Other backends override
+    get_index() to return objects with the subset of the search.Index
+    interface that the handlers need: put(), get(), delete(), get_range(),
+    search() and search_async(). Documents, queries and results are the
+    Search API's own classes, whatever the backend.
+    """
+    def get_index(self, name):
+        """Return an index.
+
+        Args:
+          name: The name of the index.
+        """
+        return search.Index(name=name)
+
+
+class InMemorySearchBackend(SearchBackend):
+    """A SearchBackend that keeps the indexes in the memory of the process.
+
+    This is meant for tests and benchmarks, where the number of documents
+    shouldn't be limited by the Search API stub, which scans every document
+    for every query. See InMemoryIndex for the queries that it supports.
+    """
+    def __init__(self):
+        self._indexes = {}
+
+    def get_index(self, name):
+        if name not in self._indexes:
+            self._indexes[name] = InMemoryIndex(name)
+        return self._indexes[name]
+
+
+# The precision of the geohash cells that InMemoryIndex buckets the
+# locations of the documents by. The cells are about 39km by 20km.
+_GRID_PRECISION = 4
+
+# Circles larger than this cover too many cells to look them up one by one,
+# so every document is checked instead.
+_MAX_GRID_RADIUS_KM = 1000
+
+_DISTANCE_RE = re.compile(
+    r'^distance\((\w+), geopoint\(([-+.\deE]+), ([-+.\deE]+)\)\) < '
+    r'([-+.\deE]+)$')
+# Values may be quoted, as in NOT user_id="facebook:1".
+_NOT_EQUALS_RE = re.compile(r'^NOT (\w+)[:=]"?([^"\s]+)"?$')
+_EQUALS_RE = re.compile(r'^(\w+)[:=]"?([^"\s]+)"?$')
+_TERMS_RE = re.compile(r'^~?\w+( ~?\w+)*$')
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# The suffixes that _stem() removes, longest first.
+_SUFFIXES = ('ing', 'ed', 's')
+
+
+def _tokenize(text):
+    return _WORD_RE.findall(unicode(text).lower())
+
+
+def _stem(word):
+    """Reduce a lowercase word to its stem, roughly."""
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+class _Future(object):
+    """The result of a search that already ran, like search_async()'s."""
+    def __init__(self, function, *args):
+        self._result = None
+        self._error = None
+        try:
+            self._result = function(*args)
+        except search.Error as e:
+            self._error = e
+
+    def get_result(self):
+        if self._error:
+            raise self._error
+        return self._result
+
+
+class InMemoryIndex(object):
+    """An index that searches its documents in the memory of the process.
+
+    Only the queries that the handlers build are supported: clauses joined
+    by AND, where each clause is one of
+
+      distance(<geo field>, geopoint(<lat>, <lng>)) < <meters>
+      <field>=<value>
+      NOT <field>=<value>
+      <term> ~<stemmed term> ...
+
+    The locations of the documents are bucketed by geohash cells, so that a
+    distance clause only looks at the documents in the cells that the circle
+    covers, and there is an inverted index from the words of the fields to
+    the documents.
+
+    Results are ordered by the sort expressions of the query, which must be
+    numeric fields, and then by rank, both descending unless the direction
+    says otherwise.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._documents = {}
+        # (field name, geohash cell) -> doc ids.
+        self._cells = collections.defaultdict(set)
+        # (field name, lowercase value or word) -> doc ids.
+        self._values = collections.defaultdict(set)
+        # Word -> doc ids, from all the text fields.
+        self._words = collections.defaultdict(set)
+        # Stemmed word -> doc ids, from all the text fields.
+        self._stems = collections.defaultdict(set)
+
+    def _postings(self, document):
+        """Yield the posting lists that a document belongs in."""
+        for field in document.fields:
+            if isinstance(field, search.GeoField):
+                yield self._cells[(field.name, geohash.encode(
+                    field.value.latitude, field.value.longitude,
+                    _GRID_PRECISION))]
+            elif isinstance(field, search.AtomField):
+                yield self._values[(field.name,
+                                    unicode(field.value or '').lower())]
+            elif isinstance(field, (search.TextField, search.HtmlField)):
+                for word in set(_tokenize(field.value or '')):
+                    yield self._values[(field.name, word)]
+                    yield self._words[word]
+                    yield self._stems[_stem(word)]
+
+    def put(self, documents):
+        """Index documents, replacing the ones with the same ids."""
+        if isinstance(documents, search.Document):
+            documents = [documents]
+        if len(documents) > search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST:
+            raise ValueError('too many documents to index')
+        for document in documents:
+            self.delete(document.doc_id)
+            self._documents[document.doc_id] = document
+            for postings in self._postings(document):
+                postings.add(document.doc_id)
+
+    def get(self, doc_id):
+        """Return the document with an id, or None if there isn't one."""
+        return self._documents.get(doc_id)
+
+    def delete(self, doc_ids):
+        """Remove documents, ignoring the ids that aren't indexed."""
+        if isinstance(doc_ids, basestring):
+            doc_ids = [doc_ids]
+        for doc_id in doc_ids:
+            document = self._documents.pop(doc_id, None)
+            if document:
+                for postings in self._postings(document):
+                    postings.discard(doc_id)
+
+    def get_range(self, start_id=None, include_start_object=True, limit=100):
+        """Return documents in the order of their ids.
+
+        Returns:
+          A search.GetResponse.
+        """
+        doc_ids = sorted(self._documents)
+        if start_id is not None:
+            doc_ids = [i for i in doc_ids if i > start_id or
+                       (include_start_object and i == start_id)]
+        return search.GetResponse(
+            results=[self._documents[i] for i in doc_ids[:limit]])
+
+    def search_async(self, query):
+        """Search the index. The search runs before this returns."""
+        return _Future(self.search, query)
+
+    def search(self, query):
+        """Search the index.
+
+        Args:
+          query: The search.Query, or a query string.
+        Returns:
+          The search.SearchResults.
+        """
+        if isinstance(query, basestring):
+            query = search.Query(query)
+        options = query.options or search.QueryOptions()
+        limit = options.limit or 20
+
+        doc_ids, filters = self._parse(query.query_string)
+        sort_key = self._sort_key_function(options.sort_options)
+        matches = [(sort_key(d), d)
+                   for d in (self._documents[i] for i in doc_ids)
+                   if all(f(d) for f in filters)]
+        number_found = len(matches)
+
+        web_safe_string = options.cursor and options.cursor.web_safe_string
+        if web_safe_string:
+            # Continue after the result that the cursor was made for.
+            after = self._decode_cursor(web_safe_string)
+            matches = [m for m in matches if m[0] < after]
+        page = heapq.nlargest(limit + 1, matches, key=lambda m: m[0])
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        per_result = options.cursor and options.cursor.per_result
+        results = []
+        for key, document in page:
+            fields = document.fields
+            if options.returned_fields:
+                fields = [f for f in fields
+                          if f.name in options.returned_fields]
+            cursor = None
+            if per_result:
+                cursor = self._encode_cursor(key, per_result)
+            results.append(search.ScoredDocument(
+                doc_id=document.doc_id, fields=fields,
+                language=document.language, rank=document.rank,
+                cursor=cursor))
+        cursor = None
+        if has_more and not per_result:
+            cursor = self._encode_cursor(page[-1][0], per_result)
+        return search.SearchResults(number_found=number_found,
+                                    results=results, cursor=cursor)
+
+    def _parse(self, query_string):
+        """Parse a query string.
+
+        Returns:
+          A (doc_ids, filters) pair, where the doc ids are the candidates
+          for the results, and the filters are the functions that the
+          candidate documents have to pass.
+        """
+        candidates = []
+        filters = []
+        clauses = query_string.split(' AND ') if query_string.strip() else []
+        for clause in clauses:
+            clause = clause.strip()
+            match = _DISTANCE_RE.match(clause)
+            if match:
+                name = match.group(1)
+                lat, lng, meters = [float(g) for g in match.group(2, 3, 4)]
+                if meters / 1000 <= _MAX_GRID_RADIUS_KM:
+                    cells = geohash.covering(lat, lng, meters / 1000,
+                                             _GRID_PRECISION)
+                    candidates.append(set().union(
+                        *[self._cells.get((name, c), ()) for c in cells]))
+                filters.append(self._distance_filter(name, lat, lng, meters))
+                continue
+            match = _NOT_EQUALS_RE.match(clause)
+            if match:
+                excluded = self._values.get(
+                    (match.group(1), match.group(2).lower()), set())
+                filters.append(lambda d, e=excluded: d.doc_id not in e)
+                continue
+            match = _EQUALS_RE.match(clause)
+            if match:
+                candidates.append(self._values.get(
+                    (match.group(1), match.group(2).lower()), set()))
+                continue
+            if _TERMS_RE.match(clause):
+                for term in clause.lower().split():
+                    if term.startswith('~'):
+                        candidates.append(
+                            self._stems.get(_stem(term[1:]), set()))
+                    else:
+                        candidates.append(self._words.get(term, set()))
+                continue
+            raise search.QueryError(
+                'Unsupported query clause: {}'.format(clause))
+
+        if not candidates:
+            return set(self._documents), filters
+        candidates.sort(key=len)
+        return candidates[0].intersection(*candidates[1:]), filters
+
+    @staticmethod
+    def _distance_filter(name, lat, lng, meters):
+        def within(document):
+            fields = document[name]
+            return bool(fields) and geohash.distance_km(
+                lat, lng, fields[0].value.latitude,
+                fields[0].value.longitude) * 1000 < meters
+        return within
+
+    @staticmethod
+    def _sort_key_function(sort_options):
+        """Return the function that orders the results, largest first."""
+        expressions = sort_options.expressions if sort_options else []
+
+        def sort_key(document):
+            key = []
+            for expression in expressions:
+                fields = document[expression.expression]
+                value = (fields[0].value if fields
+                         else expression.default_value)
+                if expression.direction == search.SortExpression.ASCENDING:
+                    value = -value
+                key.append(value)
+            key.append(document.rank)
+            key.append(document.doc_id)
+            return tuple(key)
+        return sort_key
+
+    @staticmethod
+    def _encode_cursor(key, per_result):
+        return search.Cursor(
+            web_safe_string='{}:{}'.format(
+                per_result, base64.urlsafe_b64encode(json.encode(key))),
+            per_result=per_result)
+
+    @staticmethod
+    def _decode_cursor(web_safe_string):
+        try:
+            return tuple(json.decode(base64.urlsafe_b64decode(
+                str(web_safe_string.split(':', 1)[-1]))))
+        except (TypeError, ValueError):
+            raise search.InvalidRequest('Invalid cursor')
+
+
+_backend = SearchBackend()
+
+
+def get():
+    """Return the SearchBackend in use."""
+    return _backend
+
+
+def set_backend(backend):
+    """Replace the SearchBackend in use, e.g. with an InMemorySearchBackend."""
+    global _backend
+    _backend = backend
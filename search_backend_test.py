@@ -0,0 +1,115 @@
+from google.appengine.api import search
+import unittest
+
+import constants
+import item_search
+import search_backend
+
+
+class InMemoryIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = search_backend.InMemorySearchBackend().get_index('items')
+
+    def put(self, doc_id, lat, lng, rank, user_id='1', category='other',
+            title='title', like_count=None):
+        fields = [search.AtomField(name='user_id', value=user_id),
+                  search.AtomField(name='category', value=category),
+                  search.TextField(name='title', value=title),
+                  search.GeoField(name='location',
+                                  value=search.GeoPoint(lat, lng))]
+        if like_count is not None:
+            fields.append(search.NumberField(
+                name=item_search.LIKE_COUNT_FIELD, value=like_count))
+        self.index.put(search.Document(doc_id=doc_id, fields=fields,
+                                       rank=rank))
+
+    def search(self, query, sort_options=None, limit=20, cursor=None):
+        results = self.index.search(search.Query(
+            query, options=search.QueryOptions(
+                limit=limit, sort_options=sort_options,
+                cursor=search.Cursor(web_safe_string=cursor,
+                                     per_result=True)))).results
+        return [r.doc_id for r in results], results
+
+    def test_distance(self):
+        self.put('near', 0, 0.05, 1)
+        self.put('far', 0, 0.5, 2)
+        # Just across the antimeridian.
+        self.put('across', 0, -179.98, 3)
+        doc_ids, _ = self.search(item_search.build_query(0, 0, 10))
+        self.assertListEqual(['near'], doc_ids)
+        doc_ids, _ = self.search(item_search.build_query(0, 0, 100))
+        self.assertListEqual(['far', 'near'], doc_ids)
+        doc_ids, _ = self.search(item_search.build_query(0, 179.98, 10))
+        self.assertListEqual(['across'], doc_ids)
+
+    def test_category_and_terms(self):
+        self.put('a', 0, 0, 1, category='books', title='Old running shoes')
+        self.put('b', 0, 0, 2, category='other', title='Running shoe')
+        self.put('c', 0, 0, 3, category='books', title='A book')
+        query = item_search.build_query(0, 0, 10, category='books')
+        self.assertListEqual(['c', 'a'], self.search(query)[0])
+        query = item_search.build_query(0, 0, 10,
+                                        search_terms=['shoes', 'running'])
+        self.assertListEqual(['b', 'a'], self.search(query)[0])
+        self.assertListEqual(['b'], self.search('shoe')[0])
+        query = item_search.build_query(0, 0, 10, category='other',
+                                        search_terms=['old'])
+        self.assertListEqual([], self.search(query)[0])
+
+    def test_not_user_id(self):
+        self.put('a', 0, 0, 1, user_id='1')
+        self.put('b', 0, 0, 2, user_id='2')
+        self.assertListEqual(['a'], self.search('NOT user_id=2')[0])
+
+    def test_quoted_values(self):
+        self.put('a', 0, 0, 1, user_id='facebook:1')
+        self.put('b', 0, 0, 2, user_id='facebook:2')
+        self.assertListEqual(['a'],
+                             self.search('NOT user_id="facebook:2"')[0])
+        self.assertListEqual(['b'], self.search('user_id="facebook:2"')[0])
+
+    def test_unsupported_query(self):
+        self.assertRaises(search.QueryError, self.index.search,
+                          'price > 10')
+
+    def test_popular(self):
+        self.put('a', 0, 0, 1, like_count=5)
+        self.put('b', 0, 0, 2, like_count=1)
+        self.put('c', 0, 0, 3)
+        self.put('d', 0, 0, 4, like_count=5)
+        sort_options = item_search.build_sort_options(
+            constants.RETRIEVAL_POPULAR)
+        doc_ids, _ = self.search(item_search.build_query(0, 0, 10),
+                                 sort_options=sort_options)
+        self.assertListEqual(['d', 'a', 'b', 'c'], doc_ids)
+
+    def test_cursors(self):
+        for i in range(5):
+            self.put(str(i), 0, 0, i + 1)
+        query = item_search.build_query(0, 0, 10)
+        doc_ids, results = self.search(query, limit=2)
+        self.assertListEqual(['4', '3'], doc_ids)
+        # Documents that are added before the cursor don't show up.
+        self.put('5', 0, 0, 6)
+        doc_ids, results = self.search(
+            query, limit=2, cursor=results[0].cursor.web_safe_string)
+        self.assertListEqual(['3', '2'], doc_ids)
+        doc_ids, _ = self.search(query,
+                                 cursor=results[1].cursor.web_safe_string)
+        self.assertListEqual(['1', '0'], doc_ids)
+
+    def test_put_and_delete(self):
+        self.put('a', 0, 0, 1, title='first')
+        self.put('a', 0, 0, 1, title='second')
+        self.assertEqual('second', self.index.get('a').field('title').value)
+        self.assertListEqual([], self.search('first')[0])
+        self.assertListEqual(['a'], self.search('second')[0])
+        self.put('b', 0, 0, 2)
+        self.assertListEqual(
+            ['b'], [d.doc_id for d in self.index.get_range(
+                start_id='a', include_start_object=False).results])
+        self.index.delete(['a', 'b'])
+        self.assertIsNone(self.index.get('a'))
+        self.assertListEqual([], self.index.get_range().results)
+        self.assertListEqual([], self.search('title')[0])
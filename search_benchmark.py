@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Benchmarks the item searches of /item/list on the in-process engine.
+
+The App Engine SDK must be on the PYTHONPATH. For example:
+
+  ./search_benchmark.py --items=100000,1000000 --queries=200
+
+Items are spread uniformly over an area about the size of Switzerland, and
+the searches are the ones that /item/list runs for a page of items, built by
+item_search.build_query(). Only the search itself is timed: the handler's
+datastore and memcache calls need the App Engine stubs.
+"""
+import getopt
+import random
+import sys
+import time
+
+from google.appengine.api import search
+
+import constants
+import item_search
+import search_backend
+
+
+_SOUTH, _NORTH = 45.8, 47.8
+_WEST, _EAST = 6.0, 10.5
+_CATEGORIES = ['books', 'clothing', 'electronics', 'furniture', 'other']
+_WORDS = ['chair', 'table', 'sofa', 'lamp', 'bike', 'phone', 'jacket',
+          'shoes', 'novel', 'camera', 'grey', 'red', 'old', 'new', 'large',
+          'small', 'wooden', 'leather', 'running', 'vintage']
+
+
+def _random_point():
+    return random.uniform(_SOUTH, _NORTH), random.uniform(_WEST, _EAST)
+
+
+def fill(index, num_items):
+    """Index random items.
+
+    Returns:
+      The number of seconds that it took.
+    """
+    start = time.time()
+    for batch_start in range(0, num_items, constants.MAX_DOCUMENTS_PER_PUT):
+        documents = []
+        for i in range(batch_start, min(
+                num_items, batch_start + constants.MAX_DOCUMENTS_PER_PUT)):
+            lat, lng = _random_point()
+            documents.append(search.Document(
+                doc_id=str(i + 1),
+                fields=[
+                    search.AtomField(name='user_id',
+                                     value=str(random.randint(1, 10000))),
+                    search.AtomField(name='category',
+                                     value=random.choice(_CATEGORIES)),
+                    search.TextField(name='title', value=' '.join(
+                        random.sample(_WORDS, 3))),
+                    search.NumberField(name='price',
+                                       value=random.randint(1, 1000)),
+                    search.GeoField(name='location',
+                                    value=search.GeoPoint(lat, lng)),
+                    search.NumberField(name=item_search.LIKE_COUNT_FIELD,
+                                       value=random.randint(0, 100))],
+                rank=i + 1))
+        index.put(documents)
+    return time.time() - start
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * fraction))]
+
+
+def run(index, num_queries, radius_km, category=False, search_terms=False,
+        retrieval=constants.RETRIEVAL_NEARBY):
+    """Time random searches for the first two pages of items.
+
+    Returns:
+      The sorted list of the latencies, in seconds.
+    """
+    latencies = []
+    for _ in range(num_queries):
+        lat, lng = _random_point()
+        query = item_search.build_query(
+            lat, lng, radius_km,
+            random.choice(_CATEGORIES) if category else None,
+            sorted(random.sample(_WORDS, 1)) if search_terms else ())
+        cursor = None
+        for _ in range(2):
+            start = time.time()
+            results = index.search(search.Query(
+                query, options=search.QueryOptions(
+                    limit=constants.NUM_ITEMS_PER_PAGE,
+                    cursor=search.Cursor(web_safe_string=cursor,
+                                         per_result=True),
+                    sort_options=item_search.build_sort_options(retrieval),
+                    returned_fields=['user_id', 'location']))).results
+            latencies.append(time.time() - start)
+            if not results:
+                break
+            cursor = results[-1].cursor.web_safe_string
+    return sorted(latencies)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    opts, args = getopt.getopt(argv[1:], '',
+                               ['items=', 'queries=', 'radius_km='])
+    opts = dict([(k.lstrip('--'), v) for (k, v) in opts])
+    sizes = [int(n) for n in opts.get('items', '100000,1000000').split(',')]
+    num_queries = int(opts.get('queries', 200))
+    radius_km = float(opts.get('radius_km', 10))
+
+    random.seed(0)
+    for num_items in sizes:
+        index = search_backend.InMemorySearchBackend().get_index('items')
+        elapsed = fill(index, num_items)
+        print '{} items indexed in {:.1f}s'.format(num_items, elapsed)
+        for name, kwargs in [
+                ('nearby', {}),
+                ('category', {'category': True}),
+                ('terms', {'search_terms': True}),
+                ('popular', {'retrieval': constants.RETRIEVAL_POPULAR})]:
+            latencies = run(index, num_queries, radius_km, **kwargs)
+            print '  {:<10} p50 {:.2f}ms, p95 {:.2f}ms, p99 {:.2f}ms'.format(
+                name, *[_percentile(latencies, f) * 1000
+                        for f in (0.5, 0.95, 0.99)])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+import hashlib
+import math
+import time
+
+from google.appengine.api import memcache
+
+import constants
+import geohash
+
+# Pages of item search results, and the items found in them, are shared by
+# all the users searching around the same geohash cell, in memcache. Cells are
+# picked to be small next to the search radius, so that the searched area
+# isn't much larger than the users' own. The cached searches of a cell are
+# invalidated through a larger cell that contains it, whose 8 neighbours
+# cover the searched area, so that an item can only show up in the searches
+# invalidated through its own cell and the 8 cells around it. Those are
+# invalidated whenever the item changes, by bumping their generation
+# counters, which are part of the keys of the cached pages and items.
+_PAGE_KEY_PREFIX = 'item_search_page:'
+_ITEM_KEY_PREFIX = 'item_search_item:'
+_GENERATION_KEY_PREFIX = 'item_search_generation:'
+
+# The most precise cells that are used.
+_MAX_PRECISION = 5
+
+# The most that the search radius is widened by, relative to the users'
+# radius, when the cells are small enough for it. Small radiuses are widened
+# by more, since cells finer than _MAX_PRECISION aren't used.
+_MAX_WIDENING = 0.5
+
+
+def _half_diagonal_km(precision, lat):
+    return math.hypot(*geohash.cell_size_km(precision, lat)) / 2
+
+
+class SearchArea(object):
+    """The cell-aligned area that is searched for a user.
+
+    Attributes:
+      cell: The geohash of the cell that the user is in.
+      lat, lng: The center of the cell.
+      radius_km: The radius around the center of the cell that covers the
+        user's search radius from anywhere in the cell.
+      generation_cell: The geohash of the smallest cell that contains the
+        cell, and whose 3x3 neighbourhood covers the area, or '' for areas
+        that no cell's neighbourhood covers. The cached searches of the area
+        are invalidated through it.
+    """
+    def __init__(self, lat, lng, radius_km):
+        # Use the largest cells that widen the search by little enough.
+        precision = _MAX_PRECISION
+        for p in range(1, _MAX_PRECISION + 1):
+            if _half_diagonal_km(p, lat) <= radius_km * _MAX_WIDENING:
+                precision = p
+                break
+        self.cell = geohash.encode(lat, lng, precision)
+        self.lat, self.lng = geohash.decode(self.cell)
+        self.radius_km = radius_km + _half_diagonal_km(precision, self.lat)
+
+        # Any point of a cell is at least the cell's height and width away
+        # from the far side of its neighbours.
+        self.generation_cell = ''
+        for p in range(precision, 0, -1):
+            if min(geohash.cell_size_km(p, self.lat)) >= self.radius_km:
+                self.generation_cell = self.cell[:p]
+                break
+
+
+def _now_micros():
+    return int(time.time() * 1000000)
+
+
+def _get_generation(cell):
+    """Return the generation counter of a cell, starting it if needed."""
+    key = _GENERATION_KEY_PREFIX + cell
+    generation = memcache.get(key)
+    if generation is None:
+        # Start from the current time, so that a counter that was evicted
+        # and started again doesn't go back to an old generation.
+        memcache.add(key, _now_micros())
+        generation = memcache.get(key)
+    return generation
+
+
+def page_key(area, category, search_terms, retrieval, cursor):
+    """Return the cache key of a page of search results.
+
+    The key must be taken before searching, so that a page that was searched
+    before an invalidation isn't cached under the new generation.
+
+    Args:
+      area: The SearchArea that is searched.
+      category: The category that is searched, if any.
+      search_terms: The list of normalized search terms, if any.
+      retrieval: The constants.RETRIEVAL_* mode that orders the results.
+      cursor: The web-safe cursor of the page, or None for the first page.
+    Returns:
+      The key, or None if memcache is unavailable.
+    """
+    generation = _get_generation(area.generation_cell)
+    if generation is None:
+        return None
+    query_key = '|'.join([area.cell,
+                          str(generation),
+                          '{:.3f}'.format(area.radius_km),
+                          category or '',
+                          ' '.join(sorted(set(search_terms))),
+                          retrieval,
+                          cursor or ''])
+    return _PAGE_KEY_PREFIX + hashlib.sha1(query_key).hexdigest()
+
+
+def get_page(key):
+    """Return the cached page with a key from page_key(), or None."""
+    return memcache.get(key) if key else None
+
+
+def put_page(key, page):
+    """Cache a page with a key from page_key()."""
+    if key:
+        memcache.set(key, page, time=constants.SEARCH_CACHE_TTL_SECONDS)
+
+
+def item_keys(area, item_ids):
+    """Return the cache keys of the search documents of items in an area.
+
+    Like page_key(), the keys must be taken before reading the documents.
+
+    Args:
+      area: The SearchArea that the items were found in.
+      item_ids: The ids of the items, as strings.
+    Returns:
+      The list of keys, which are None if memcache is unavailable.
+    """
+    generation = _get_generation(area.generation_cell)
+    if generation is None:
+        return [None] * len(item_ids)
+    return ['{}{}:{}:{}'.format(_ITEM_KEY_PREFIX, area.cell, generation,
+                                item_id)
+            for item_id in item_ids]
+
+
+def get_items(keys):
+    """Return the cached items with keys from item_keys().
+
+    Returns:
+      A list with the cached values, or None for the ones that aren't cached.
+    """
+    cached = memcache.get_multi([key for key in keys if key])
+    return [cached.get(key) if key else None for key in keys]
+
+
+def put_items(items):
+    """Cache items, given as a dictionary from keys from item_keys()."""
+    items = dict((key, value) for key, value in items.iteritems() if key)
+    if items:
+        memcache.set_multi(items, time=constants.SEARCH_CACHE_TTL_SECONDS)
+
+
+def invalidate(lat, lng):
+    """Invalidate the cached searches that could have an item at a location.
+
+    This must be called after the item's search document changes.
+
+    Args:
+      lat: The latitude of the item.
+      lng: The longitude of the item.
+    """
+    # Searches too wide for any cell are invalidated through ''.
+    cells = set([''])
+    for precision in range(1, _MAX_PRECISION + 1):
+        cells.update(geohash.neighborhood(
+            geohash.encode(lat, lng, precision)))
+    memcache.offset_multi(dict((cell, 1) for cell in cells),
+                          key_prefix=_GENERATION_KEY_PREFIX,
+                          initial_value=_now_micros())
@@ -0,0 +1,50 @@
+import math
+import unittest
+
+import geohash
+import search_cache
+
+
+def _circle(lat, lng, radius_km, num_points=72):
+    """Yield points around a circle, roughly."""
+    km_per_degree = math.pi * 6371.0 / 180
+    for i in range(num_points):
+        angle = 2 * math.pi * i / num_points
+        yield (lat + radius_km * math.sin(angle) / km_per_degree,
+               lng + radius_km * math.cos(angle) /
+               (km_per_degree * math.cos(math.radians(lat))))
+
+
+class SearchAreaTest(unittest.TestCase):
+    def test_widening(self):
+        for lat in (0, 47, 60):
+            area = search_cache.SearchArea(lat, 8, 10)
+            self.assertLessEqual(area.radius_km, 15)
+            # The area covers the search radius from anywhere in the cell.
+            self.assertEqual(area.cell, geohash.encode(lat, 8,
+                                                       len(area.cell)))
+            self.assertGreaterEqual(
+                area.radius_km,
+                10 + geohash.distance_km(lat, 8, area.lat, area.lng))
+
+    def test_generation_cell_covers_area(self):
+        for lat in (0, 47, 60, -70):
+            for radius_km in (1, 5, 10, 50, 300, 2000):
+                area = search_cache.SearchArea(lat, 8, radius_km)
+                self.assertTrue(area.cell.startswith(area.generation_cell))
+                if not area.generation_cell:
+                    continue
+                neighborhood = geohash.neighborhood(area.generation_cell)
+                for point in _circle(area.lat, area.lng, area.radius_km):
+                    self.assertIn(
+                        geohash.encode(point[0], point[1],
+                                       len(area.generation_cell)),
+                        neighborhood)
+
+    def test_huge_radius(self):
+        area = search_cache.SearchArea(47, 8, 10000)
+        self.assertEqual('', area.generation_cell)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+from google.appengine.ext import ndb
+
+import constants
+import models
+import seen_set
+
+
+class SeenItemIds(object):
+    """The set of items that a user has seen, across all of their shards."""
+    def __init__(self, sets):
+        self._sets = sets
+
+    def __contains__(self, item_id):
+        return any(item_id in s for s in self._sets)
+
+    def __len__(self):
+        return sum(len(s) for s in self._sets)
+
+    def __iter__(self):
+        for s in self._sets:
+            for item_id in s:
+                yield item_id
+
+
+def _shard_key(user_key, shard_id):
+    return ndb.Key(models.SeenItems, shard_id, parent=user_key)
+
+
+@ndb.tasklet
+def _get_shards_async(user):
+    """Load all of a user's SeenItems shards.
+
+    If the user doesn't have any shards yet, this returns a new, unsaved first
+    shard seeded from the user's deprecated seen_item_ids list.
+    """
+    first_shard = yield _shard_key(user.key, 1).get_async()
+    if not first_shard:
+        first_shard = models.SeenItems(
+            key=_shard_key(user.key, 1),
+            item_ids=seen_set.SeenSet.from_ids(user.seen_item_ids).data)
+        raise ndb.Return([first_shard])
+
+    shards = [first_shard]
+    if first_shard.num_shards > 1:
+        other_shards = yield ndb.get_multi_async(
+            [_shard_key(user.key, i)
+             for i in range(2, first_shard.num_shards + 1)])
+        shards.extend(other_shards)
+    raise ndb.Return(shards)
+
+
+@ndb.tasklet
+def get_async(user):
+    """Load the set of items that a user has seen.
+
+    Args:
+      user: The models.User.
+    Returns:
+      A future for a SeenItemIds.
+    """
+    shards = yield _get_shards_async(user)
+    raise ndb.Return(
+        SeenItemIds([seen_set.SeenSet(s.item_ids or '') for s in shards]))
+
+
+def get(user):
+    """Synchronous version of get_async()."""
+    return get_async(user).get_result()
+
+
+def _put_shards(user, shards, sets, dirty_shards):
+    """Store the modified shards, clearing the user's deprecated list.
+
+    The list is cleared in a copy of the user that is read within the
+    transaction, since the caller's copy may be missing later changes to
+    the user.
+    """
+    entities = []
+    for i in dirty_shards:
+        shards[i].item_ids = sets[i].data
+        entities.append(shards[i])
+    if user.seen_item_ids:
+        user = user.key.get(use_cache=False)
+        if user and user.seen_item_ids:
+            user.seen_item_ids = []
+            entities.append(user)
+    ndb.put_multi(entities)
+
+
+@ndb.transactional
+def add(user, item_ids):
+    """Mark items as seen by a user.
+
+    Args:
+      user: The models.User.
+      item_ids: The ids of the items that the user has seen.
+    Returns:
+      The list of item ids that the user had not seen before.
+    """
+    shards = _get_shards_async(user).get_result()
+    sets = [seen_set.SeenSet(s.item_ids or '') for s in shards]
+    dirty_shards = set()
+    added_item_ids = []
+    for item_id in item_ids:
+        if any(item_id in s for s in sets):
+            continue
+        if len(sets[-1]) >= constants.MAX_SEEN_ITEMS_PER_SHARD:
+            # Start a new shard, and record it in the first one.
+            shards.append(models.SeenItems(
+                key=_shard_key(user.key, len(shards) + 1)))
+            sets.append(seen_set.SeenSet())
+            shards[0].num_shards = len(shards)
+            dirty_shards.add(0)
+        sets[-1].add(item_id)
+        dirty_shards.add(len(shards) - 1)
+        added_item_ids.append(item_id)
+
+    if dirty_shards:
+        _put_shards(user, shards, sets, dirty_shards)
+    return added_item_ids
+
+
+@ndb.transactional
+def remove(user, item_id):
+    """Remove an item from the set of items that a user has seen.
+
+    Args:
+      user: The models.User.
+      item_id: The id of the item to remove.
+    Returns:
+      True if the user had seen the item, False otherwise.
+    """
+    shards = _get_shards_async(user).get_result()
+    sets = [seen_set.SeenSet(s.item_ids or '') for s in shards]
+    for i, s in enumerate(sets):
+        if s.remove(item_id):
+            _put_shards(user, shards, sets, [i])
+            return True
+    return False
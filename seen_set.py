@@ -0,0 +1,96 @@
+import struct
+
+# Each item id is packed as an unsigned, big-endian 64-bit integer.
+_ID = struct.Struct('>Q')
+
+
+class SeenSet(object):
+    """A sorted set of item ids, packed into a byte string.
+
+    Membership tests binary search the packed data directly, so they take
+    O(log n) time without unpacking the whole set. Adding and removing ids
+    splices the byte string, which is a single copy of at most 8 * n bytes.
+    """
+    def __init__(self, data=''):
+        """Create a set from data previously returned by the data property.
+
+        Args:
+          data: The packed item ids.
+        """
+        if len(data) % _ID.size:
+            raise ValueError('Invalid packed data length: {}'.format(
+                len(data)))
+        self._data = data
+
+    @classmethod
+    def from_ids(cls, item_ids):
+        """Create a set containing the given item ids.
+
+        Args:
+          item_ids: An iterable of item ids.
+        Returns:
+          The new SeenSet.
+        """
+        return cls(''.join(_ID.pack(i) for i in sorted(set(item_ids))))
+
+    @property
+    def data(self):
+        """The packed item ids, for storage."""
+        return self._data
+
+    def __len__(self):
+        return len(self._data) // _ID.size
+
+    def __iter__(self):
+        for offset in xrange(0, len(self._data), _ID.size):
+            yield _ID.unpack_from(self._data, offset)[0]
+
+    def __contains__(self, item_id):
+        index = self._bisect(item_id)
+        return index < len(self) and self._id_at(index) == item_id
+
+    def add(self, item_id):
+        """Add an item id to the set.
+
+        Args:
+          item_id: The item id to add.
+        Returns:
+          True if the id was added, False if it was already in the set.
+        """
+        index = self._bisect(item_id)
+        if index < len(self) and self._id_at(index) == item_id:
+            return False
+        offset = index * _ID.size
+        self._data = (self._data[:offset] + _ID.pack(item_id) +
+                      self._data[offset:])
+        return True
+
+    def remove(self, item_id):
+        """Remove an item id from the set.
+
+        Args:
+          item_id: The item id to remove.
+        Returns:
+          True if the id was removed, False if it wasn't in the set.
+        """
+        index = self._bisect(item_id)
+        if index == len(self) or self._id_at(index) != item_id:
+            return False
+        offset = index * _ID.size
+        self._data = self._data[:offset] + self._data[offset + _ID.size:]
+        return True
+
+    def _id_at(self, index):
+        return _ID.unpack_from(self._data, index * _ID.size)[0]
+
+    def _bisect(self, item_id):
+        """Return the index of the first id in the set that is >= item_id."""
+        low = 0
+        high = len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._id_at(middle) < item_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
@@ -0,0 +1,58 @@
+import unittest
+
+import constants
+import seen_set
+
+# The most bytes that a full SeenItems shard may take, so that adding an item
+# to it stays cheap.
+_MAX_SHARD_BYTES = 100 * 1024
+
+
+class SeenSetTest(unittest.TestCase):
+    def test_empty(self):
+        s = seen_set.SeenSet()
+        self.assertEqual(0, len(s))
+        self.assertFalse(1 in s)
+        self.assertListEqual([], list(s))
+
+    def test_from_ids(self):
+        s = seen_set.SeenSet.from_ids([5, 1, 3, 1, 2 ** 63])
+        self.assertListEqual([1, 3, 5, 2 ** 63], list(s))
+        for item_id in [1, 3, 5, 2 ** 63]:
+            self.assertTrue(item_id in s)
+        for item_id in [0, 2, 4, 6, 2 ** 63 - 1]:
+            self.assertFalse(item_id in s)
+
+    def test_add(self):
+        s = seen_set.SeenSet()
+        self.assertTrue(s.add(3))
+        self.assertTrue(s.add(1))
+        self.assertTrue(s.add(2))
+        self.assertFalse(s.add(2))
+        self.assertListEqual([1, 2, 3], list(s))
+
+    def test_remove(self):
+        s = seen_set.SeenSet.from_ids([1, 2, 3])
+        self.assertTrue(s.remove(2))
+        self.assertFalse(s.remove(2))
+        self.assertFalse(s.remove(4))
+        self.assertListEqual([1, 3], list(s))
+        self.assertTrue(s.remove(1))
+        self.assertTrue(s.remove(3))
+        self.assertEqual(0, len(s))
+
+    def test_round_trip(self):
+        s = seen_set.SeenSet.from_ids(range(0, 1000, 7))
+        copy = seen_set.SeenSet(s.data)
+        self.assertListEqual(list(s), list(copy))
+        self.assertEqual(8 * len(s), len(s.data))
+
+    def test_invalid_data(self):
+        self.assertRaises(ValueError, seen_set.SeenSet, 'abc')
+
+    def test_full_shard_size(self):
+        # Allocated ids can take all of the 64 bits.
+        s = seen_set.SeenSet.from_ids(
+            range(2 ** 63 - constants.MAX_SEEN_ITEMS_PER_SHARD, 2 ** 63))
+        self.assertEqual(constants.MAX_SEEN_ITEMS_PER_SHARD, len(s))
+        self.assertLessEqual(len(s.data), _MAX_SHARD_BYTES)
@@ -0,0 +1,58 @@
+from google.appengine.api import memcache
+
+import constants
+
+# The fraction of search results that /item/list skips for a user, because
+# they were seen already or are out of range, as a moving average in
+# memcache. It is used to size the pages of search results, so that users in
+# dense areas get more results per round trip, and others fewer wasted ones.
+_KEY_PREFIX = 'item_list_skip_ratio:'
+
+
+def get(user_key):
+    """Return the skip ratio of a user, or None if it isn't known."""
+    return memcache.get(_KEY_PREFIX + user_key.id())
+
+
+def record(user_key, num_scanned, num_skipped):
+    """Fold the search results of a request into the skip ratio of a user.
+
+    Concurrent requests may overwrite each other's updates, which is fine for
+    an estimate.
+
+    Args:
+      user_key: The key of the user.
+      num_scanned: The number of search results that were looked at.
+      num_skipped: The number of those that were skipped.
+    """
+    if not num_scanned:
+        return
+    ratio = float(num_skipped) / num_scanned
+    previous = get(user_key)
+    if previous is not None:
+        ratio = (constants.SKIP_RATIO_SMOOTHING * ratio +
+                 (1 - constants.SKIP_RATIO_SMOOTHING) * previous)
+    memcache.set(_KEY_PREFIX + user_key.id(), ratio)
+
+
+def page_limit(ratio, num_missing):
+    """Return the number of search results to ask for.
+
+    Page sizes are limited to doublings of constants.MIN_ITEMS_PER_PAGE.
+    Cached pages are always constants.NUM_ITEMS_PER_PAGE results long, and
+    cut short to this.
+
+    Args:
+      ratio: The skip ratio of the user, or None if it isn't known.
+      num_missing: The number of items that are still needed.
+    Returns:
+      The page size, which is at most constants.NUM_ITEMS_PER_PAGE.
+    """
+    if ratio is None:
+        return constants.NUM_ITEMS_PER_PAGE
+    # Aim for enough results to fill the response after skipping.
+    needed = num_missing / max(1 - ratio, 1.0 / constants.NUM_ITEMS_PER_PAGE)
+    limit = constants.MIN_ITEMS_PER_PAGE
+    while limit < needed:
+        limit *= 2
+    return min(limit, constants.NUM_ITEMS_PER_PAGE)
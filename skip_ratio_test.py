@@ -0,0 +1,28 @@
+import unittest
+
+import constants
+import skip_ratio
+
+
+class PageLimitTest(unittest.TestCase):
+    def test_unknown_ratio(self):
+        self.assertEqual(constants.NUM_ITEMS_PER_PAGE,
+                         skip_ratio.page_limit(None, 5))
+
+    def test_low_ratio(self):
+        self.assertEqual(constants.MIN_ITEMS_PER_PAGE,
+                         skip_ratio.page_limit(0, 5))
+        self.assertEqual(constants.MIN_ITEMS_PER_PAGE,
+                         skip_ratio.page_limit(0.5, 5))
+
+    def test_pages_double(self):
+        self.assertEqual(2 * constants.MIN_ITEMS_PER_PAGE,
+                         skip_ratio.page_limit(0.7, 5))
+        self.assertEqual(4 * constants.MIN_ITEMS_PER_PAGE,
+                         skip_ratio.page_limit(0.8, 5))
+
+    def test_high_ratio(self):
+        self.assertEqual(constants.NUM_ITEMS_PER_PAGE,
+                         skip_ratio.page_limit(0.99, 5))
+        self.assertEqual(constants.NUM_ITEMS_PER_PAGE,
+                         skip_ratio.page_limit(1, 5))
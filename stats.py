@@ -0,0 +1,34 @@
+import collections
+import threading
+
+# Per-instance counters, keyed by name. These are reset whenever the instance
+# restarts, so they are only meant for spotting trends.
+_counters = collections.defaultdict(int)
+_lock = threading.Lock()
+
+
+def increment(name, delta=1):
+    """Add delta to the counter with the given name.
+
+    Args:
+      name: The name of the counter.
+      delta: The amount to add to the counter.
+    """
+    with _lock:
+        _counters[name] += delta
+
+
+def get_all():
+    """Return a snapshot of all the counters.
+
+    Returns:
+      A dictionary from counter names to their current values.
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    """Reset all the counters to zero."""
+    with _lock:
+        _counters.clear()
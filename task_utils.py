@@ -0,0 +1,21 @@
+from google.appengine.api import taskqueue
+from webapp2_extras import json
+
+
+def add_task(url, args=None, **kwargs):
+    """Enqueue a push task that POSTs the given arguments as JSON.
+
+    This lets task handlers parse their arguments with
+    BaseHandler.parse_request(), just like the client-facing handlers.
+
+    Args:
+      url: The URL of the task handler.
+      args: A dictionary of arguments for the task handler.
+      kwargs: Any additional arguments for taskqueue.add().
+    Returns:
+      The enqueued taskqueue.Task.
+    """
+    return taskqueue.add(url=url,
+                         payload=json.encode(args or {}),
+                         headers={'Content-Type': 'application/json'},
+                         **kwargs)
@@ -0,0 +1,58 @@
+import time
+
+from google.appengine.api import memcache
+
+# Every user has a version counter in memcache, which is bumped whenever
+# something happens that /updates should tell the user's clients about. A
+# client whose last check-in saw the current version has nothing new to get.
+#
+# Counters start at the current time in microseconds, so that a counter that
+# was evicted and started again is still larger than any version a client saw
+# before the eviction.
+_KEY_PREFIX = 'updates_version:'
+
+
+def _now_micros():
+    return int(time.time() * 1000000)
+
+
+def bump(user_keys):
+    """Bump the version counters of users that have something new.
+
+    This must be called after the new data is stored.
+
+    Args:
+      user_keys: The keys of the users.
+    """
+    memcache.offset_multi(dict((str(k.id()), 1) for k in user_keys),
+                          key_prefix=_KEY_PREFIX,
+                          initial_value=_now_micros())
+
+
+def get(user_key):
+    """Return the current version counter of a user, starting it if needed.
+
+    This must be called before reading the data that the version describes.
+
+    Args:
+      user_key: The key of the user.
+    Returns:
+      The version, or None if memcache is unavailable.
+    """
+    key = _KEY_PREFIX + str(user_key.id())
+    version = memcache.get(key)
+    if version is None:
+        memcache.add(key, _now_micros())
+        version = memcache.get(key)
+    return version
+
+
+def peek(user_key):
+    """Return the current version counter of a user, without starting it.
+
+    Args:
+      user_key: The key of the user.
+    Returns:
+      The version, or None if there is no counter for the user.
+    """
+    return memcache.get(_KEY_PREFIX + str(user_key.id()))
@@ -1,8 +1,21 @@
+import collections
+import hashlib
 import httplib
 import json
+import threading
+import time
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 
+import constants
+import stats
+
+# Markers for the kinds of entries stored in the token cache.
+_TOKEN_VALID = 'valid'
+_TOKEN_EXPIRED = 'expired'
+_TOKEN_INVALID = 'invalid'
+
 
 class FacebookException(Exception):
     """An exception in communicating with Facebook."""
@@ -49,3 +62,125 @@ def get_facebook_user_id(fb_access_token):
 
     # Wrap all other errors.
     raise FacebookException(json.loads(response.content))
+
+
+class _TokenCache(object):
+    """A thread-safe LRU cache whose entries expire after a given time.
+
+    Entries are (kind, value, expiry) triples, where kind is one of the
+    _TOKEN_* markers.
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                return None
+            # Re-insert the entry to mark it as the most recently used.
+            self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_token_cache = _TokenCache(constants.TOKEN_CACHE_SIZE)
+
+
+def _token_cache_key(fb_access_token):
+    # Never store raw access tokens as keys, and keep the memcache key length
+    # bounded.
+    return 'fb_token:' + hashlib.sha256(fb_access_token).hexdigest()
+
+
+def _store_token_entry(cache_key, kind, value, ttl_seconds):
+    entry = (kind, value, time.time() + ttl_seconds)
+    _token_cache.set(cache_key, entry)
+    memcache.set(cache_key, entry, time=ttl_seconds)
+
+
+def _user_id_from_token_entry(entry):
+    kind, value, _ = entry
+    if kind == _TOKEN_EXPIRED:
+        raise FacebookTokenExpiredException()
+    elif kind == _TOKEN_INVALID:
+        raise FacebookException(value)
+    return value
+
+
+def get_cached_facebook_user_id(fb_access_token):
+    """Like get_facebook_user_id(), but backed by a two-tier cache.
+
+    Lookups go to a per-instance LRU cache first, then to memcache, and only
+    then to Facebook. Tokens that Facebook rejects are cached for a shorter
+    time, so that repeated requests with a bad token don't hit Facebook either.
+
+    Args:
+      fb_access_token: The Facebook access token.
+    Raises:
+      FacebookTokenExpiredException: if the given token expired.
+      FacebookException: if there was any other problem getting the Facebook
+        user id using this token.
+    Returns:
+      The (app-specific) Facebook user id for the given user.
+    """
+    if not fb_access_token:
+        return get_facebook_user_id(fb_access_token)
+
+    cache_key = _token_cache_key(fb_access_token)
+    entry = _token_cache.get(cache_key)
+    if entry:
+        stats.increment('token_cache.local_hit')
+        return _user_id_from_token_entry(entry)
+
+    entry = memcache.get(cache_key)
+    if entry and entry[2] > time.time():
+        stats.increment('token_cache.memcache_hit')
+        _token_cache.set(cache_key, entry)
+        return _user_id_from_token_entry(entry)
+
+    stats.increment('token_cache.miss')
+    try:
+        fb_user_id = get_facebook_user_id(fb_access_token)
+    except FacebookTokenExpiredException:
+        # Overwrite any stale entry in both tiers with the expiry.
+        _store_token_entry(cache_key, _TOKEN_EXPIRED, None,
+                           constants.TOKEN_CACHE_NEGATIVE_TTL_SECONDS)
+        raise
+    except FacebookException as e:
+        # Only remember errors that are about the token itself. Anything else
+        # is likely transient, so the next request should retry.
+        if _is_oauth_error(e.error):
+            _store_token_entry(cache_key, _TOKEN_INVALID, e.error,
+                               constants.TOKEN_CACHE_NEGATIVE_TTL_SECONDS)
+        raise
+
+    _store_token_entry(cache_key, _TOKEN_VALID, fb_user_id,
+                       constants.TOKEN_CACHE_TTL_SECONDS)
+    return fb_user_id
+
+
+def clear_token_cache():
+    """Clear the per-instance tier of the token cache."""
+    _token_cache.clear()
+
+
+def _is_oauth_error(error):
+    try:
+        return error['error']['type'] == 'OAuthException'
+    except (KeyError, TypeError):
+        return False